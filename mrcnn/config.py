@@ -24,9 +24,17 @@ class Config(object):
     # experiment is running.
     NAME = None  # Override in sub-classes
 
-    # NUMBER OF GPUs to use. When using only a CPU, this needs to be set to 1.
+    # NUMBER OF GPUs to use. When using only a CPU, this needs to be set to 1,
+    # unless TOWER_DEVICE is "cpu".
     GPU_COUNT = 1
 
+    # Device type of the GPU_COUNT model copies. "cpu" places them on as many
+    # virtual CPU devices, each with its own pool of CPU_TOWER_THREADS intra-op
+    # threads, to use several sockets of a CPU-only host. The batch is sliced
+    # across them the same way. XLA_JIT is not applied to CPU towers.
+    TOWER_DEVICE = "gpu"
+    CPU_TOWER_THREADS = 4
+
     # Number of images to train with on each GPU. A 12GB GPU can typically
     # handle 2 images of 1024x1024px.
     # Adjust based on your GPU memory and image sizes. Use the highest
@@ -48,7 +56,8 @@ class Config(object):
     VALIDATION_STEPS = 50
 
     # Backbone network architecture
-    # Supported values are: resnet50, resnet101.
+    # Supported values are the keys of model.BACKBONES: resnet50, resnet101
+    # and mobilenet, a lighter depthwise separable network for CPU inference.
     # You can also provide a callable that should have the signature
     # of model.resnet_graph. If you do so, you need to supply a callable
     # to COMPUTE_BACKBONE_SHAPE as well
@@ -136,6 +145,18 @@ class Config(object):
     # details: https://github.com/matterport/Mask_RCNN/wiki
     IMAGE_CHANNEL_COUNT = 3
 
+    # Number of image shapes whose anchors MaskRCNN.get_anchors() keeps. With
+    # "pad64" every new image size adds an entry, so the least recently used
+    # shapes are dropped first.
+    ANCHOR_CACHE_SIZE = 16
+
+    # Inference only. If True, the model runs in a session with XLA JIT
+    # auto-clustering (CPU included) and grappler remapping, see
+    # model.inference_session(). Ops XLA can't compile, like NMS, run as
+    # before. Each new input shape is compiled once, so it pays off most
+    # with fixed size inputs. Falls back to the regular session on errors.
+    XLA_JIT = False
+
     # Image mean (RGB)
     MEAN_PIXEL = np.array([123.7, 116.8, 103.9])
 
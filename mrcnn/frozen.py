@@ -0,0 +1,284 @@
+"""
+Mask R-CNN
+Frozen inference graph export and a Keras-free loader.
+
+The exported GraphDef holds the weights as constants, generates the anchors
+in the graph from the input image shape, and keeps only the two outputs that
+detect() consumes. Loading it is a single import_graph_def() call, instead of
+rebuilding the Keras model in Python and walking the h5 file layer by layer.
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import time
+import numpy as np
+import tensorflow as tf
+
+from mrcnn import utils
+
+# Names of the endpoints in the exported graph
+INPUT_IMAGE = "input_image"
+INPUT_IMAGE_META = "input_image_meta"
+OUTPUT_DETECTIONS = "detections"
+OUTPUT_MASKS = "mrcnn_mask"
+
+
+############################################################
+#  Export
+############################################################
+
+def generate_pyramid_anchors_graph(image_shape, config):
+    """Graph version of utils.generate_pyramid_anchors() followed by
+    utils.norm_boxes(). Supports ResNet backbones only.
+
+    image_shape: [height, width] int32 tensor of the molded image.
+
+    Returns:
+        [N, (y1, x1, y2, x2)] anchors in normalized coordinates, in the
+        same order as MaskRCNN.get_anchors().
+    """
+    anchors = []
+    for scale, stride in zip(config.RPN_ANCHOR_SCALES, config.BACKBONE_STRIDES):
+        # Heights and widths of the anchors of one cell. Static.
+        scales, ratios = np.meshgrid(np.array(scale), np.array(config.RPN_ANCHOR_RATIOS))
+        scales = scales.flatten()
+        ratios = ratios.flatten()
+        sizes = np.stack([scales / np.sqrt(ratios),
+                          scales * np.sqrt(ratios)], axis=1).astype(np.float32)
+
+        # Shifts in feature space. Backbone shape is ceil(image / stride).
+        shape = (image_shape + stride - 1) // stride
+        shifts_y = tf.to_float(tf.range(0, shape[0], config.RPN_ANCHOR_STRIDE) * stride)
+        shifts_x = tf.to_float(tf.range(0, shape[1], config.RPN_ANCHOR_STRIDE) * stride)
+        shifts_x, shifts_y = tf.meshgrid(shifts_x, shifts_y)
+
+        # [cells, anchors per cell, (y, x)] centers and (h, w) sizes
+        centers = tf.stack([tf.reshape(shifts_y, [-1]),
+                            tf.reshape(shifts_x, [-1])], axis=1)
+        centers = tf.tile(centers[:, tf.newaxis], [1, sizes.shape[0], 1])
+        boxes = tf.concat([centers - 0.5 * sizes, centers + 0.5 * sizes], axis=2)
+        anchors.append(tf.reshape(boxes, [-1, 4]))
+    anchors = tf.concat(anchors, axis=0)
+
+    # Normalize coordinates the same way utils.norm_boxes() does
+    h = tf.to_float(image_shape[0])
+    w = tf.to_float(image_shape[1])
+    scale = tf.stack([h - 1, w - 1, h - 1, w - 1])
+    shift = tf.constant([0., 0., 1., 1.])
+    return (anchors - shift) / scale
+
+
+def export_frozen_graph(model, path, optimize=True):
+    """Freezes an inference MaskRCNN into a single GraphDef file.
+
+    model: MaskRCNN in inference mode with its weights already loaded.
+    path: Where to write the .pb file.
+    optimize: If True, run the TF graph transforms that fold constants and
+        batch norms and drop the nodes that don't feed the outputs.
+    """
+    assert model.mode == "inference", "Create model in inference mode."
+    assert model.config.GPU_COUNT == 1, "Export a single tower model (GPU_COUNT = 1)."
+    config = model.config
+    keras_model = model.keras_model
+    input_image, input_image_meta, input_anchors = keras_model.inputs
+    detections, _, _, mrcnn_mask = keras_model.outputs[:4]
+
+    # 1. Replace the variables with their current values
+    import keras.backend as K
+    sess = K.get_session()
+    frozen = tf.graph_util.convert_variables_to_constants(
+        sess, sess.graph.as_graph_def(),
+        [detections.op.name, mrcnn_mask.op.name])
+
+    # 2. Re-import it behind new inputs with the anchors built in the graph
+    graph = tf.Graph()
+    with graph.as_default():
+        image = tf.placeholder(tf.float32, [None, None, None, config.IMAGE_CHANNEL_COUNT],
+                               name=INPUT_IMAGE)
+        image_meta = tf.placeholder(tf.float32, [None, config.IMAGE_META_SIZE],
+                                    name=INPUT_IMAGE_META)
+        anchors = generate_pyramid_anchors_graph(tf.shape(image)[1:3], config)
+        anchors = tf.tile(anchors[tf.newaxis], [tf.shape(image)[0], 1, 1])
+        outputs = tf.import_graph_def(
+            frozen,
+            input_map={input_image.name: image,
+                       input_image_meta.name: image_meta,
+                       input_anchors.name: anchors},
+            return_elements=[detections.name, mrcnn_mask.name],
+            name="mrcnn")
+        tf.identity(outputs[0], name=OUTPUT_DETECTIONS)
+        tf.identity(outputs[1], name=OUTPUT_MASKS)
+    graph_def = tf.graph_util.extract_sub_graph(
+        graph.as_graph_def(), [OUTPUT_DETECTIONS, OUTPUT_MASKS])
+
+    # 3. Constant folding
+    if optimize:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        graph_def = TransformGraph(
+            graph_def, [INPUT_IMAGE, INPUT_IMAGE_META],
+            [OUTPUT_DETECTIONS, OUTPUT_MASKS],
+            ["fold_constants(ignore_errors=true)",
+             "fold_batch_norms",
+             "fold_old_batch_norms",
+             "strip_unused_nodes",
+             "sort_by_execution_order"])
+
+    with tf.gfile.GFile(path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    print("Exported {} nodes to {}".format(len(graph_def.node), path))
+    return path
+
+
+############################################################
+#  Loader
+############################################################
+
+class FrozenMaskRCNN():
+    """Runs a graph written by export_frozen_graph() in a plain tf.Session.
+    Same detect() interface as MaskRCNN in inference mode, without Keras.
+    """
+
+    def __init__(self, config, path, session_config=None):
+        """
+        config: The Config the graph was exported with.
+        path: The .pb file written by export_frozen_graph().
+        session_config: Optional tf.ConfigProto for the session.
+        """
+        start = time.time()
+        self.config = config
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=self.graph, config=session_config)
+        self.input_image = self.graph.get_tensor_by_name(INPUT_IMAGE + ":0")
+        self.input_image_meta = self.graph.get_tensor_by_name(INPUT_IMAGE_META + ":0")
+        self.detections = self.graph.get_tensor_by_name(OUTPUT_DETECTIONS + ":0")
+        self.mrcnn_mask = self.graph.get_tensor_by_name(OUTPUT_MASKS + ":0")
+        self.load_time = time.time() - start
+
+    def mold_inputs(self, images):
+        """Same as MaskRCNN.mold_inputs().
+
+        Returns molded_images, image_metas and windows.
+        """
+        molded_images = []
+        image_metas = []
+        windows = []
+        for image in images:
+            molded_image, window, scale, padding, crop = utils.resize_image(
+                image,
+                min_dim=self.config.IMAGE_MIN_DIM,
+                min_scale=self.config.IMAGE_MIN_SCALE,
+                max_dim=self.config.IMAGE_MAX_DIM,
+                mode=self.config.IMAGE_RESIZE_MODE)
+            molded_image = molded_image.astype(np.float32) - self.config.MEAN_PIXEL
+            # Same layout as model.compose_image_meta()
+            image_meta = np.array(
+                [0] + list(image.shape) + list(molded_image.shape) +
+                list(window) + [scale] +
+                [0] * self.config.NUM_CLASSES)
+            molded_images.append(molded_image)
+            windows.append(window)
+            image_metas.append(image_meta)
+        return np.stack(molded_images), np.stack(image_metas), np.stack(windows)
+
+    def unmold_detections(self, detections, mrcnn_mask, original_image_shape,
+                          image_shape, window):
+        """Same as MaskRCNN.unmold_detections().
+
+        Returns boxes, class_ids, scores and full size masks of one image.
+        """
+        zero_ix = np.where(detections[:, 4] == 0)[0]
+        N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[0]
+
+        boxes = detections[:N, :4]
+        class_ids = detections[:N, 4].astype(np.int32)
+        scores = detections[:N, 5]
+        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+
+        # Normalized coordinates in the molded image to pixels in the original
+        wy1, wx1, wy2, wx2 = utils.norm_boxes(window, image_shape[:2])
+        shift = np.array([wy1, wx1, wy1, wx1])
+        scale = np.array([wy2 - wy1, wx2 - wx1, wy2 - wy1, wx2 - wx1])
+        boxes = utils.denorm_boxes(np.divide(boxes - shift, scale),
+                                   original_image_shape[:2])
+
+        # Filter out detections with zero area
+        keep = np.where(
+            (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) > 0)[0]
+        boxes, class_ids, scores, masks = \
+            boxes[keep], class_ids[keep], scores[keep], masks[keep]
+
+        full_masks = [utils.unmold_mask(masks[i], boxes[i], original_image_shape)
+                      for i in range(class_ids.shape[0])]
+        full_masks = np.stack(full_masks, axis=-1)\
+            if full_masks else np.empty(original_image_shape[:2] + (0,))
+        return boxes, class_ids, scores, full_masks
+
+    def detect(self, images, verbose=0):
+        """Runs the detection pipeline. See MaskRCNN.detect().
+
+        images: List of images. They must have the same shape after molding.
+
+        Returns a list of dicts with rois, class_ids, scores and masks.
+        """
+        molded_images, image_metas, windows = self.mold_inputs(images)
+        image_shape = molded_images[0].shape
+        for g in molded_images[1:]:
+            assert g.shape == image_shape,\
+                "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
+
+        detections, mrcnn_mask = self.session.run(
+            [self.detections, self.mrcnn_mask],
+            {self.input_image: molded_images, self.input_image_meta: image_metas})
+
+        results = []
+        for i, image in enumerate(images):
+            final_rois, final_class_ids, final_scores, final_masks =\
+                self.unmold_detections(detections[i], mrcnn_mask[i],
+                                       image.shape, molded_images[i].shape,
+                                       windows[i])
+            results.append({
+                "rois": final_rois,
+                "class_ids": final_class_ids,
+                "scores": final_scores,
+                "masks": final_masks,
+            })
+        return results
+
+    def detect_iter(self, image_source, batch_size=None):
+        """Same interface as MaskRCNN.detect_iter(). The exported graph is
+        built for batches of exactly BATCH_SIZE (the DetectionLayer reshape
+        and batch_slice() use IMAGES_PER_GPU), so runs of up to BATCH_SIZE
+        consecutive images of the same shape are detected together, a
+        shorter run padded with copies of its last image.
+
+        image_source: Iterable of images or of image file paths.
+        batch_size: Must be BATCH_SIZE, the default.
+
+        Yields one dict per image, in order.
+        """
+        batch_size = batch_size or self.config.BATCH_SIZE
+        assert batch_size == self.config.BATCH_SIZE,\
+            "The frozen graph only runs batches of BATCH_SIZE"
+        batch = []
+        for image in image_source:
+            if isinstance(image, str):
+                image = utils.read_image(image)
+            if batch and (len(batch) == batch_size or image.shape != batch[0].shape):
+                for r in self._detect_padded(batch):
+                    yield r
+                batch = []
+            batch.append(image)
+        if batch:
+            for r in self._detect_padded(batch):
+                yield r
+
+    def _detect_padded(self, images):
+        # detect() of up to BATCH_SIZE images, filled up with copies of the
+        # last one
+        padded = images + images[-1:] * (self.config.BATCH_SIZE - len(images))
+        return self.detect(padded)[:len(images)]
@@ -17,6 +17,7 @@ from collections import OrderedDict
 import multiprocessing
 import numpy as np
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 import keras
 import keras.backend as K
 import keras.layers as KL
@@ -50,6 +51,31 @@ def log(text, array=None):
     print(text)
 
 
+def inference_session(jit=False):
+    """Creates a tf.Session for inference.
+
+    jit: If True, XLA auto-clustering compiles the ops it supports (the
+        convs, BatchNorm and activations of the backbone, FPN and heads)
+        into fused kernels, on CPU as well, and grappler's remapper fuses
+        conv, bias and activation ops. Ops XLA can't compile, like NMS,
+        crop_and_resize or py_func, stay out of the clusters and run on
+        the regular executor.
+    """
+    session_config = tf.ConfigProto()
+    session_config.gpu_options.allow_growth = True
+    if jit:
+        # Auto-clustering only covers the GPU without this flag. It has to
+        # be set before the first session of the process is created.
+        xla_flags = os.environ.get("TF_XLA_FLAGS", "")
+        if "--tf_xla_cpu_global_jit" not in xla_flags:
+            os.environ["TF_XLA_FLAGS"] = (xla_flags + " --tf_xla_cpu_global_jit").strip()
+        session_config.graph_options.optimizer_options.global_jit_level =\
+            tf.OptimizerOptions.ON_1
+        session_config.graph_options.rewrite_options.remapping =\
+            rewriter_config_pb2.RewriterConfig.ON
+    return tf.Session(config=session_config)
+
+
 class BatchNorm(KL.BatchNormalization):
     """Extends the Keras BatchNormalization class to allow a central place
     to make changes if needed.
@@ -77,8 +103,8 @@ def compute_backbone_shapes(config, image_shape):
     if callable(config.BACKBONE):
         return config.COMPUTE_BACKBONE_SHAPE(image_shape)
 
-    # Currently supports ResNet only
-    assert config.BACKBONE in ["resnet50", "resnet101"]
+    # Backbones of BACKBONES all have the ResNet strides
+    assert config.BACKBONE in BACKBONES
     return np.array(
         [[int(math.ceil(image_shape[0] / stride)),
             int(math.ceil(image_shape[1] / stride))]
@@ -206,6 +232,78 @@ def resnet_graph(input_image, architecture, stage5=False, train_bn=True):
     return [C1, C2, C3, C4, C5]
 
 
+############################################################
+#  MobileNet Graph
+############################################################
+
+def separable_block(input_tensor, filters, stage, block, strides=(1, 1),
+                    use_bias=True, train_bn=True):
+    """Depthwise separable block: a 3x3 depthwise conv and a 1x1 pointwise
+    conv, followed by BatchNorm and ReLU.
+    # Arguments
+        input_tensor: input tensor
+        filters: integer, the nb_filters of the pointwise conv
+        stage: integer, current stage label, used for generating layer names
+        block: 'a','b'..., current block label, used for generating layer names
+        strides: strides of the depthwise conv
+        use_bias: Boolean. To use or not use a bias in conv layers.
+        train_bn: Boolean. Train or freeze Batch Norm layers
+    Both convs come from one SeparableConv2D, so there is no BatchNorm
+    between them.
+    """
+    x = KL.SeparableConv2D(filters, (3, 3), strides=strides, padding='same',
+                           name='res' + str(stage) + block + '_sep',
+                           use_bias=use_bias)(input_tensor)
+    x = BatchNorm(name='bn' + str(stage) + block + '_sep')(x, training=train_bn)
+    x = KL.Activation('relu', name='res' + str(stage) + block + '_out')(x)
+    return x
+
+
+def mobilenet_graph(input_image, architecture, stage5=False, train_bn=True):
+    """Build a MobileNet style graph with the ResNet strides.
+        architecture: Must be mobilenet
+        stage5: Boolean. If False, stage5 of the network is not created
+        train_bn: Boolean. Train or freeze Batch Norm layers
+    Layers are named like the ResNet ones (res3a_sep, bn3a_sep, ...) so
+    the stage groups of MaskRCNN.train() select them.
+    """
+    assert architecture == "mobilenet"
+    # Stage 1
+    x = KL.Conv2D(32, (3, 3), strides=(2, 2), padding='same', name='conv1',
+                  use_bias=True)(input_image)
+    x = BatchNorm(name='bn_conv1')(x, training=train_bn)
+    C1 = x = KL.Activation('relu')(x)
+    # Stage 2
+    x = separable_block(x, 64, stage=2, block='a', train_bn=train_bn)
+    x = separable_block(x, 128, stage=2, block='b', strides=(2, 2), train_bn=train_bn)
+    C2 = x = separable_block(x, 128, stage=2, block='c', train_bn=train_bn)
+    # Stage 3
+    x = separable_block(x, 256, stage=3, block='a', strides=(2, 2), train_bn=train_bn)
+    C3 = x = separable_block(x, 256, stage=3, block='b', train_bn=train_bn)
+    # Stage 4
+    x = separable_block(x, 512, stage=4, block='a', strides=(2, 2), train_bn=train_bn)
+    for i in range(5):
+        x = separable_block(x, 512, stage=4, block=chr(98 + i), train_bn=train_bn)
+    C4 = x
+    # Stage 5
+    if stage5:
+        x = separable_block(x, 1024, stage=5, block='a', strides=(2, 2), train_bn=train_bn)
+        C5 = x = separable_block(x, 1024, stage=5, block='b', train_bn=train_bn)
+    else:
+        C5 = None
+    return [C1, C2, C3, C4, C5]
+
+
+# Backbones selectable by name with config.BACKBONE. Each one is called as
+# graph(input_image, name, stage5=True, train_bn=...) and returns
+# [C1, C2, C3, C4, C5] with strides 2, 4, 8, 16 and 32.
+BACKBONES = {
+    "resnet50": resnet_graph,
+    "resnet101": resnet_graph,
+    "mobilenet": mobilenet_graph,
+}
+
+
 ############################################################
 #  Proposal Layer
 ############################################################
@@ -393,6 +491,10 @@ class PyramidROIAlign(KE.Layer):
         roi_level = tf.squeeze(roi_level, 2)
 
         # Loop through levels and apply ROI pooling to each. P2 to P5.
+        # Each level writes its crops straight into the slots of its boxes
+        # in the flattened [batch * num_boxes] order, so no sort is needed
+        # to restore the original box order afterwards.
+        num_boxes = tf.shape(boxes)[1]
         pooled = []
         box_to_level = []
         for i, level in enumerate(range(2, 6)):
@@ -402,8 +504,9 @@ class PyramidROIAlign(KE.Layer):
             # Box indices for crop_and_resize.
             box_indices = tf.cast(ix[:, 0], tf.int32)
 
-            # Keep track of which box is mapped to which level
-            box_to_level.append(ix)
+            # Keep track of where each box of this level goes in the output
+            ix = tf.cast(ix, tf.int32)
+            box_to_level.append(ix[:, 0] * num_boxes + ix[:, 1])
 
             # Stop gradient propogation to ROI proposals
             level_boxes = tf.stop_gradient(level_boxes)
@@ -417,29 +520,15 @@ class PyramidROIAlign(KE.Layer):
             #
             # Here we use the simplified approach of a single value per bin,
             # which is how it's done in tf.crop_and_resize()
-            # Result: [batch * num_boxes, pool_height, pool_width, channels]
+            # Result: [level_boxes, pool_height, pool_width, channels]
             pooled.append(tf.image.crop_and_resize(
                 feature_maps[i], level_boxes, box_indices, self.pool_shape,
                 method="bilinear"))
 
-        # Pack pooled features into one tensor
-        pooled = tf.concat(pooled, axis=0)
-
-        # Pack box_to_level mapping into one array and add another
-        # column representing the order of pooled boxes
-        box_to_level = tf.concat(box_to_level, axis=0)
-        box_range = tf.expand_dims(tf.range(tf.shape(box_to_level)[0]), 1)
-        box_to_level = tf.concat([tf.cast(box_to_level, tf.int32), box_range],
-                                 axis=1)
-
-        # Rearrange pooled features to match the order of the original boxes
-        # Sort box_to_level by batch then box index
-        # TF doesn't have a way to sort by two columns, so merge them and sort.
-        sorting_tensor = box_to_level[:, 0] * 100000 + box_to_level[:, 1]
-        ix = tf.nn.top_k(sorting_tensor, k=tf.shape(
-            box_to_level)[0]).indices[::-1]
-        ix = tf.gather(box_to_level[:, 2], ix)
-        pooled = tf.gather(pooled, ix)
+        # Every box is assigned to exactly one level, so the per-level
+        # slots cover [0, batch * num_boxes) and stitch into one tensor.
+        # Result: [batch * num_boxes, pool_height, pool_width, channels]
+        pooled = tf.dynamic_stitch(box_to_level, pooled)
 
         # Re-add the batch dimension
         shape = tf.concat([tf.shape(boxes)[:2], tf.shape(pooled)[1:]], axis=0)
@@ -814,10 +903,11 @@ class DetectionLayer(KE.Layer):
 
         # Reshape output
         # [batch, num_detections, (y1, x1, y2, x2, class_id, class_score)] in
-        # normalized coordinates
+        # normalized coordinates. With several towers, each one only sees
+        # IMAGES_PER_GPU images.
         return tf.reshape(
             detections_batch,
-            [self.config.BATCH_SIZE, self.config.DETECTION_MAX_INSTANCES, 6])
+            [self.config.IMAGES_PER_GPU, self.config.DETECTION_MAX_INSTANCES, 6])
 
     def compute_output_shape(self, input_shape):
         return (None, self.config.DETECTION_MAX_INSTANCES, 6)
@@ -1834,6 +1924,14 @@ class MaskRCNN():
         self.config = config
         self.model_dir = model_dir
         self.set_log_dir()
+        # Optionally compile the inference graph with XLA, or run the towers
+        # on virtual CPU devices with a thread pool each
+        self.jit = mode == "inference" and config.XLA_JIT and config.TOWER_DEVICE == "gpu"
+        if self.jit:
+            K.set_session(inference_session(jit=True))
+        elif config.TOWER_DEVICE == "cpu":
+            from mrcnn.parallel_model import cpu_tower_session
+            K.set_session(cpu_tower_session(config.GPU_COUNT, config.CPU_TOWER_THREADS))
         self.keras_model = self.build(mode=mode, config=config)
 
     def build(self, mode, config):
@@ -1897,8 +1995,8 @@ class MaskRCNN():
             _, C2, C3, C4, C5 = config.BACKBONE(input_image, stage5=True,
                                                 train_bn=config.TRAIN_BN)
         else:
-            _, C2, C3, C4, C5 = resnet_graph(input_image, config.BACKBONE,
-                                             stage5=True, train_bn=config.TRAIN_BN)
+            _, C2, C3, C4, C5 = BACKBONES[config.BACKBONE](
+                input_image, config.BACKBONE, stage5=True, train_bn=config.TRAIN_BN)
         # Top-down Layers
         # TODO: add assert to varify feature map sizes match what's in config
         P5 = KL.Conv2D(config.TOP_DOWN_PYRAMID_SIZE, (1, 1), name='fpn_c5p5')(C5)
@@ -2059,7 +2157,7 @@ class MaskRCNN():
         # Add multi-GPU support.
         if config.GPU_COUNT > 1:
             from mrcnn.parallel_model import ParallelModel
-            model = ParallelModel(model, config.GPU_COUNT)
+            model = ParallelModel(model, config.GPU_COUNT, device=config.TOWER_DEVICE)
 
         return model
 
@@ -2313,7 +2411,7 @@ class MaskRCNN():
         layer_regex = {
             # all layers but the backbone
             "heads": r"(mrcnn\_.*)|(rpn\_.*)|(fpn\_.*)",
-            # From a specific Resnet stage and up
+            # From a specific backbone stage and up
             "3+": r"(res3.*)|(bn3.*)|(res4.*)|(bn4.*)|(res5.*)|(bn5.*)|(mrcnn\_.*)|(rpn\_.*)|(fpn\_.*)",
             "4+": r"(res4.*)|(bn4.*)|(res5.*)|(bn5.*)|(mrcnn\_.*)|(rpn\_.*)|(fpn\_.*)",
             "5+": r"(res5.*)|(bn5.*)|(mrcnn\_.*)|(rpn\_.*)|(fpn\_.*)",
@@ -2479,6 +2577,26 @@ class MaskRCNN():
 
         return boxes, class_ids, scores, full_masks
 
+    def predict(self, inputs):
+        """Runs keras_model.predict() on the inputs. If the XLA_JIT session
+        fails to compile or run the graph, switches to a regular session
+        with the same weights and runs it there.
+        """
+        # The graph is built for batches of BATCH_SIZE
+        batch_size = self.config.BATCH_SIZE
+        try:
+            return self.keras_model.predict(inputs, batch_size=batch_size, verbose=0)
+        except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError,
+                tf.errors.InternalError) as e:
+            if not self.jit:
+                raise
+            log("XLA JIT failed ({}), using the default executor".format(type(e).__name__))
+            weights = self.keras_model.get_weights()
+            K.set_session(inference_session(jit=False))
+            self.keras_model.set_weights(weights)
+            self.jit = False
+            return self.keras_model.predict(inputs, batch_size=batch_size, verbose=0)
+
     def detect(self, images, verbose=0):
         """Runs the detection pipeline.
 
@@ -2521,7 +2639,7 @@ class MaskRCNN():
             log("anchors", anchors)
         # Run object detection
         detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+            self.predict([molded_images, image_metas, anchors])
         # Process detections
         results = []
         for i, image in enumerate(images):
@@ -2578,7 +2696,7 @@ class MaskRCNN():
             log("anchors", anchors)
         # Run object detection
         detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+            self.predict([molded_images, image_metas, anchors])
         # Process detections
         results = []
         for i, image in enumerate(molded_images):
@@ -2595,13 +2713,103 @@ class MaskRCNN():
             })
         return results
 
+    def detect_iter(self, image_source, batch_size=None, max_pending=None):
+        """Runs the detection pipeline on any number of images, batching
+        those that have the same shape after molding.
+
+        image_source: Iterable of images or of image file paths.
+        batch_size: Number of images per predict() call. A multiple of
+            BATCH_SIZE, BATCH_SIZE by default.
+        max_pending: Most images held while waiting for a full batch of
+            their shape, 4 * batch_size by default. When it's reached, the
+            batch of the oldest image runs padded. The last batches of
+            each shape run padded too.
+
+        Yields one dict per image, in the order of image_source, as
+        detect() returns them.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        batch_size = batch_size or self.config.BATCH_SIZE
+        assert batch_size % self.config.BATCH_SIZE == 0,\
+            "batch_size must be a multiple of BATCH_SIZE"
+        max_pending = max_pending or 4 * batch_size
+
+        # Molded images waiting for a batch, by molded shape, and results
+        # waiting for the ones of earlier images
+        groups = OrderedDict()
+        pending = 0
+        results = {}
+        next_index = 0
+        for index, image in enumerate(image_source):
+            if isinstance(image, str):
+                image = utils.read_image(image)
+            molded_images, image_metas, windows = self.mold_inputs([image])
+            shape = molded_images.shape[1:]
+            groups.setdefault(shape, []).append(
+                (index, image.shape, molded_images[0], image_metas[0], windows[0]))
+            pending += 1
+            if len(groups[shape]) == batch_size:
+                results.update(self._detect_group(groups.pop(shape), batch_size))
+                pending -= batch_size
+            elif pending >= max_pending:
+                # Flush the group of the oldest image
+                oldest = min(groups, key=lambda k: groups[k][0][0])
+                group = groups.pop(oldest)
+                results.update(self._detect_group(group, batch_size))
+                pending -= len(group)
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+        for group in groups.values():
+            results.update(self._detect_group(group, batch_size))
+        while next_index in results:
+            yield results.pop(next_index)
+            next_index += 1
+
+    def _detect_group(self, group, batch_size):
+        """Runs a group of molded images of the same shape through the model
+        as one batch, padded to a multiple of BATCH_SIZE with copies of the
+        last image.
+
+        group: list of (index, original image shape, molded image, image meta,
+            window) tuples.
+
+        Returns a dict of the results of the group by index.
+        """
+        count = -(-len(group) // self.config.BATCH_SIZE) * self.config.BATCH_SIZE
+        group = group + [group[-1]] * (count - len(group))
+        molded_images = np.stack([g[2] for g in group])
+        image_metas = np.stack([g[3] for g in group])
+        anchors = self.get_anchors(molded_images.shape[1:])
+        anchors = np.broadcast_to(anchors, (count,) + anchors.shape)
+        detections, _, _, mrcnn_mask, _, _, _ =\
+            self.predict([molded_images, image_metas, anchors])
+        results = {}
+        for i, (index, image_shape, molded_image, _, window) in enumerate(group):
+            if index in results:
+                continue
+            final_rois, final_class_ids, final_scores, final_masks =\
+                self.unmold_detections(detections[i], mrcnn_mask[i],
+                                       image_shape, molded_image.shape,
+                                       window)
+            results[index] = {
+                "rois": final_rois,
+                "class_ids": final_class_ids,
+                "scores": final_scores,
+                "masks": final_masks,
+            }
+        return results
+
     def get_anchors(self, image_shape):
         """Returns anchor pyramid for the given image size."""
         backbone_shapes = compute_backbone_shapes(self.config, image_shape)
-        # Cache anchors and reuse if image shape is the same
+        # Cache anchors and reuse if image shape is the same. Keep the
+        # ANCHOR_CACHE_SIZE most recently used shapes.
         if not hasattr(self, "_anchor_cache"):
-            self._anchor_cache = {}
-        if not tuple(image_shape) in self._anchor_cache:
+            self._anchor_cache = OrderedDict()
+        if tuple(image_shape) in self._anchor_cache:
+            self._anchor_cache.move_to_end(tuple(image_shape))
+        else:
             # Generate Anchors
             a = utils.generate_pyramid_anchors(
                 self.config.RPN_ANCHOR_SCALES,
@@ -2615,6 +2823,8 @@ class MaskRCNN():
             self.anchors = a
             # Normalize coordinates
             self._anchor_cache[tuple(image_shape)] = utils.norm_boxes(a, image_shape[:2])
+            while len(self._anchor_cache) > self.config.ANCHOR_CACHE_SIZE:
+                self._anchor_cache.popitem(last=False)
         return self._anchor_cache[tuple(image_shape)]
 
     def ancestor(self, tensor, name, checked=None):
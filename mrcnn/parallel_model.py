@@ -1,6 +1,6 @@
 """
 Mask R-CNN
-Multi-GPU Support for Keras.
+Multi-GPU (and multi-CPU-device) Support for Keras.
 
 Copyright (c) 2017 Matterport, Inc.
 Licensed under the MIT License (see LICENSE for details)
@@ -13,27 +13,50 @@ https://github.com/avolkov1/keras_experiments/blob/master/keras_exp/multigpu/
 https://github.com/fchollet/keras/blob/master/keras/utils/training_utils.py
 """
 
+import os
 import tensorflow as tf
 import keras.backend as K
 import keras.layers as KL
 import keras.models as KM
 
 
+def cpu_tower_session(tower_count, threads_per_tower):
+    """Creates a tf.Session with tower_count virtual CPU devices, /cpu:0 to
+    /cpu:N-1, to run a ParallelModel built with device="cpu".
+
+    Each device gets its own intra-op thread pool of threads_per_tower
+    threads instead of all of them sharing one pool, so the towers don't
+    compete for the same threads. TF reads TF_OVERRIDE_GLOBAL_THREADPOOL
+    when a session creates its devices.
+    """
+    os.environ["TF_OVERRIDE_GLOBAL_THREADPOOL"] = "1"
+    config = tf.ConfigProto(device_count={"CPU": tower_count},
+                            intra_op_parallelism_threads=threads_per_tower,
+                            inter_op_parallelism_threads=tower_count,
+                            allow_soft_placement=True)
+    return tf.Session(config=config)
+
+
 class ParallelModel(KM.Model):
     """Subclasses the standard Keras Model and adds multi-GPU support.
     It works by creating a copy of the model on each GPU. Then it slices
     the inputs and sends a slice to each copy of the model, and then
     merges the outputs together and applies the loss on the combined
     outputs.
+    With device="cpu", the copies go to virtual CPU devices instead. See
+    cpu_tower_session() for the session they need.
     """
 
-    def __init__(self, keras_model, gpu_count):
+    def __init__(self, keras_model, gpu_count, device="gpu"):
         """Class constructor.
         keras_model: The Keras model to parallelize
-        gpu_count: Number of GPUs. Must be > 1
+        gpu_count: Number of GPUs (or CPU devices). Must be > 1
+        device: "gpu" or "cpu", the type of device to place the copies on
         """
+        assert device in ["gpu", "cpu"]
         self.inner_model = keras_model
         self.gpu_count = gpu_count
+        self.device = device
         merged_outputs = self.make_parallel()
         super(ParallelModel, self).__init__(inputs=self.inner_model.inputs,
                                             outputs=merged_outputs)
@@ -53,7 +76,7 @@ class ParallelModel(KM.Model):
 
     def make_parallel(self):
         """Creates a new wrapper model that consists of multiple replicas of
-        the original model placed on different GPUs.
+        the original model placed on different GPUs (or CPU devices).
         """
         # Slice inputs. Slice inputs on the CPU to avoid sending a copy
         # of the full inputs to all GPUs. Saves on bandwidth and memory.
@@ -68,7 +91,7 @@ class ParallelModel(KM.Model):
 
         # Run the model call() on each GPU to place the ops there
         for i in range(self.gpu_count):
-            with tf.device('/gpu:%d' % i):
+            with tf.device('/%s:%d' % (self.device, i)):
                 with tf.name_scope('tower_%d' % i):
                     # Run a slice of inputs through this replica
                     zipped_inputs = zip(self.inner_model.input_names,
@@ -13,7 +13,6 @@ import logging
 import math
 import random
 import numpy as np
-import tensorflow as tf
 import scipy
 import skimage.color
 import skimage.io
@@ -184,6 +183,9 @@ def box_refinement_graph(box, gt_box):
     """Compute refinement needed to transform box to gt_box.
     box and gt_box are [N, (y1, x1, y2, x2)]
     """
+    # TensorFlow is imported where it is used, so that processes that only
+    # read images or post-process detections don't load it
+    import tensorflow as tf
     box = tf.cast(box, tf.float32)
     gt_box = tf.cast(gt_box, tf.float32)
 
@@ -355,15 +357,7 @@ class Dataset(object):
     def load_image(self, image_id):
         """Load the specified image and return a [H,W,3] Numpy array.
         """
-        # Load image
-        image = skimage.io.imread(self.image_info[image_id]['path'])
-        # If grayscale. Convert to RGB for consistency.
-        if image.ndim != 3:
-            image = skimage.color.gray2rgb(image)
-        # If has an alpha channel, remove it for consistency
-        if image.shape[-1] == 4:
-            image = image[..., :3]
-        return image
+        return read_image(self.image_info[image_id]['path'])
 
     def load_mask(self, image_id):
         """Load instance masks for the given image.
@@ -385,6 +379,22 @@ class Dataset(object):
         return mask, class_ids
 
 
+def rgb_image(image):
+    """[H, W, 3] array of a gray, RGB or RGBA image."""
+    # If grayscale. Convert to RGB for consistency.
+    if image.ndim != 3:
+        image = skimage.color.gray2rgb(image)
+    # If has an alpha channel, remove it for consistency
+    return image[:, :, :3]
+
+
+def read_image(path):
+    """Reads an image file (a path or a file object) and returns it as a
+    [H, W, 3] Numpy array. The nuclei_* modules read images with it too.
+    """
+    return rgb_image(skimage.io.imread(path))
+
+
 def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square"):
     """Resizes an image keeping the aspect ratio unchanged.
 
@@ -829,6 +839,7 @@ def batch_slice(inputs, graph_fn, batch_size, names=None):
     if names is None:
         names = [None] * len(outputs)
 
+    import tensorflow as tf
     result = [tf.stack(o, axis=0, name=n)
               for o, n in zip(outputs, names)]
     if len(result) == 1:
@@ -0,0 +1,805 @@
+__authors__="Jie Yang and Xinyang Feng"
+
+###########################################
+# Micro-benchmarks for model components
+###########################################
+
+import os
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import skimage.io
+
+import tensorflow as tf
+import keras.backend as K
+import keras.layers as KL
+import keras.models as KM
+
+from nuclei_config import Config
+import nuclei_utils as utils
+import nuclei_model as modellib
+from nuclei_tiling import TiledDetector
+from nuclei_pipeline import InferencePipeline
+from nuclei_sweep import RawCache, cache_images, sweep, parameter_grid, SWEEP_PARAMETERS
+
+###########################################
+# Helpers
+###########################################
+
+def time_run(sess, fetches, feed_dict, iterations, warmup=3):
+    # Returns the mean wall time of sess.run in milliseconds and the last output
+    for _ in range(warmup):
+        out = sess.run(fetches, feed_dict)
+    start = time.time()
+    for _ in range(iterations):
+        out = sess.run(fetches, feed_dict)
+    return (time.time() - start) * 1000. / iterations, out
+
+def random_boxes(batch, num_boxes, pad=0):
+    # Random normalized boxes of all sizes, zero padded at the end like
+    # the proposals coming out of ProposalLayer/DetectionTargetLayer
+    yx = np.random.uniform(0, 0.9, (batch, num_boxes, 2))
+    hw = np.exp(np.random.uniform(np.log(0.01), np.log(0.6), (batch, num_boxes, 2)))
+    boxes = np.concatenate([yx, np.minimum(yx + hw, 1.)], axis=2).astype(np.float32)
+    if pad:
+        boxes[:, -pad:] = 0
+    return boxes
+
+###########################################
+# PyramidROIAlign
+###########################################
+
+def pyramid_roi_align_sorted(boxes, feature_maps, pool_shape, image_shape):
+    # Reference implementation with per-level gather and a top_k sort to
+    # restore the box order. Batch size must be 1.
+    y1, x1, y2, x2 = tf.split(boxes, 4, axis=2)
+    h = y2 - y1
+    w = x2 - x1
+    image_area = tf.cast(image_shape[0] * image_shape[1], tf.float32)
+    roi_level = modellib.log2_graph(tf.sqrt(h * w) / (224.0 / tf.sqrt(image_area)))
+    roi_level = tf.minimum(5, tf.maximum(
+        2, 4 + tf.cast(tf.round(roi_level), tf.int32)))
+    roi_level = tf.squeeze(roi_level, 2)
+
+    pooled = []
+    box_to_level = []
+    for i, level in enumerate(range(2, 6)):
+        ix = tf.where(tf.equal(roi_level, level))
+        level_boxes = tf.gather_nd(boxes, ix)
+        box_indices = tf.cast(ix[:, 0], tf.int32)
+        box_to_level.append(ix)
+        pooled.append(tf.image.crop_and_resize(
+            feature_maps[i], level_boxes, box_indices, pool_shape,
+            method="bilinear"))
+    pooled = tf.concat(pooled, axis=0)
+
+    box_to_level = tf.concat(box_to_level, axis=0)
+    box_range = tf.expand_dims(tf.range(tf.shape(box_to_level)[0]), 1)
+    box_to_level = tf.concat([tf.cast(box_to_level, tf.int32), box_range],
+                             axis=1)
+    sorting_tensor = box_to_level[:, 0] * 100000 + box_to_level[:, 1]
+    ix = tf.nn.top_k(sorting_tensor, k=tf.shape(
+        box_to_level)[0]).indices[::-1]
+    ix = tf.gather(box_to_level[:, 2], ix)
+    pooled = tf.gather(pooled, ix)
+    return tf.expand_dims(pooled, 0)
+
+def bench_roi_align(params):
+    # Compares the stitched PyramidROIAlign against the sort-based reference
+    # on random boxes, for the classifier (7x7) and mask (14x14) pool sizes.
+    image_dim = params['image_dim']
+    channels = params['channels']
+    num_boxes = params['num_boxes']
+    iterations = params['iterations']
+    image_shape = (image_dim, image_dim, 3)
+    strides = [4, 8, 16, 32]
+
+    for pool_size in [7, 14]:
+        for batch in params['batch_sizes']:
+            tf.reset_default_graph()
+            np.random.seed(1234)
+            boxes = tf.placeholder(tf.float32, [batch, num_boxes, 4])
+            feature_maps = [tf.placeholder(tf.float32, [batch, image_dim // s, image_dim // s, channels])
+                            for s in strides]
+            feed = {boxes: random_boxes(batch, num_boxes, pad=num_boxes // 10)}
+            for fm, s in zip(feature_maps, strides):
+                feed[fm] = np.random.randn(batch, image_dim // s, image_dim // s, channels).astype(np.float32)
+
+            pooled = modellib.PyramidROIAlign([pool_size, pool_size], image_shape)([boxes] + feature_maps)
+            fetches = {'stitched': pooled}
+            if batch == 1:
+                fetches['sorted'] = pyramid_roi_align_sorted(boxes, feature_maps, (pool_size, pool_size), image_shape)
+
+            with tf.Session() as sess:
+                t_new, out = time_run(sess, fetches['stitched'], feed, iterations)
+                line = 'pool {:2d} batch {:d} rois {:4d}: stitched {:8.2f} ms'.format(
+                    pool_size, batch, num_boxes, t_new)
+                if 'sorted' in fetches:
+                    t_old, ref = time_run(sess, fetches['sorted'], feed, iterations)
+                    line += ', sorted {:8.2f} ms, max abs diff {:.2e}'.format(
+                        t_old, np.abs(out - ref).max())
+                print(line)
+
+###########################################
+# DetectionLayer
+###########################################
+
+class BenchmarkConfig(Config):
+    NAME = "nuclei_benchmark"
+    NUM_CLASSES = 1 + 1
+    DETECTION_MAX_INSTANCES = 400
+
+def random_detection_inputs(config, batch, num_rois):
+    # Random classifier head outputs with a realistic share of confident,
+    # overlapping nuclei boxes and a padded image window
+    rois = random_boxes(batch, num_rois)
+    logits = np.random.randn(batch, num_rois, config.NUM_CLASSES) * 3
+    probs = np.exp(logits) / np.exp(logits).sum(axis=2, keepdims=True)
+    deltas = np.random.randn(batch, num_rois, config.NUM_CLASSES, 4) * 0.5
+    h, w = config.IMAGE_SHAPE[:2]
+    metas = np.stack([modellib.compose_image_meta(
+        b, config.IMAGE_SHAPE, (0, 0, h - 16 * b, w), np.ones(config.NUM_CLASSES))
+        for b in range(batch)])
+    return rois.astype(np.float32), probs.astype(np.float32), \
+        deltas.astype(np.float32), metas.astype(np.float32)
+
+def bench_detection(params):
+    # Checks DetectionLayer against the numpy refine_detections() and times
+    # it against the previous tf.py_func wrapper of the numpy code.
+    num_rois = params['num_boxes']
+    iterations = params['iterations']
+
+    for batch in params['batch_sizes']:
+        config = BenchmarkConfig(params['image_dim'], params['image_dim'] // 2, 1)
+        config.IMAGES_PER_GPU = batch
+        config.BATCH_SIZE = batch
+
+        tf.reset_default_graph()
+        np.random.seed(1234)
+        inputs = random_detection_inputs(config, batch, num_rois)
+        rois = tf.placeholder(tf.float32, [batch, num_rois, 4])
+        probs = tf.placeholder(tf.float32, [batch, num_rois, config.NUM_CLASSES])
+        deltas = tf.placeholder(tf.float32, [batch, num_rois, config.NUM_CLASSES, 4])
+        metas = tf.placeholder(tf.float32, [batch, None])
+        feed = dict(zip([rois, probs, deltas, metas], inputs))
+
+        detections = modellib.DetectionLayer(config)([rois, probs, deltas, metas])
+
+        def py_refine(rois, probs, deltas, metas):
+            _, _, window, _ = modellib.parse_image_meta(metas)
+            out = np.zeros([batch, config.DETECTION_MAX_INSTANCES, 6], np.float32)
+            for b in range(batch):
+                d = modellib.refine_detections(rois[b], probs[b], deltas[b], window[b], config)
+                out[b, :d.shape[0]] = d
+            return out
+        detections_py = tf.py_func(py_refine, [rois, probs, deltas, metas], tf.float32)
+
+        with tf.Session() as sess:
+            t_graph, out = time_run(sess, detections, feed, iterations)
+            t_py, ref = time_run(sess, detections_py, feed, iterations)
+
+        # Ties in score may come out in a different order, so compare the
+        # detections as sets of rows
+        mismatch = 0
+        for b in range(batch):
+            a = out[b][np.lexsort(out[b].T[::-1])]
+            r = ref[b][np.lexsort(ref[b].T[::-1])]
+            mismatch += int(np.sum(np.any(np.abs(a - r) > 1e-4 + 1e-4 * np.abs(r), axis=1)))
+        print('batch {:d} rois {:4d}: graph {:8.2f} ms, py_func {:8.2f} ms, '
+              'detections {:d}/{:d}, mismatched rows {:d}'.format(
+                  batch, num_rois, t_graph, t_py,
+                  int(np.sum(out[..., 4] > 0)), int(np.sum(ref[..., 4] > 0)), mismatch))
+
+###########################################
+# Whole model
+###########################################
+
+class InferenceBenchmarkConfig(BenchmarkConfig):
+    IMAGES_PER_GPU = 1
+    RPN_ANCHOR_SCALES = (8, 16, 32, 64, 128)
+    SAVE_PROB_MASK = False
+
+def load_images(params, count):
+    # Images to run the models on: the given file, else random noise
+    if params['image']:
+        image = utils.read_image(params['image'])
+    else:
+        np.random.seed(1234)
+        image = np.random.randint(0, 255, (params['image_dim'], params['image_dim'], 3)).astype(np.uint8)
+    return [image] * count
+
+def time_keras(keras_model, inputs, iterations, warmup=2):
+    # Mean keras_model.predict time in milliseconds and the last outputs
+    for _ in range(warmup):
+        out = keras_model.predict(inputs, verbose=0)
+    start = time.time()
+    for _ in range(iterations):
+        out = keras_model.predict(inputs, verbose=0)
+    return (time.time() - start) * 1000. / iterations, out
+
+def time_predict(model, images, iterations, warmup=2):
+    # Same as time_keras for a MaskRCNN, on the molded images
+    molded_images, image_metas, _ = model.mold_inputs(images)
+    return time_keras(model.keras_model, [molded_images, image_metas], iterations, warmup)
+
+def bench_fold_bn(params):
+    # Compares an inference model with BatchNorm folded into the backbone
+    # convs against the regular one, loaded from the same weights.
+    assert params['weights'], "Provide --weights"
+    images = load_images(params, 1)
+    outputs = {}
+    for fold in [False, True]:
+        config = InferenceBenchmarkConfig(params['image_dim'], params['image_dim'] // 2, 1)
+        config.FOLD_BATCH_NORM = fold
+        model = modellib.MaskRCNN(mode="inference", model_dir=params['dir_log'], config=config)
+        model.load_weights(params['weights'], by_name=True)
+        t, out = time_predict(model, images, params['iterations'])
+        outputs[fold] = out
+        print('fold_bn {}: {:d} layers, predict {:8.2f} ms'.format(
+            fold, len(model.keras_model.layers), t))
+    detections, folded = outputs[False][0], outputs[True][0]
+    masks, folded_masks = outputs[False][3], outputs[True][3]
+    print('detections max abs diff {:.2e} (boxes in pixels, scores), '
+          'masks max abs diff {:.2e}'.format(
+              np.abs(detections - folded).max(), np.abs(masks - folded_masks).max()))
+
+def bench_uint8(params):
+    # Compares a model fed uint8 images (normalized in the graph) against
+    # the float32 one, loaded from the same weights. Run it on a color and
+    # on a gray image to see both the 3 and the 1 channel feeds.
+    assert params['weights'], "Provide --weights"
+    images = load_images(params, 1)
+    outputs = {}
+    for uint8 in [False, True]:
+        config = InferenceBenchmarkConfig(params['image_dim'], params['image_dim'] // 2, 1)
+        config.IMAGE_UINT8 = uint8
+        model = modellib.MaskRCNN(mode="inference", model_dir=params['dir_log'], config=config)
+        model.load_weights(params['weights'], by_name=True)
+        molded_images, _, _ = model.mold_inputs(images)
+        t, out = time_predict(model, images, params['iterations'])
+        outputs[uint8] = out
+        print('uint8 {}: image feed {} {} ({:.2f} MB), predict {:8.2f} ms'.format(
+            uint8, molded_images.dtype, molded_images.shape, molded_images.nbytes / 2.**20, t))
+    print('detections max abs diff {:.2e}, masks max abs diff {:.2e}'.format(
+        np.abs(outputs[False][0] - outputs[True][0]).max(),
+        np.abs(outputs[False][3] - outputs[True][3]).max()))
+
+def bench_output_level(params):
+    # Latency breakdown of detect() for each OUTPUT_LEVEL: molding, the
+    # model itself and the unmolding of the results
+    images = load_images(params, 1)
+    iterations = params['iterations']
+    for level in ['masks', 'boxes', 'count']:
+        config = InferenceBenchmarkConfig(params['image_dim'], params['image_dim'] // 2, 1)
+        config.OUTPUT_LEVEL = level
+        model = modellib.MaskRCNN(mode="inference", model_dir=params['dir_log'], config=config)
+        if params['weights']:
+            model.load_weights(params['weights'], by_name=True)
+
+        start = time.time()
+        for _ in range(iterations):
+            model.mold_inputs(images)
+        t_mold = (time.time() - start) * 1000. / iterations
+        t_predict, _ = time_predict(model, images, iterations)
+        model.detect(images)
+        start = time.time()
+        for _ in range(iterations):
+            results = model.detect(images)
+        t_detect = (time.time() - start) * 1000. / iterations
+
+        found = results[0]['count'] if level == 'count' else len(results[0]['scores'])
+        print('{:5s}: {:d} outputs, mold {:8.2f} ms, predict {:8.2f} ms, unmold {:8.2f} ms, '
+              'detect {:8.2f} ms, {:d} detections'.format(
+                  level, len(model.keras_model.outputs), t_mold, t_predict,
+                  t_detect - t_mold - t_predict, t_detect, found))
+
+def bench_jit(params):
+    # Per image predict latency with and without the XLA_JIT session, for
+    # each image size and batch size. Run with --cpu for the CPU numbers.
+    # TF_XLA_FLAGS is set by __main__ before any session exists (see
+    # inference_session()); the default session leaves global_jit_level
+    # off, so the flag alone compiles nothing.
+    images = load_images(params, max(params['batch_sizes']))
+    for image_dim in params['image_dims']:
+        for batch in params['batch_sizes']:
+            times = {}
+            outputs = {}
+            for jit in [False, True]:
+                K.clear_session()
+                config = InferenceBenchmarkConfig(image_dim, image_dim // 2, 1)
+                config.IMAGES_PER_GPU = batch
+                config.BATCH_SIZE = batch
+                config.XLA_JIT = jit
+                model = modellib.MaskRCNN(mode="inference", model_dir=params['dir_log'], config=config)
+                if params['weights']:
+                    model.load_weights(params['weights'], by_name=True)
+                # The first runs include the XLA compilation
+                start = time.time()
+                model.predict(list(model.mold_inputs(images[:batch])[:2]))
+                first = (time.time() - start) * 1000.
+                t, outputs[jit] = time_predict(model, images[:batch], params['iterations'])
+                times[jit] = (first, t / batch, model.jit)
+            line = 'image {:4d} batch {:d}: default {:8.2f} ms/image, jit {:8.2f} ms/image ' \
+                   '(first run {:8.2f} ms vs {:8.2f} ms{})'.format(
+                       image_dim, batch, times[False][1], times[True][1],
+                       times[True][0], times[False][0], '' if times[True][2] else ', fell back')
+            if params['weights']:
+                line += ', detections max abs diff {:.2e}'.format(
+                    np.abs(outputs[False][0] - outputs[True][0]).max())
+            print(line)
+
+###########################################
+# Backbones
+###########################################
+
+def load_val_split(params):
+    # Validation images and their instance masks, split as in nuclei_train.py
+    train_dir = os.path.join(params['dir_root'], 'dataset', 'train')
+    df = pd.read_csv(os.path.join(params['dir_root'], 'image_group_train.csv'))
+    val_ids = list(df['id'][df['istrain'] == 0])
+    if params['val_images']:
+        val_ids = val_ids[:params['val_images']]
+    samples = []
+    for val_id in val_ids:
+        image = utils.read_image(os.path.join(train_dir, val_id, 'images', val_id + '.png'))
+        mask_dir = os.path.join(train_dir, val_id, 'masks')
+        masks = [skimage.io.imread(os.path.join(mask_dir, f)) for f in sorted(os.listdir(mask_dir))]
+        samples.append((image, np.stack(masks, axis=-1)))
+    return samples
+
+def evaluate_val(model, samples):
+    # Mean over the images of the mask AP averaged over IoU 0.5:0.95
+    aps = []
+    for image, gt_mask in samples:
+        r = model.detect([image])[0]
+        aps.append(utils.sweep_iou_mask_ap(gt_mask.copy(), r['masks'].copy(), r['scores']))
+    return np.mean(aps)
+
+def bench_backbone(params):
+    # Times each backbone alone and inside the whole inference model on the
+    # same image. With --backbone_weights (one h5 file per backbone) it also
+    # reports the mask mAP on the validation split.
+    names = params['backbones']
+    weights = params['backbone_weights'] or [''] * len(names)
+    assert len(weights) == len(names), "Give one weights file per backbone"
+    dim = params['image_dim']
+    images = load_images(params, 1)
+    samples = load_val_split(params) if any(weights) else None
+
+    for name, weights_path in zip(names, weights):
+        K.clear_session()
+        input_image = KL.Input(shape=[dim, dim, 3])
+        feature_maps = modellib.BACKBONES[name]["graph"](input_image, name, stage5=True)
+        backbone = KM.Model(input_image, feature_maps[1:])
+        x = np.random.randn(1, dim, dim, 3).astype(np.float32)
+        t_backbone, _ = time_keras(backbone, x, params['iterations'])
+        backbone_params = backbone.count_params()
+
+        K.clear_session()
+        config = InferenceBenchmarkConfig(dim, dim // 2, 1)
+        config.BACKBONE_NAME = name
+        model = modellib.MaskRCNN(mode="inference", model_dir=params['dir_log'], config=config)
+        if weights_path:
+            model.load_weights(weights_path, by_name=True)
+        t_model, _ = time_predict(model, images, params['iterations'])
+
+        line = '{:10s}: backbone {:6.2f}M params {:8.2f} ms, model {:8.2f} ms'.format(
+            name, backbone_params / 1e6, t_backbone, t_model)
+        if weights_path:
+            line += ', val mAP {:.4f} on {:d} images'.format(evaluate_val(model, samples), len(samples))
+        print(line)
+
+###########################################
+# Test-time augmentation
+###########################################
+
+def bench_tta(params):
+    # Per image latency and validation mask mAP of detect() against
+    # detect_tta() with the --tta_variants, from the same weights
+    assert params['weights'], "Provide --weights"
+    samples = load_val_split(params)
+    variants = params['tta_variants']
+    for tta in [False, True]:
+        K.clear_session()
+        config = InferenceBenchmarkConfig(params['image_dim'], params['image_dim'] // 2, 1)
+        if tta:
+            config.TTA_VARIANTS = variants
+            config.IMAGES_PER_GPU = len(variants)
+            config.BATCH_SIZE = len(variants)
+        model = modellib.MaskRCNN(mode="inference", model_dir=params['dir_log'], config=config)
+        model.load_weights(params['weights'], by_name=True)
+        detect = model.detect_tta if tta else model.detect
+        detect([samples[0][0]])
+        aps = []
+        start = time.time()
+        for image, gt_mask in samples:
+            r = detect([image])[0]
+            aps.append(utils.sweep_iou_mask_ap(gt_mask.copy(), r['masks'].copy(), r['scores']))
+        t = (time.time() - start) * 1000. / len(samples)
+        print('{}: {:8.2f} ms/image, val mAP {:.4f} on {:d} images'.format(
+            'tta ' + '+'.join(variants) if tta else 'no tta', t, np.mean(aps), len(samples)))
+
+###########################################
+# Pipelined inference
+###########################################
+
+def bench_pipeline(params):
+    # End-to-end images/s from image files with a detect() loop and with
+    # InferencePipeline, against the predict() rate alone, per batch size
+    assert params['image'], "Provide --image"
+    paths = [params['image']] * params['count']
+    for batch in params['batch_sizes']:
+        K.clear_session()
+        config = InferenceBenchmarkConfig(params['image_dim'], params['image_dim'] // 2, 1)
+        config.IMAGES_PER_GPU = batch
+        config.BATCH_SIZE = batch
+        model = modellib.MaskRCNN(mode="inference", model_dir=params['dir_log'], config=config)
+        if params['weights']:
+            model.load_weights(params['weights'], by_name=True)
+        t_predict, _ = time_predict(model, [utils.read_image(params['image'])] * batch, params['iterations'])
+
+        start = time.time()
+        for k in range(0, len(paths) - batch + 1, batch):
+            model.detect([utils.read_image(path) for path in paths[k:k + batch]])
+        t_serial = time.time() - start
+        count = len(paths) // batch * batch
+
+        pipeline = InferencePipeline(model, readers=params['readers'], molders=params['molders'],
+                                     postprocessors=params['postprocessors'])
+        list(pipeline.run(paths[:batch]))
+        start = time.time()
+        for _ in pipeline.run(paths):
+            pass
+        t_pipeline = time.time() - start
+        pipeline.close()
+        print('batch {:d}: predict only {:7.2f} images/s, detect loop {:7.2f} images/s, '
+              'pipeline {:7.2f} images/s ({:.0f}% of the time in predict)'.format(
+                  batch, batch * 1000. / t_predict, count / t_serial, len(paths) / t_pipeline,
+                  100. * pipeline.predict_time / t_pipeline))
+
+###########################################
+# Tiled inference
+###########################################
+
+def bench_tiled(params):
+    # Tiles/s of TiledDetector on a slide made of --slide_repeat x
+    # --slide_repeat copies of the image, for each tile batch size, and the
+    # instances found against a single detect() of the downscaled slide
+    image = load_images(params, 1)[0]
+    slide = np.tile(image, (params['slide_repeat'], params['slide_repeat'], 1))
+    tile = params['image_dim']
+    for batch in params['batch_sizes']:
+        K.clear_session()
+        config = InferenceBenchmarkConfig(tile, tile // 2, 1)
+        config.IMAGES_PER_GPU = batch
+        config.BATCH_SIZE = batch
+        model = modellib.MaskRCNN(mode="inference", model_dir=params['dir_log'], config=config)
+        if params['weights']:
+            model.load_weights(params['weights'], by_name=True)
+        detector = TiledDetector(model, overlap=params['overlap'])
+        # Warm up on one batch
+        model.detect([image[:tile, :tile]] * batch)
+        r = detector.detect(slide)
+        stats = detector.stats
+        print('slide {}x{} tile {:d} batch {:d}: {:d} tiles ({:d} skipped) in {:.2f} s, '
+              '{:.2f} tiles/s, {:d} instances'.format(
+                  slide.shape[0], slide.shape[1], tile, batch, stats['tiles'], stats['skipped'],
+                  stats['seconds'], stats['tiles_per_sec'], len(r['scores'])))
+    whole = model.detect([slide] * batch)[0]
+    print('whole slide downscaled to {:d}: {:d} instances'.format(tile, len(whole['scores'])))
+
+###########################################
+# Compact instance masks
+###########################################
+
+def result_nbytes(r):
+    # Bytes held by the masks of a detect() result
+    size = r['masks'].nbytes
+    if 'masks_prob' in r:
+        size += r['masks_prob'].nbytes
+    return size
+
+def bench_compact(params):
+    # Result memory and unmolding time of the full size masks against
+    # COMPACT_MASKS with each probability dtype, from the same model outputs,
+    # and the time to run-length encode all the instances of each
+    images = load_images(params, 1)
+    iterations = params['iterations']
+    config = InferenceBenchmarkConfig(params['image_dim'], params['image_dim'] // 2, 1)
+    config.SAVE_PROB_MASK = True
+    model = modellib.MaskRCNN(mode="inference", model_dir=params['dir_log'], config=config)
+    if params['weights']:
+        model.load_weights(params['weights'], by_name=True)
+    molded_images, image_metas, windows = model.mold_inputs(images)
+    outputs = model.keras_model.predict([molded_images, image_metas], verbose=0)
+    detections, mrcnn_mask = outputs[0][0], outputs[3][0]
+    for compact, dtype in [(False, None), (True, 'uint8'), (True, 'float16')]:
+        config.COMPACT_MASKS = compact
+        config.PROB_MASK_DTYPE = dtype
+        start = time.time()
+        for _ in range(iterations):
+            r = model.unmold_result(detections, mrcnn_mask, images[0].shape, windows[0])
+        t_unmold = (time.time() - start) * 1000. / iterations
+        masks = r['masks']
+        start = time.time()
+        if compact:
+            rles = [masks.rle(i) for i in range(len(masks))]
+        else:
+            rles = [utils.rle_encoding(masks[:, :, i]) for i in range(masks.shape[2])]
+        t_rle = (time.time() - start) * 1000.
+        print('{:16s}: {:d} instances, {:10.1f} KB, unmold {:8.2f} ms, rle {:8.2f} ms'.format(
+            'compact ' + dtype if compact else 'full size', len(rles),
+            result_nbytes(r) / 1024., t_unmold, t_rle))
+
+###########################################
+# Overlap resolution
+###########################################
+
+def deoverlap_masks_loop(masks):
+    # The former nuclei_utils.deoverlap_masks(), one pixel at a time, as the
+    # reference for the vectorized one
+    from scipy.ndimage.measurements import center_of_mass
+    masks_collapse = np.sum(masks, axis=2)
+    com = np.zeros((masks.shape[2], 2))
+    for k in range(masks.shape[2]):
+        com[k, :] = center_of_mass(masks[:, :, k])
+    overlap_indices = np.argwhere(masks_collapse > 1)
+    for k in range(overlap_indices.shape[0]):
+        mask_indices = np.argwhere(np.squeeze(masks[overlap_indices[k, 0], overlap_indices[k, 1], :]) == 1)
+        dist_tmp = []
+        for kk in range(len(mask_indices)):
+            dif_vec = [overlap_indices[k, 0], overlap_indices[k, 1]] - com[mask_indices[kk], :]
+            dist_tmp.append(np.sum(np.square(dif_vec)))
+        dist_tmp = np.array(dist_tmp)
+        masks[overlap_indices[k, 0], overlap_indices[k, 1], mask_indices[dist_tmp > dist_tmp.min()]] = 0
+    return masks
+
+def random_disk_masks(size, count, radius=(8, 24)):
+    # [size, size, count] masks of random, often overlapping disks
+    np.random.seed(1234)
+    yy, xx = np.mgrid[:size, :size]
+    masks = np.zeros((size, size, count), dtype=np.uint8)
+    for k in range(count):
+        cy, cx = np.random.randint(0, size, 2)
+        r = np.random.randint(*radius)
+        masks[:, :, k] = (yy - cy) ** 2 + (xx - cx) ** 2 < r * r
+    return masks
+
+def bench_deoverlap(params):
+    # deoverlap_masks() against the per pixel loop it replaced, and
+    # InstanceMasks.deoverlap(), on --image_dim images of --num_instances
+    # random disks, checking that all give the same masks
+    size = params['image_dim']
+    for count in params['num_instances']:
+        masks = random_disk_masks(size, count)
+        contested = np.sum(masks.sum(axis=2) > 1)
+        start = time.time()
+        expected = deoverlap_masks_loop(masks.copy())
+        t_loop = (time.time() - start) * 1000.
+        start = time.time()
+        for _ in range(params['iterations']):
+            result = utils.deoverlap_masks(masks.copy())
+        t_vec = (time.time() - start) * 1000. / params['iterations']
+        compact = utils.InstanceMasks.from_dense(utils.extract_bboxes(masks), masks)
+        start = time.time()
+        for _ in range(params['iterations']):
+            compact_result = compact.copy().deoverlap()
+        t_compact = (time.time() - start) * 1000. / params['iterations']
+        same = np.array_equal(expected, result) and np.array_equal(expected, compact_result.to_dense())
+        print('{:d} instances, {:d} contested pixels: loop {:9.2f} ms, vectorized {:8.2f} ms, '
+              'compact {:8.2f} ms, {}'.format(count, contested, t_loop, t_vec, t_compact,
+                                             'same masks' if same else 'MASKS DIFFER'))
+
+###########################################
+# Run-length encoding
+###########################################
+
+def rle_encoding_loop(x):
+    # The former nuclei_utils.rle_encoding(), one pixel at a time
+    dots = np.where(x.T.flatten() == 1)[0]
+    run_lengths = []
+    prev = -2
+    for b in dots:
+        if (b > prev + 1): run_lengths.extend((b + 1, 0))
+        run_lengths[-1] += 1
+        prev = b
+    return run_lengths
+
+def rle_encode_frame(mask):
+    # The former samples/nucleus rle_encode(), on the whole frame
+    m = mask.T.flatten()
+    g = np.diff(np.concatenate([[0], m, [0]]), n=1)
+    rle = np.where(g != 0)[0].reshape([-1, 2]) + 1
+    rle[:, 1] = rle[:, 1] - rle[:, 0]
+    return " ".join(map(str, rle.flatten()))
+
+def rle_decoding_loop(rle, shape):
+    # The former nuclei_utils.rle_decoding(), one run at a time
+    starts = np.array(rle[::2]) - 1
+    ends = starts + np.array(rle[1::2])
+    img = np.zeros(shape[0] * shape[1], dtype=np.uint8)
+    for lo, hi in zip(starts, ends):
+        img[lo:hi] = 1
+    return img.reshape(shape, order='F')
+
+def bench_rle(params):
+    # Instances/s of the former encoders and of nuclei_rle from full size
+    # masks, a label map and box-local masks, on --image_dim images of
+    # --num_instances random disks, and of the Kaggle decoders
+    import nuclei_rle
+    try:
+        from pycocotools import mask as cocom
+    except ImportError:
+        cocom = None
+    size = params['image_dim']
+    iterations = params['iterations']
+
+    def rate(fn, count):
+        start = time.time()
+        for _ in range(iterations):
+            out = fn()
+        return count * iterations / (time.time() - start), out
+
+    for count in params['num_instances']:
+        masks, labels = utils.deoverlap_masks(random_disk_masks(size, count), return_labels=True)
+        compact = utils.InstanceMasks.from_dense(utils.extract_bboxes(masks), masks)
+        rates = []
+        r, kaggle = rate(lambda: [rle_encoding_loop(masks[:, :, i]) for i in range(count)], count)
+        rates.append(('rle_encoding loop', r))
+        r, _ = rate(lambda: [rle_encode_frame(np.where(labels == i + 1, 1, 0)) for i in range(count)], count)
+        rates.append(('mask_to_rle full frame per instance', r))
+        if cocom is not None:
+            r, coco = rate(lambda: [cocom.encode(np.array(masks[:, :, i] > 0.5, dtype=bool, order='F'))
+                                    for i in range(count)], count)
+            rates.append(('cocom.encode full frame', r))
+        r, (new_coco, new_kaggle) = rate(lambda: nuclei_rle.encode(masks), count)
+        rates.append(('nuclei_rle full size masks', r))
+        r, _ = rate(lambda: nuclei_rle.encode(labels), count)
+        rates.append(('nuclei_rle label map', r))
+        r, _ = rate(lambda: nuclei_rle.encode(compact), count)
+        rates.append(('nuclei_rle InstanceMasks', r))
+        same = all(' '.join(map(str, k)) == n for k, n in zip(kaggle, new_kaggle))
+        if cocom is not None:
+            same = same and all(c['counts'].decode('utf-8') == n['counts'] for c, n in zip(coco, new_coco))
+        r, _ = rate(lambda: [rle_decoding_loop(k, (size, size)) for k in kaggle], count)
+        rates.append(('rle_decoding loop', r))
+        r, _ = rate(lambda: [nuclei_rle.decode_kaggle(k, (size, size)) for k in new_kaggle], count)
+        rates.append(('nuclei_rle.decode_kaggle', r))
+        r, _ = rate(lambda: nuclei_rle.decode_kaggle_labels(new_kaggle, (size, size)), count)
+        rates.append(('nuclei_rle.decode_kaggle_labels', r))
+        print('{:d} instances on {:d}x{:d}, {}:'.format(
+            count, size, size, 'same encodings' if same else 'ENCODINGS DIFFER'))
+        for name, r in rates:
+            print('  {:40s} {:10.0f} instances/s'.format(name, r))
+
+###########################################
+# Parameter sweeps
+###########################################
+
+def bench_sweep(params):
+    # Time of a grid of DETECTION_* settings on the validation split,
+    # replayed from the raw detection cache, against one detect() pass per
+    # setting (estimated from one pass), with the mAP of each setting
+    assert params['weights'], "Provide --weights"
+    samples = load_val_split(params)
+    gt_masks = [gt_mask for _, gt_mask in samples]
+    grid = {
+        "DETECTION_MIN_CONFIDENCE": params['min_confidences'],
+        "DETECTION_NMS_THRESHOLD": params['nms_thresholds'],
+        "DETECTION_MAX_INSTANCES": params['max_instances'],
+        "DETECTION_MASK_THRESHOLD": params['mask_thresholds'],
+    }
+    settings = len(parameter_grid(grid))
+
+    K.clear_session()
+    config = InferenceBenchmarkConfig(params['image_dim'], params['image_dim'] // 2, 1)
+    config.COMPACT_MASKS = True
+    model = modellib.MaskRCNN(mode="inference", model_dir=params['dir_log'], config=config)
+    model.load_weights(params['weights'], by_name=True)
+    model.detect([samples[0][0]])
+    start = time.time()
+    detect_ap = evaluate_val(model, samples)
+    t_detect = time.time() - start
+
+    K.clear_session()
+    config.OUTPUT_LEVEL = "raw"
+    # Room for the largest DETECTION_MAX_INSTANCES replayed, the default
+    # one of BenchmarkConfig included
+    config.RAW_MAX_ROIS = max([config.RAW_MAX_ROIS, config.DETECTION_MAX_INSTANCES] + params['max_instances'])
+    model = modellib.MaskRCNN(mode="inference", model_dir=params['dir_log'], config=config)
+    model.load_weights(params['weights'], by_name=True)
+    cache = RawCache(params['cache_dir'], params['weights'], config)
+    start = time.time()
+    keys = cache_images(model, [image for image, _ in samples], cache)
+    t_cache = time.time() - start
+    cache_size = sum(os.path.getsize(cache.path(key)) for key in set(keys))
+
+    # The default settings replayed, to compare with detect()
+    default = sweep(cache, keys, {name: [getattr(config, name)] for name in SWEEP_PARAMETERS},
+                    gt_masks, params['workers'])[0]
+    start = time.time()
+    results = sweep(cache, keys, grid, gt_masks, params['workers'])
+    t_sweep = time.time() - start
+
+    print('{:d} images: detect() {:.4f} mAP in {:.1f} s, replayed from the cache {:.4f} mAP'.format(
+        len(samples), detect_ap, t_detect, default['mAP']))
+    print('cache filled in {:.1f} s, {:.1f} KB per image'.format(t_cache, cache_size / 1024. / len(set(keys))))
+    print('{:d} settings: {:.1f} s from the cache, about {:.1f} s with detect()'.format(
+        settings, t_sweep, settings * t_detect))
+    for r in sorted(results, key=lambda r: -r['mAP']):
+        print('  ' + ', '.join('{} {}'.format(name, r[name]) for name in sorted(grid)) +
+              ': {:.2f} detections, mAP {:.4f}'.format(r['detections'], r['mAP']))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('command', choices=['roi_align', 'detection', 'fold_bn', 'uint8', 'output_level', 'jit', 'backbone', 'tiled', 'tta', 'pipeline', 'compact', 'deoverlap', 'rle', 'sweep'], help='component to benchmark')
+    parser.add_argument('--image_dim', default=512, type=int, help='side of the (square) input image')
+    parser.add_argument('--image_dims', default=[256, 512, 1024], type=int, nargs='+', help='image sizes to run, for jit')
+    parser.add_argument('--channels', default=256, type=int, help='number of FPN channels')
+    parser.add_argument('--num_instances', default=[50, 100, 200], type=int, nargs='+', help='instances per image, for deoverlap and rle')
+    parser.add_argument('--num_boxes', default=512, type=int, help='number of rois (or proposals) per image')
+    parser.add_argument('--batch_sizes', default=[1, 2, 4], type=int, nargs='+', help='batch sizes to run')
+    parser.add_argument('--iterations', default=20, type=int, help='timed runs per setting')
+    parser.add_argument('--weights', default='', help='h5 weights for the whole model benchmarks')
+    parser.add_argument('--image', default='', help='image for the whole model benchmarks, random if empty')
+    parser.add_argument('--backbones', default=sorted(modellib.BACKBONES), nargs='+', help='backbones to compare')
+    parser.add_argument('--backbone_weights', default=[], nargs='*', help='trained h5 weights, one per backbone, to score on the validation split')
+    parser.add_argument('--val_images', default=0, type=int, help='number of validation images to score, all if 0')
+    parser.add_argument('--slide_repeat', default=4, type=int, help='the tiled slide is this many copies of the image per side')
+    parser.add_argument('--overlap', default=64, type=int, help='pixels shared by neighbouring tiles')
+    parser.add_argument('--tta_variants', default=['identity', 'flip_lr', 'flip_ud', 'rot90'], nargs='+', choices=utils.TTA_VARIANTS, help='test-time augmentation variants')
+    parser.add_argument('--count', default=64, type=int, help='number of images to run through the pipeline')
+    parser.add_argument('--readers', default=4, type=int, help='pipeline image reading threads')
+    parser.add_argument('--molders', default=2, type=int, help='pipeline molding threads')
+    parser.add_argument('--postprocessors', default=None, type=int, help='pipeline postprocessing processes, half the cores if not set')
+    parser.add_argument('--cache_dir', default='raw_cache', help='raw detection cache directory, for sweep')
+    parser.add_argument('--min_confidences', default=[0.5, 0.6, 0.7, 0.8], type=float, nargs='+', help='DETECTION_MIN_CONFIDENCE values to sweep')
+    parser.add_argument('--nms_thresholds', default=[0.2, 0.3, 0.4], type=float, nargs='+', help='DETECTION_NMS_THRESHOLD values to sweep')
+    parser.add_argument('--max_instances', default=[100, 200], type=int, nargs='+', help='DETECTION_MAX_INSTANCES values to sweep')
+    parser.add_argument('--mask_thresholds', default=[0.4, 0.5, 0.6], type=float, nargs='+', help='DETECTION_MASK_THRESHOLD values to sweep')
+    parser.add_argument('--workers', default=None, type=int, help='sweep processes, one per core if not set')
+    parser.add_argument('--cpu', action='store_true', help='hide the GPUs')
+    parser.add_argument('--dir_root', default='', help='root directory of the project')
+    parser.add_argument('--dir_log', default='logs', help='log directory')
+
+    args = parser.parse_args()
+    params = vars(args) # convert to ordinary dict
+    if args.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    if args.command == 'jit':
+        # CPU auto-clustering is only read when the first session is
+        # created, and the default mode runs first
+        xla_flags = os.environ.get("TF_XLA_FLAGS", "")
+        if "--tf_xla_cpu_global_jit" not in xla_flags:
+            os.environ["TF_XLA_FLAGS"] = (xla_flags + " --tf_xla_cpu_global_jit").strip()
+    if args.command == 'roi_align':
+        bench_roi_align(params)
+    elif args.command == 'detection':
+        bench_detection(params)
+    elif args.command == 'fold_bn':
+        bench_fold_bn(params)
+    elif args.command == 'uint8':
+        bench_uint8(params)
+    elif args.command == 'output_level':
+        bench_output_level(params)
+    elif args.command == 'jit':
+        bench_jit(params)
+    elif args.command == 'backbone':
+        bench_backbone(params)
+    elif args.command == 'tiled':
+        bench_tiled(params)
+    elif args.command == 'tta':
+        bench_tta(params)
+    elif args.command == 'pipeline':
+        bench_pipeline(params)
+    elif args.command == 'compact':
+        bench_compact(params)
+    elif args.command == 'deoverlap':
+        bench_deoverlap(params)
+    elif args.command == 'rle':
+        bench_rle(params)
+    elif args.command == 'sweep':
+        bench_sweep(params)
@@ -88,10 +88,21 @@ class Config(object):
     IMAGE_MAX_DIM = 1024
     # If True, pad images with zeros such that they're (max_dim by max_dim)
     IMAGE_PADDING = True  # currently, the False option is not supported
+    # Inference only. If True, images are only padded to multiples of 64 rather
+    # than to a max_dim square, so a 256x320 image runs a 256x320 forward pass.
+    # Anchors are then generated per image shape and fed to the model.
+    IMAGE_PAD64 = False
+    # Number of image shapes whose anchors are kept (least recently used first out)
+    ANCHOR_CACHE_SIZE = 16
 
     # Image mean (RGB)
     MEAN_PIXEL = np.array([48.2, 40.1, 44.9])  # Nuclei
     # MEAN_PIXEL = np.array([123.7, 116.8, 103.9])  # ImageNet
+    # If True, images are fed to the model as uint8 and the cast to float and
+    # the MEAN_PIXEL subtraction are the first ops of the graph, so the feeds
+    # and the data generator queue carry 4x fewer bytes. At inference, batches
+    # of gray images are fed as one channel and broadcast to RGB in the graph.
+    IMAGE_UINT8 = False
 
     # Number of ROIs per image to feed to classifier/mask heads
     # The Mask RCNN paper uses 512 but often the RPN doesn't generate
@@ -125,6 +136,9 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # Mask probability from which a pixel belongs to a detected instance
+    DETECTION_MASK_THRESHOLD = 0.5
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimzer
@@ -132,6 +146,12 @@ class Config(object):
     LEARNING_RATE = 0.001
     LEARNING_MOMENTUM = 0.9
 
+    # Number of batches whose gradients are averaged into one optimizer step.
+    # Trains like a batch of GRADIENT_ACCUMULATION_STEPS * BATCH_SIZE images
+    # with the memory of BATCH_SIZE images. Epochs still count batches, so
+    # there are this many times fewer weight updates per epoch.
+    GRADIENT_ACCUMULATION_STEPS = 1
+
     # Weight decay regularization
     WEIGHT_DECAY = 0.0001
 
@@ -147,9 +167,56 @@ class Config(object):
     RAND_SCALE_TRAIN = True # if False, upscale to similar instance size
     SCALE_HIGH_INIT = 2.
     RM_BOUND = True
-    BACKBONE_NAME = 'resnet50'
+    BACKBONE_NAME = 'resnet50' # or resnet101, mobilenet (see nuclei_model.BACKBONES)
     OPTIMIZER = 'sgd' # otherwise adam
     SAVE_PROB_MASK = True
+    # If True, detect() returns the masks as a nuclei_utils.InstanceMasks:
+    # boxes plus box-local crops, with the SAVE_PROB_MASK probabilities kept
+    # in it as PROB_MASK_DTYPE ("uint8" or "float16") crops, instead of full
+    # size [H, W, N] arrays. Full size masks are made on request.
+    COMPACT_MASKS = False
+    PROB_MASK_DTYPE = "uint8"
+
+    # Inference only. What the model computes and detect() returns: "masks"
+    # (everything), "boxes" (no mask branch, no masks in the results) or
+    # "count" (only the number of detections per image, with images where
+    # no ROI clears DETECTION_MIN_CONFIDENCE skipping the refinement and NMS)
+    # With "raw", MaskRCNN.detect_raw() returns the candidates before NMS
+    # instead, for nuclei_sweep: the RAW_MAX_ROIS best refined boxes with a
+    # foreground score of at least RAW_MIN_CONFIDENCE, their class
+    # probabilities and masks. RAW_MAX_ROIS defaults to
+    # POST_NMS_ROIS_INFERENCE, every candidate the NMS of detect() sees; with
+    # fewer, the duplicates of dense nuclei can crowd out instances detect()
+    # would keep.
+    OUTPUT_LEVEL = "masks"
+    RAW_MIN_CONFIDENCE = 0.3
+    RAW_MAX_ROIS = None
+
+    # Inference only. If True, the backbone is built without BatchNorm layers
+    # and their scale and shift are folded into the conv weights on load.
+    FOLD_BATCH_NORM = False
+
+    # Inference only. If True, the model runs in a session with XLA JIT
+    # auto-clustering (CPU included) and grappler remapping, see
+    # nuclei_model.inference_session(). Ops XLA can't compile, like NMS, run as
+    # before. Each new input shape is compiled once, so it pays off most
+    # with fixed size inputs. Falls back to the regular session on errors.
+    XLA_JIT = False
+
+    # Inference only. Flips and rotations of each image run by
+    # MaskRCNN.detect_tta() in a single batch, see nuclei_utils.TTA_VARIANTS.
+    # IMAGES_PER_GPU must be a multiple of their number. The instances of the
+    # variants are clustered by box IoU >= TTA_IOU_THRESHOLD, and clusters
+    # found by less than TTA_MIN_VOTES of the variants are dropped.
+    TTA_VARIANTS = ["identity", "flip_lr", "flip_ud", "rot90"]
+    TTA_IOU_THRESHOLD = 0.5
+    TTA_MIN_VOTES = 0.5
+
+    # Training only. Directory of cached C2-C5 backbone features written by
+    # nuclei_model.build_feature_cache() into "train" and "val" sub-directories.
+    # If set, the training model is built without the ResNet and reads the
+    # features from the cache, so only the heads can be trained.
+    BACKBONE_FEATURE_CACHE = None
 
     def __init__(self, image_max_dim,image_min_dim,id_length):
         """Set values of computed attributes."""
@@ -158,6 +225,8 @@ class Config(object):
         self.STEPS_PER_EPOCH = id_length/self.IMAGES_PER_GPU
         self.IMAGE_MAX_DIM = image_max_dim
         self.IMAGE_MIN_DIM = image_min_dim
+        if self.RAW_MAX_ROIS is None:
+            self.RAW_MAX_ROIS = self.POST_NMS_ROIS_INFERENCE
 
         # Input image size
         self.IMAGE_SHAPE = np.array(
@@ -19,12 +19,14 @@ from collections import OrderedDict
 import numpy as np
 import scipy.misc
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 import keras
 import keras.backend as K
 import keras.layers as KL
 import keras.initializers as KI
 import keras.engine as KE
 import keras.models as KM
+from keras.legacy import interfaces
 import nuclei_utils as utils
 
 # Requires TensorFlow 1.3+ and Keras 2.0.8+.
@@ -49,6 +51,31 @@ def log(text, array=None):
     print(text)
 
 
+def inference_session(jit=False):
+    """Creates a tf.Session for inference.
+
+    jit: If True, XLA auto-clustering compiles the ops it supports (the
+        convs, BatchNorm and activations of the backbone, FPN and heads)
+        into fused kernels, on CPU as well, and grappler's remapper fuses
+        conv, bias and activation ops. Ops XLA can't compile, like NMS,
+        crop_and_resize or py_func, stay out of the clusters and run on
+        the regular executor.
+    """
+    session_config = tf.ConfigProto()
+    session_config.gpu_options.allow_growth = True
+    if jit:
+        # Auto-clustering only covers the GPU without this flag. It has to
+        # be set before the first session of the process is created.
+        xla_flags = os.environ.get("TF_XLA_FLAGS", "")
+        if "--tf_xla_cpu_global_jit" not in xla_flags:
+            os.environ["TF_XLA_FLAGS"] = (xla_flags + " --tf_xla_cpu_global_jit").strip()
+        session_config.graph_options.optimizer_options.global_jit_level =\
+            tf.OptimizerOptions.ON_1
+        session_config.graph_options.rewrite_options.remapping =\
+            rewriter_config_pb2.RewriterConfig.ON
+    return tf.Session(config=session_config)
+
+
 class BatchNorm(KL.BatchNormalization):
     """Batch Normalization class. Subclasses the Keras BN class and
     hardcodes training=False so the BN layer doesn't update
@@ -70,7 +97,7 @@ class BatchNorm(KL.BatchNormalization):
 # https://github.com/fchollet/deep-learning-models/blob/master/resnet50.py
 
 def identity_block(input_tensor, kernel_size, filters, stage, block,
-                   use_bias=True):
+                   use_bias=True, fold_bn=False):
     """The identity_block is the block that has no conv layer at shortcut
     # Arguments
         input_tensor: input tensor
@@ -78,6 +105,8 @@ def identity_block(input_tensor, kernel_size, filters, stage, block,
         filters: list of integers, the nb_filters of 3 conv layer at main path
         stage: integer, current stage label, used for generating layer names
         block: 'a','b'..., current block label, used for generating layer names
+        fold_bn: if True, skip the BatchNorm layers. Their scale and shift are
+            folded into the conv weights by MaskRCNN.load_weights()
     """
     nb_filter1, nb_filter2, nb_filter3 = filters
     conv_name_base = 'res' + str(stage) + block + '_branch'
@@ -85,17 +114,20 @@ def identity_block(input_tensor, kernel_size, filters, stage, block,
 
     x = KL.Conv2D(nb_filter1, (1, 1), name=conv_name_base + '2a',
                   use_bias=use_bias)(input_tensor)
-    x = BatchNorm(axis=3, name=bn_name_base + '2a')(x)
+    if not fold_bn:
+        x = BatchNorm(axis=3, name=bn_name_base + '2a')(x)
     x = KL.Activation('relu')(x)
 
     x = KL.Conv2D(nb_filter2, (kernel_size, kernel_size), padding='same',
                   name=conv_name_base + '2b', use_bias=use_bias)(x)
-    x = BatchNorm(axis=3, name=bn_name_base + '2b')(x)
+    if not fold_bn:
+        x = BatchNorm(axis=3, name=bn_name_base + '2b')(x)
     x = KL.Activation('relu')(x)
 
     x = KL.Conv2D(nb_filter3, (1, 1), name=conv_name_base + '2c',
                   use_bias=use_bias)(x)
-    x = BatchNorm(axis=3, name=bn_name_base + '2c')(x)
+    if not fold_bn:
+        x = BatchNorm(axis=3, name=bn_name_base + '2c')(x)
 
     x = KL.Add()([x, input_tensor])
     x = KL.Activation('relu', name='res' + str(stage) + block + '_out')(x)
@@ -103,7 +135,7 @@ def identity_block(input_tensor, kernel_size, filters, stage, block,
 
 
 def conv_block(input_tensor, kernel_size, filters, stage, block,
-               strides=(2, 2), use_bias=True):
+               strides=(2, 2), use_bias=True, fold_bn=False):
     """conv_block is the block that has a conv layer at shortcut
     # Arguments
         input_tensor: input tensor
@@ -111,6 +143,7 @@ def conv_block(input_tensor, kernel_size, filters, stage, block,
         filters: list of integers, the nb_filters of 3 conv layer at main path
         stage: integer, current stage label, used for generating layer names
         block: 'a','b'..., current block label, used for generating layer names
+        fold_bn: if True, skip the BatchNorm layers (see identity_block)
     Note that from stage 3, the first conv layer at main path is with subsample=(2,2)
     And the shortcut should have subsample=(2,2) as well
     """
@@ -120,60 +153,171 @@ def conv_block(input_tensor, kernel_size, filters, stage, block,
 
     x = KL.Conv2D(nb_filter1, (1, 1), strides=strides,
                   name=conv_name_base + '2a', use_bias=use_bias)(input_tensor)
-    x = BatchNorm(axis=3, name=bn_name_base + '2a')(x)
+    if not fold_bn:
+        x = BatchNorm(axis=3, name=bn_name_base + '2a')(x)
     x = KL.Activation('relu')(x)
 
     x = KL.Conv2D(nb_filter2, (kernel_size, kernel_size), padding='same',
                   name=conv_name_base + '2b', use_bias=use_bias)(x)
-    x = BatchNorm(axis=3, name=bn_name_base + '2b')(x)
+    if not fold_bn:
+        x = BatchNorm(axis=3, name=bn_name_base + '2b')(x)
     x = KL.Activation('relu')(x)
 
     x = KL.Conv2D(nb_filter3, (1, 1), name=conv_name_base +
                   '2c', use_bias=use_bias)(x)
-    x = BatchNorm(axis=3, name=bn_name_base + '2c')(x)
+    if not fold_bn:
+        x = BatchNorm(axis=3, name=bn_name_base + '2c')(x)
 
     shortcut = KL.Conv2D(nb_filter3, (1, 1), strides=strides,
                          name=conv_name_base + '1', use_bias=use_bias)(input_tensor)
-    shortcut = BatchNorm(axis=3, name=bn_name_base + '1')(shortcut)
+    if not fold_bn:
+        shortcut = BatchNorm(axis=3, name=bn_name_base + '1')(shortcut)
 
     x = KL.Add()([x, shortcut])
     x = KL.Activation('relu', name='res' + str(stage) + block + '_out')(x)
     return x
 
 
-def resnet_graph(input_image, architecture, stage5=False):
+def resnet_graph(input_image, architecture, stage5=False, fold_bn=False):
     assert architecture in ["resnet50", "resnet101"]
     # Stage 1
     x = KL.ZeroPadding2D((3, 3))(input_image)
     x = KL.Conv2D(64, (7, 7), strides=(2, 2), name='conv1', use_bias=True)(x)
-    x = BatchNorm(axis=3, name='bn_conv1')(x)
+    if not fold_bn:
+        x = BatchNorm(axis=3, name='bn_conv1')(x)
     x = KL.Activation('relu')(x)
     C1 = x = KL.MaxPooling2D((3, 3), strides=(2, 2), padding="same")(x)
     # Stage 2
-    x = conv_block(x, 3, [64, 64, 256], stage=2, block='a', strides=(1, 1))
-    x = identity_block(x, 3, [64, 64, 256], stage=2, block='b')
-    C2 = x = identity_block(x, 3, [64, 64, 256], stage=2, block='c')
+    x = conv_block(x, 3, [64, 64, 256], stage=2, block='a', strides=(1, 1), fold_bn=fold_bn)
+    x = identity_block(x, 3, [64, 64, 256], stage=2, block='b', fold_bn=fold_bn)
+    C2 = x = identity_block(x, 3, [64, 64, 256], stage=2, block='c', fold_bn=fold_bn)
     # Stage 3
-    x = conv_block(x, 3, [128, 128, 512], stage=3, block='a')
-    x = identity_block(x, 3, [128, 128, 512], stage=3, block='b')
-    x = identity_block(x, 3, [128, 128, 512], stage=3, block='c')
-    C3 = x = identity_block(x, 3, [128, 128, 512], stage=3, block='d')
+    x = conv_block(x, 3, [128, 128, 512], stage=3, block='a', fold_bn=fold_bn)
+    x = identity_block(x, 3, [128, 128, 512], stage=3, block='b', fold_bn=fold_bn)
+    x = identity_block(x, 3, [128, 128, 512], stage=3, block='c', fold_bn=fold_bn)
+    C3 = x = identity_block(x, 3, [128, 128, 512], stage=3, block='d', fold_bn=fold_bn)
     # Stage 4
-    x = conv_block(x, 3, [256, 256, 1024], stage=4, block='a')
+    x = conv_block(x, 3, [256, 256, 1024], stage=4, block='a', fold_bn=fold_bn)
     block_count = {"resnet50": 5, "resnet101": 22}[architecture]
     for i in range(block_count):
-        x = identity_block(x, 3, [256, 256, 1024], stage=4, block=chr(98 + i))
+        x = identity_block(x, 3, [256, 256, 1024], stage=4, block=chr(98 + i), fold_bn=fold_bn)
+    C4 = x
+    # Stage 5
+    if stage5:
+        x = conv_block(x, 3, [512, 512, 2048], stage=5, block='a', fold_bn=fold_bn)
+        x = identity_block(x, 3, [512, 512, 2048], stage=5, block='b', fold_bn=fold_bn)
+        C5 = x = identity_block(x, 3, [512, 512, 2048], stage=5, block='c', fold_bn=fold_bn)
+    else:
+        C5 = None
+    return [C1, C2, C3, C4, C5]
+
+
+def fold_batch_norm(kernel, bias, gamma, beta, moving_mean, moving_variance,
+                    epsilon=1e-3):
+    """Folds an inference BatchNorm into the conv layer in front of it.
+    kernel: [height, width, in_channels, out_channels] conv kernel
+    bias: [out_channels] conv bias
+    gamma, beta, moving_mean, moving_variance: [out_channels] BN weights
+    epsilon: BN epsilon. 1e-3 is the Keras default used by BatchNorm.
+
+    Returns the kernel and bias of a single conv computing
+    gamma * (conv(x) + bias - mean) / sqrt(variance + epsilon) + beta
+    """
+    scale = gamma / np.sqrt(moving_variance + epsilon)
+    kernel = kernel * scale
+    bias = (bias - moving_mean) * scale + beta
+    return kernel.astype(np.float32), bias.astype(np.float32)
+
+
+############################################################
+#  MobileNet Graph
+############################################################
+
+def separable_block(input_tensor, filters, stage, block, strides=(1, 1),
+                    use_bias=True, fold_bn=False):
+    """Depthwise separable block: a 3x3 depthwise conv and a 1x1 pointwise
+    conv, followed by BatchNorm and ReLU.
+    # Arguments
+        input_tensor: input tensor
+        filters: integer, the nb_filters of the pointwise conv
+        stage: integer, current stage label, used for generating layer names
+        block: 'a','b'..., current block label, used for generating layer names
+        strides: strides of the depthwise conv
+        fold_bn: if True, skip the BatchNorm layer (see identity_block)
+    Keras 2.0 has no DepthwiseConv2D layer, so both convs come from one
+    SeparableConv2D and there is no BatchNorm between them.
+    """
+    x = KL.SeparableConv2D(filters, (3, 3), strides=strides, padding='same',
+                           name='res' + str(stage) + block + '_sep',
+                           use_bias=use_bias)(input_tensor)
+    if not fold_bn:
+        x = BatchNorm(axis=3, name='bn' + str(stage) + block + '_sep')(x)
+    x = KL.Activation('relu', name='res' + str(stage) + block + '_out')(x)
+    return x
+
+
+def mobilenet_graph(input_image, architecture, stage5=False, fold_bn=False):
+    """MobileNet style backbone with the same strides as the ResNet
+    (C2 to C5 at 1/4 to 1/32 of the image) and a quarter to a half of
+    its channels. Layers are named like the ResNet ones (res3a_sep,
+    bn3a_sep, ...) so the stage groups of MaskRCNN.train() select them.
+    """
+    assert architecture == "mobilenet"
+    # Stage 1
+    x = KL.Conv2D(32, (3, 3), strides=(2, 2), padding='same', name='conv1',
+                  use_bias=True)(input_image)
+    if not fold_bn:
+        x = BatchNorm(axis=3, name='bn_conv1')(x)
+    C1 = x = KL.Activation('relu')(x)
+    # Stage 2
+    x = separable_block(x, 64, stage=2, block='a', fold_bn=fold_bn)
+    x = separable_block(x, 128, stage=2, block='b', strides=(2, 2), fold_bn=fold_bn)
+    C2 = x = separable_block(x, 128, stage=2, block='c', fold_bn=fold_bn)
+    # Stage 3
+    x = separable_block(x, 256, stage=3, block='a', strides=(2, 2), fold_bn=fold_bn)
+    C3 = x = separable_block(x, 256, stage=3, block='b', fold_bn=fold_bn)
+    # Stage 4
+    x = separable_block(x, 512, stage=4, block='a', strides=(2, 2), fold_bn=fold_bn)
+    for i in range(5):
+        x = separable_block(x, 512, stage=4, block=chr(98 + i), fold_bn=fold_bn)
     C4 = x
     # Stage 5
     if stage5:
-        x = conv_block(x, 3, [512, 512, 2048], stage=5, block='a')
-        x = identity_block(x, 3, [512, 512, 2048], stage=5, block='b')
-        C5 = x = identity_block(x, 3, [512, 512, 2048], stage=5, block='c')
+        x = separable_block(x, 1024, stage=5, block='a', strides=(2, 2), fold_bn=fold_bn)
+        C5 = x = separable_block(x, 1024, stage=5, block='b', fold_bn=fold_bn)
     else:
         C5 = None
     return [C1, C2, C3, C4, C5]
 
 
+############################################################
+#  Backbone Registry
+############################################################
+
+# Backbones selectable with config.BACKBONE_NAME. "graph" builds the network
+# as graph(input_image, name, stage5=True, fold_bn=False) and returns
+# [C1, C2, C3, C4, C5], "features" names the layers that output C2 to C5
+# and "channels" gives their depth. The FPN takes any channel count, so
+# the RPN and the heads are the same for every backbone.
+BACKBONES = {}
+
+
+def register_backbone(name, graph, features, channels):
+    """Adds a backbone to BACKBONES. See above for the arguments."""
+    BACKBONES[name] = {"graph": graph, "features": features, "channels": channels}
+
+
+register_backbone("resnet50", resnet_graph,
+                  ['res2c_out', 'res3d_out', 'res4f_out', 'res5c_out'],
+                  [256, 512, 1024, 2048])
+register_backbone("resnet101", resnet_graph,
+                  ['res2c_out', 'res3d_out', 'res4w_out', 'res5c_out'],
+                  [256, 512, 1024, 2048])
+register_backbone("mobilenet", mobilenet_graph,
+                  ['res2c_out', 'res3b_out', 'res4f_out', 'res5b_out'],
+                  [128, 256, 512, 1024])
+
+
 ############################################################
 #  Proposal Layer
 ############################################################
@@ -228,6 +372,9 @@ class ProposalLayer(KE.Layer):
     Inputs:
         rpn_probs: [batch, anchors, (bg prob, fg prob)]
         rpn_bbox: [batch, anchors, (dy, dx, log(dh), log(dw))]
+        If the layer was created without anchors, also:
+        anchors: [batch, anchors, (y1, x1, y2, x2)] in image coordinates
+        image: [batch, height, width, channels] the input image, for its shape
 
     Returns:
         Proposals in normalized coordinates [batch, rois, (y1, x1, y2, x2)]
@@ -236,13 +383,14 @@ class ProposalLayer(KE.Layer):
     def __init__(self, proposal_count, nms_threshold, anchors,
                  config=None, **kwargs):
         """
-        anchors: [N, (y1, x1, y2, x2)] anchors defined in image coordinates
+        anchors: [N, (y1, x1, y2, x2)] anchors defined in image coordinates,
+            or None to take them from the inputs for variable image sizes
         """
         super(ProposalLayer, self).__init__(**kwargs)
         self.config = config
         self.proposal_count = proposal_count
         self.nms_threshold = nms_threshold
-        self.anchors = anchors.astype(np.float32)
+        self.anchors = anchors.astype(np.float32) if anchors is not None else None
 
     def call(self, inputs):
         # Box Scores. Use the foreground class confidence. [Batch, num_rois, 1]
@@ -251,11 +399,18 @@ class ProposalLayer(KE.Layer):
         deltas = inputs[1]
         deltas = deltas * np.reshape(self.config.RPN_BBOX_STD_DEV, [1, 1, 4])
         # Base anchors
-        anchors = self.anchors
+        if self.anchors is not None:
+            anchors = self.anchors
+            pre_nms_limit = min(6000, self.anchors.shape[0])
+            height, width = self.config.IMAGE_SHAPE[:2]
+        else:
+            anchors = inputs[2]
+            pre_nms_limit = tf.minimum(6000, tf.shape(anchors)[1])
+            height = tf.to_float(tf.shape(inputs[3])[1])
+            width = tf.to_float(tf.shape(inputs[3])[2])
 
         # Improve performance by trimming to top anchors by score
         # and doing the rest on the smaller subset.
-        pre_nms_limit = min(6000, self.anchors.shape[0])
         ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
                          name="top_anchors").indices
         scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y),
@@ -263,9 +418,14 @@ class ProposalLayer(KE.Layer):
         deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y),
                                    self.config.IMAGES_PER_GPU)
         # print anchors.shape
-        anchors = utils.batch_slice(ix, lambda x: tf.gather(anchors, x),
-                                    self.config.IMAGES_PER_GPU,
-                                    names=["pre_nms_anchors"])
+        if self.anchors is not None:
+            anchors = utils.batch_slice(ix, lambda x: tf.gather(anchors, x),
+                                        self.config.IMAGES_PER_GPU,
+                                        names=["pre_nms_anchors"])
+        else:
+            anchors = utils.batch_slice([anchors, ix], lambda a, x: tf.gather(a, x),
+                                        self.config.IMAGES_PER_GPU,
+                                        names=["pre_nms_anchors"])
         # print anchors
 
         # Apply deltas to anchors to get refined anchors.
@@ -276,8 +436,7 @@ class ProposalLayer(KE.Layer):
                                   names=["refined_anchors"])
 
         # Clip to image boundaries. [batch, N, (y1, x1, y2, x2)]
-        height, width = self.config.IMAGE_SHAPE[:2]
-        window = np.array([0, 0, height, width]).astype(np.float32)
+        window = tf.cast(tf.stack([0, 0, height, width]), tf.float32)
         boxes = utils.batch_slice(boxes,
                                   lambda x: clip_boxes_graph(x, window),
                                   self.config.IMAGES_PER_GPU,
@@ -288,7 +447,7 @@ class ProposalLayer(KE.Layer):
         # for small objects, so we're skipping it.
 
         # Normalize dimensions to range of 0 to 1.
-        normalized_boxes = boxes / np.array([[height, width, height, width]])
+        normalized_boxes = boxes / tf.cast(tf.stack([height, width, height, width]), tf.float32)
         # # Normalize coordinates
         # normalized_boxes = norm_boxes_graph(boxes, self.config.IMAGE_SHAPE[:2])
         # Non-max suppression
@@ -323,7 +482,9 @@ class PyramidROIAlign(KE.Layer):
 
     Params:
     - pool_shape: [height, width] of the output pooled regions. Usually [7, 7]
-    - image_shape: [height, width, chanells]. Shape of input image in pixels
+    - image_shape: [height, width, chanells]. Shape of input image in pixels.
+                   If None, it's taken from the P2 feature map (stride 4),
+                   which allows variable image sizes.
 
     Inputs:
     - boxes: [batch, num_boxes, (y1, x1, y2, x2)] in normalized
@@ -341,7 +502,7 @@ class PyramidROIAlign(KE.Layer):
     def __init__(self, pool_shape, image_shape, **kwargs):
         super(PyramidROIAlign, self).__init__(**kwargs)
         self.pool_shape = tuple(pool_shape)
-        self.image_shape = tuple(image_shape)
+        self.image_shape = tuple(image_shape) if image_shape is not None else None
 
     def call(self, inputs):
         # Crop boxes [batch, num_boxes, (y1, x1, y2, x2)] in normalized coords
@@ -358,25 +519,34 @@ class PyramidROIAlign(KE.Layer):
         # Equation 1 in the Feature Pyramid Networks paper. Account for
         # the fact that our coordinates are normalized here.
         # e.g. a 224x224 ROI (in pixels) maps to P4
-        image_area = tf.cast(
-            self.image_shape[0] * self.image_shape[1], tf.float32)
+        if self.image_shape is not None:
+            image_area = tf.cast(
+                self.image_shape[0] * self.image_shape[1], tf.float32)
+        else:
+            image_area = tf.cast(
+                tf.reduce_prod(tf.shape(feature_maps[0])[1:3] * 4), tf.float32)
         roi_level = log2_graph(tf.sqrt(h * w) / (224.0 / tf.sqrt(image_area)))
         roi_level = tf.minimum(5, tf.maximum(
             2, 4 + tf.cast(tf.round(roi_level), tf.int32)))
         roi_level = tf.squeeze(roi_level, 2)
 
         # Loop through levels and apply ROI pooling to each. P2 to P5.
+        # Each level writes its crops straight into the slots of its boxes
+        # in the flattened [batch * num_boxes] order, so no sort is needed
+        # to restore the original box order afterwards.
+        num_boxes = tf.shape(boxes)[1]
         pooled = []
         box_to_level = []
         for i, level in enumerate(range(2, 6)):
             ix = tf.where(tf.equal(roi_level, level))
             level_boxes = tf.gather_nd(boxes, ix)
 
-            # Box indicies for crop_and_resize.
+            # Box indices for crop_and_resize.
             box_indices = tf.cast(ix[:, 0], tf.int32)
 
-            # Keep track of which box is mapped to which level
-            box_to_level.append(ix)
+            # Keep track of where each box of this level goes in the output
+            ix = tf.cast(ix, tf.int32)
+            box_to_level.append(ix[:, 0] * num_boxes + ix[:, 1])
 
             # Stop gradient propogation to ROI proposals
             level_boxes = tf.stop_gradient(level_boxes)
@@ -390,32 +560,19 @@ class PyramidROIAlign(KE.Layer):
             #
             # Here we use the simplified approach of a single value per bin,
             # which is how it's done in tf.crop_and_resize()
-            # Result: [batch * num_boxes, pool_height, pool_width, channels]
+            # Result: [level_boxes, pool_height, pool_width, channels]
             pooled.append(tf.image.crop_and_resize(
                 feature_maps[i], level_boxes, box_indices, self.pool_shape,
                 method="bilinear"))
 
-        # Pack pooled features into one tensor
-        pooled = tf.concat(pooled, axis=0)
-
-        # Pack box_to_level mapping into one array and add another
-        # column representing the order of pooled boxes
-        box_to_level = tf.concat(box_to_level, axis=0)
-        box_range = tf.expand_dims(tf.range(tf.shape(box_to_level)[0]), 1)
-        box_to_level = tf.concat([tf.cast(box_to_level, tf.int32), box_range],
-                                 axis=1)
-
-        # Rearrange pooled features to match the order of the original boxes
-        # Sort box_to_level by batch then box index
-        # TF doesn't have a way to sort by two columns, so merge them and sort.
-        sorting_tensor = box_to_level[:, 0] * 100000 + box_to_level[:, 1]
-        ix = tf.nn.top_k(sorting_tensor, k=tf.shape(
-            box_to_level)[0]).indices[::-1]
-        ix = tf.gather(box_to_level[:, 2], ix)
-        pooled = tf.gather(pooled, ix)
+        # Every box is assigned to exactly one level, so the per-level
+        # slots cover [0, batch * num_boxes) and stitch into one tensor.
+        # Result: [batch * num_boxes, pool_height, pool_width, channels]
+        pooled = tf.dynamic_stitch(box_to_level, pooled)
 
         # Re-add the batch dimension
-        pooled = tf.expand_dims(pooled, 0)
+        shape = tf.concat([tf.shape(boxes)[:2], tf.shape(pooled)[1:]], axis=0)
+        pooled = tf.reshape(pooled, shape)
         return pooled
 
     def compute_output_shape(self, input_shape):
@@ -700,84 +857,245 @@ def refine_detections(rois, probs, deltas, window, config):
 
     # TODO: Filter out boxes with zero area
 
+    keep = utils.select_detections(refined_rois, class_ids, class_scores, config)
+
+    # Arrange output as [N, (y1, x1, y2, x2, class_id, score)]
+    # Coordinates are in image domain.
+    result = np.hstack((refined_rois[keep],
+                        class_ids[keep][..., np.newaxis],
+                        class_scores[keep][..., np.newaxis]))
+    return result
+
+
+def refine_boxes_graph(rois, probs, deltas, window, config, image_shape=None):
+    """Applies to each ROI the bounding box deltas of its top class, in the
+    image domain. See refine_detections_graph() for the inputs.
+
+    Returns refined_rois [N, (y1, x1, y2, x2)] clipped to the window and
+    rounded to pixels, and class_ids and class_scores [N] of the top class.
+    """
+    # Class IDs per ROI
+    class_ids = tf.argmax(probs, axis=1, output_type=tf.int32)
+    # Class probability of the top class of each ROI
+    indices = tf.stack([tf.range(tf.shape(probs)[0]), class_ids], axis=1)
+    class_scores = tf.gather_nd(probs, indices)
+    # Class-specific bounding box deltas
+    deltas_specific = tf.gather_nd(deltas, indices)
+    # Apply bounding box deltas
+    # Shape: [boxes, (y1, x1, y2, x2)] in normalized coordinates
+    refined_rois = apply_box_deltas_graph(
+        rois, deltas_specific * config.BBOX_STD_DEV.astype(np.float32))
+    # Convert coordiates to image domain
+    if image_shape is None:
+        height, width = config.IMAGE_SHAPE[:2]
+        refined_rois *= np.array([height, width, height, width], dtype=np.float32)
+    else:
+        height, width = tf.to_float(image_shape[0]), tf.to_float(image_shape[1])
+        refined_rois *= tf.stack([height, width, height, width])
+    # Clip boxes to image window
+    refined_rois = clip_boxes_graph(refined_rois, window)
+    # Round since we're deadling with pixels now
+    refined_rois = tf.round(refined_rois)
+    return refined_rois, class_ids, class_scores
+
+
+def raw_detections_graph(rois, probs, deltas, window, config, image_shape=None):
+    """Pre-NMS version of refine_detections_graph() for a single image.
+    Keeps the refined boxes and class probabilities of the ROIs whose top
+    class is a foreground class with a score of at least
+    RAW_MIN_CONFIDENCE, the RAW_MAX_ROIS best of them.
+
+    Returns [RAW_MAX_ROIS, (y1, x1, y2, x2, class probabilities...)] with
+    the boxes in pixels, best first, zero padded.
+    """
+    refined_rois, class_ids, class_scores = refine_boxes_graph(
+        rois, probs, deltas, window, config, image_shape)
+    keep = tf.where(tf.logical_and(
+        class_ids > 0, class_scores >= config.RAW_MIN_CONFIDENCE))[:, 0]
+    scores = tf.gather(class_scores, keep)
+    num_keep = tf.minimum(tf.shape(scores)[0], config.RAW_MAX_ROIS)
+    top_ids = tf.nn.top_k(scores, k=num_keep, sorted=True)[1]
+    keep = tf.gather(keep, top_ids)
+    raw = tf.concat([tf.gather(refined_rois, keep), tf.gather(probs, keep)], axis=1)
+    gap = config.RAW_MAX_ROIS - tf.shape(raw)[0]
+    return tf.pad(raw, [(0, gap), (0, 0)], "CONSTANT")
+
+
+def refine_detections_graph(rois, probs, deltas, window, config, image_shape=None):
+    """Graph version of refine_detections() for a single image. Refines
+    classified proposals, filters overlaps and returns final detections.
+
+    Inputs:
+        rois: [N, (y1, x1, y2, x2)] in normalized coordinates
+        probs: [N, num_classes]. Class probabilities.
+        deltas: [N, num_classes, (dy, dx, log(dh), log(dw))]. Class-specific
+                bounding box deltas.
+        window: (y1, x1, y2, x2) in image coordinates. The part of the image
+            that contains the image excluding the padding.
+        image_shape: [height, width] tensor of the input image. Defaults to
+            config.IMAGE_SHAPE.
+
+    Returns detections shaped: [DETECTION_MAX_INSTANCES,
+        (y1, x1, y2, x2, class_id, score)] in pixels, zero padded.
+    """
+    refined_rois, class_ids, class_scores = refine_boxes_graph(
+        rois, probs, deltas, window, config, image_shape)
+
     # Filter out background boxes
-    keep = np.where(class_ids > 0)[0]
+    keep = tf.where(class_ids > 0)[:, 0]
     # Filter out low confidence boxes
     if config.DETECTION_MIN_CONFIDENCE:
-        keep = np.intersect1d(
-            keep, np.where(class_scores >= config.DETECTION_MIN_CONFIDENCE)[0])
+        conf_keep = tf.where(class_scores >= config.DETECTION_MIN_CONFIDENCE)[:, 0]
+        keep = tf.sets.set_intersection(tf.expand_dims(keep, 0),
+                                        tf.expand_dims(conf_keep, 0))
+        keep = tf.sparse_tensor_to_dense(keep)[0]
 
     # Apply per-class NMS
-    pre_nms_class_ids = class_ids[keep]
-    pre_nms_scores = class_scores[keep]
-    pre_nms_rois = refined_rois[keep]
-    nms_keep = []
-    for class_id in np.unique(pre_nms_class_ids):
-        # Pick detections of this class
-        ixs = np.where(pre_nms_class_ids == class_id)[0]
+    # 1. Prepare variables
+    pre_nms_class_ids = tf.gather(class_ids, keep)
+    pre_nms_scores = tf.gather(class_scores, keep)
+    pre_nms_rois = tf.gather(refined_rois, keep)
+    unique_pre_nms_class_ids = tf.unique(pre_nms_class_ids)[0]
+
+    def nms_keep_map(class_id):
+        """Apply Non-Maximum Suppression on ROIs of the given class."""
+        # Indices of ROIs of the given class
+        ixs = tf.where(tf.equal(pre_nms_class_ids, class_id))[:, 0]
         # Apply NMS
-        class_keep = utils.non_max_suppression(
-            pre_nms_rois[ixs], pre_nms_scores[ixs],
-            config.DETECTION_NMS_THRESHOLD)
+        class_keep = tf.image.non_max_suppression(
+            tf.gather(pre_nms_rois, ixs),
+            tf.gather(pre_nms_scores, ixs),
+            max_output_size=config.DETECTION_MAX_INSTANCES,
+            iou_threshold=config.DETECTION_NMS_THRESHOLD)
         # Map indicies
-        class_keep = keep[ixs[class_keep]]
-        nms_keep = np.union1d(nms_keep, class_keep)
-    keep = np.intersect1d(keep, nms_keep).astype(np.int32)
-
+        class_keep = tf.gather(keep, tf.gather(ixs, class_keep))
+        # Pad with -1 so returned tensors have the same shape
+        gap = config.DETECTION_MAX_INSTANCES - tf.shape(class_keep)[0]
+        class_keep = tf.pad(class_keep, [(0, gap)],
+                            mode='CONSTANT', constant_values=-1)
+        # Set shape so map_fn() can infer result shape
+        class_keep.set_shape([config.DETECTION_MAX_INSTANCES])
+        return class_keep
+
+    # 2. Map over class IDs
+    nms_keep = tf.map_fn(nms_keep_map, unique_pre_nms_class_ids,
+                         dtype=tf.int64)
+    # 3. Merge results into one list, and remove -1 padding
+    nms_keep = tf.reshape(nms_keep, [-1])
+    nms_keep = tf.gather(nms_keep, tf.where(nms_keep > -1)[:, 0])
+    # 4. Compute intersection between keep and nms_keep
+    keep = tf.sets.set_intersection(tf.expand_dims(keep, 0),
+                                    tf.expand_dims(nms_keep, 0))
+    keep = tf.sparse_tensor_to_dense(keep)[0]
     # Keep top detections
     roi_count = config.DETECTION_MAX_INSTANCES
-    top_ids = np.argsort(class_scores[keep])[::-1][:roi_count]
-    keep = keep[top_ids]
+    class_scores_keep = tf.gather(class_scores, keep)
+    num_keep = tf.minimum(tf.shape(class_scores_keep)[0], roi_count)
+    top_ids = tf.nn.top_k(class_scores_keep, k=num_keep, sorted=True)[1]
+    keep = tf.gather(keep, top_ids)
 
     # Arrange output as [N, (y1, x1, y2, x2, class_id, score)]
     # Coordinates are in image domain.
-    result = np.hstack((refined_rois[keep],
-                        class_ids[keep][..., np.newaxis],
-                        class_scores[keep][..., np.newaxis]))
-    return result
+    detections = tf.concat([
+        tf.gather(refined_rois, keep),
+        tf.to_float(tf.gather(class_ids, keep))[..., tf.newaxis],
+        tf.gather(class_scores, keep)[..., tf.newaxis]
+        ], axis=1)
+
+    # Pad with zeros if detections < DETECTION_MAX_INSTANCES
+    gap = config.DETECTION_MAX_INSTANCES - tf.shape(detections)[0]
+    detections = tf.pad(detections, [(0, gap), (0, 0)], "CONSTANT")
+    return detections
 
 
 class DetectionLayer(KE.Layer):
     """Takes classified proposal boxes and their bounding box deltas and
-    returns the final detection boxes.
+    returns the final detection boxes. Runs refine_detections_graph() on
+    each image of the batch, so the whole step stays inside the graph.
+
+    Inputs: rois, mrcnn_class, mrcnn_bbox, image_meta and, optionally, the
+    input image, whose shape is then used instead of config.IMAGE_SHAPE.
+
+    early_exit: If True, images where no ROI has a foreground class with a
+        score of at least DETECTION_MIN_CONFIDENCE skip the refinement and
+        NMS and return no detections right away.
 
     Returns:
-    [batch, num_detections, (y1, x1, y2, x2, class_score)] in pixels
+    [batch, num_detections, (y1, x1, y2, x2, class_id, class_score)] in pixels
     """
 
-    def __init__(self, config=None, **kwargs):
+    def __init__(self, config=None, early_exit=False, **kwargs):
         super(DetectionLayer, self).__init__(**kwargs)
         self.config = config
+        self.early_exit = early_exit
+
+    def refine_or_exit(self, rois, probs, deltas, window, image_shape):
+        """refine_detections_graph() behind the early exit check."""
+        if not self.early_exit:
+            return refine_detections_graph(rois, probs, deltas, window, self.config, image_shape)
+        class_ids = tf.argmax(probs, axis=1, output_type=tf.int32)
+        confident = tf.logical_and(
+            class_ids > 0, tf.reduce_max(probs, axis=1) >= self.config.DETECTION_MIN_CONFIDENCE)
+        return tf.cond(
+            tf.reduce_any(confident),
+            lambda: refine_detections_graph(rois, probs, deltas, window, self.config, image_shape),
+            lambda: tf.zeros([self.config.DETECTION_MAX_INSTANCES, 6]))
 
     def call(self, inputs):
-        def wrapper(rois, mrcnn_class, mrcnn_bbox, image_meta):
-            detections_batch = []
-            _, _, window, _ = parse_image_meta(image_meta)
-            for b in range(self.config.BATCH_SIZE):
-                detections = refine_detections(
-                    rois[b], mrcnn_class[b], mrcnn_bbox[b], window[b], self.config)
-                # Pad with zeros if detections < DETECTION_MAX_INSTANCES
-                gap = self.config.DETECTION_MAX_INSTANCES - detections.shape[0]
-                assert gap >= 0
-                if gap > 0:
-                    detections = np.pad(
-                        detections, [(0, gap), (0, 0)], 'constant', constant_values=0)
-                detections_batch.append(detections)
-
-            # Stack detections and cast to float32
-            # TODO: track where float64 is introduced
-            detections_batch = np.array(detections_batch).astype(np.float32)
-            # Reshape output
-            # [batch, num_detections, (y1, x1, y2, x2, class_score)] in pixels
-            return np.reshape(detections_batch, [self.config.BATCH_SIZE, self.config.DETECTION_MAX_INSTANCES, 6])
-
-        # Return wrapped function
-        return tf.py_func(wrapper, inputs, tf.float32)
+        rois = inputs[0]
+        mrcnn_class = inputs[1]
+        mrcnn_bbox = inputs[2]
+        image_meta = inputs[3]
+        image_shape = tf.shape(inputs[4])[1:3] if len(inputs) > 4 else None
+
+        # Window of the image in pixels, excluding the padding
+        _, _, window, _ = parse_image_meta_graph(image_meta)
+
+        # Run detection refinement graph on each item in the batch
+        detections_batch = utils.batch_slice(
+            [rois, mrcnn_class, mrcnn_bbox, window],
+            lambda x, y, w, z: self.refine_or_exit(x, y, w, z, image_shape),
+            self.config.IMAGES_PER_GPU)
+
+        # Reshape output
+        # [batch, num_detections, (y1, x1, y2, x2, class_id, class_score)] in pixels
+        return tf.reshape(
+            detections_batch,
+            [self.config.IMAGES_PER_GPU, self.config.DETECTION_MAX_INSTANCES, 6])
 
     def compute_output_shape(self, input_shape):
         return (None, self.config.DETECTION_MAX_INSTANCES, 6)
 
 
+class RawDetectionLayer(KE.Layer):
+    """Takes the same inputs as DetectionLayer and returns the refined
+    boxes and class probabilities of the candidates before NMS, see
+    raw_detections_graph().
+
+    Returns:
+    [batch, RAW_MAX_ROIS, (y1, x1, y2, x2, class probabilities...)] in pixels
+    """
+
+    def __init__(self, config=None, **kwargs):
+        super(RawDetectionLayer, self).__init__(**kwargs)
+        self.config = config
+
+    def call(self, inputs):
+        rois, mrcnn_class, mrcnn_bbox, image_meta = inputs[:4]
+        image_shape = tf.shape(inputs[4])[1:3] if len(inputs) > 4 else None
+        _, _, window, _ = parse_image_meta_graph(image_meta)
+        raw_batch = utils.batch_slice(
+            [rois, mrcnn_class, mrcnn_bbox, window],
+            lambda x, y, w, z: raw_detections_graph(x, y, w, z, self.config, image_shape),
+            self.config.IMAGES_PER_GPU)
+        return tf.reshape(
+            raw_batch,
+            [self.config.IMAGES_PER_GPU, self.config.RAW_MAX_ROIS, 4 + self.config.NUM_CLASSES])
+
+    def compute_output_shape(self, input_shape):
+        return (None, self.config.RAW_MAX_ROIS, 4 + self.config.NUM_CLASSES)
+
+
 # Region Proposal Network (RPN)
 
 def rpn_graph(feature_map, anchors_per_location, anchor_stride):
@@ -1703,7 +2021,8 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
                 batch_rpn_bbox = np.zeros(
                     [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=rpn_bbox.dtype)
                 batch_images = np.zeros(
-                    (batch_size,) + image.shape, dtype=np.float32)
+                    (batch_size,) + image.shape,
+                    dtype=np.uint8 if config.IMAGE_UINT8 else np.float32)
                 batch_gt_class_ids = np.zeros(
                     (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
                 batch_gt_boxes = np.zeros(
@@ -1739,7 +2058,7 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
             batch_image_meta[b] = image_meta
             batch_rpn_match[b] = rpn_match[:, np.newaxis]
             batch_rpn_bbox[b] = rpn_bbox
-            batch_images[b] = mold_image(image.astype(np.float32), config)
+            batch_images[b] = mold_image(image, config)
             batch_gt_class_ids[b, :gt_class_ids.shape[0]] = gt_class_ids
             batch_gt_boxes[b, :gt_boxes.shape[0]] = gt_boxes
             batch_gt_masks[b, :, :, :gt_masks.shape[-1]] = gt_masks
@@ -1783,6 +2102,289 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
                 raise
 
 
+############################################################
+#  Backbone Feature Cache
+############################################################
+
+def backbone_feature_names(architecture):
+    """Names of the layers that output C2, C3, C4 and C5 in the backbone."""
+    return BACKBONES[architecture]["features"]
+
+
+def backbone_feature_shapes(config):
+    """[height, width, channels] of C2, C3, C4 and C5 for config.IMAGE_SHAPE."""
+    channels = BACKBONES[config.BACKBONE_NAME]["channels"]
+    return [np.array([shape[0], shape[1], c])
+            for shape, c in zip(config.BACKBONE_SHAPES[:4], channels)]
+
+
+def build_feature_cache(model, dataset, cache_dir, variants=1, augment=False):
+    """Runs the backbone once over a dataset and stores everything the
+    heads need to train on it, so the heads-only training stage doesn't
+    have to run the frozen ResNet again every epoch.
+
+    model: MaskRCNN with the backbone weights loaded. Either mode works.
+    dataset: The Dataset object to render
+    cache_dir: Directory to write to. Holds C2.npy ... C5.npy, float16
+        arrays of [samples, height, width, channels] opened as memory maps,
+        and one gt_XXXXXX.npz per sample with the image meta and targets.
+    variants: Number of renderings of each image. Only useful with augment,
+        as each rendering gets its own random augmentation.
+    augment: Apply the training augmentation, see load_image_gt()
+
+    Returns the number of samples written.
+    """
+    config = model.config
+    keras_model = model.keras_model.inner_model if hasattr(model.keras_model, "inner_model")\
+        else model.keras_model
+    backbone = KM.Model(keras_model.get_layer("input_image").input,
+                        [keras_model.get_layer(name).output
+                         for name in backbone_feature_names(config.BACKBONE_NAME)])
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    samples = []
+    for image_id in dataset.image_ids:
+        for _ in range(variants):
+            samples.append(image_id)
+    features = [np.lib.format.open_memmap(
+        os.path.join(cache_dir, name + ".npy"), mode="w+", dtype=np.float16,
+        shape=(len(samples),) + tuple(shape))
+        for name, shape in zip(["C2", "C3", "C4", "C5"], backbone_feature_shapes(config))]
+
+    count = 0
+    for image_id in samples:
+        image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+            load_image_gt(dataset, config, image_id, augment=augment,
+                          use_mini_mask=config.USE_MINI_MASK)
+        # Samples with no instances are skipped in training, so leave them out
+        if not np.any(gt_class_ids > 0):
+            continue
+        outputs = backbone.predict(mold_image(image, config)[np.newaxis], verbose=0)
+        for f, o in zip(features, outputs):
+            f[count] = o[0].astype(np.float16)
+        np.savez(os.path.join(cache_dir, "gt_{:06d}.npz".format(count)),
+                 image_meta=image_meta, gt_class_ids=gt_class_ids,
+                 gt_boxes=gt_boxes, gt_masks=gt_masks.astype(bool))
+        count += 1
+        if count % 100 == 0:
+            log("Cached {} / {} samples".format(count, len(samples)))
+    for f in features:
+        f.flush()
+    # Record how many of the preallocated rows are used
+    np.save(os.path.join(cache_dir, "count.npy"), np.array(count))
+    return count
+
+
+def feature_cache_generator(cache_dir, config, shuffle=True, batch_size=1):
+    """Same as data_generator() but reads the samples written by
+    build_feature_cache(). The first four inputs are the C2 to C5 feature
+    maps instead of the image. RPN targets are still built on the fly so
+    the anchor sampling changes from epoch to epoch.
+    """
+    b = 0  # batch item index
+    sample_index = -1
+    count = int(np.load(os.path.join(cache_dir, "count.npy")))
+    sample_ids = np.arange(count)
+    features = [np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="r")
+                for name in ["C2", "C3", "C4", "C5"]]
+
+    # Anchors
+    # [anchor_count, (y1, x1, y2, x2)]
+    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                             config.RPN_ANCHOR_RATIOS,
+                                             config.BACKBONE_SHAPES,
+                                             config.BACKBONE_STRIDES,
+                                             config.RPN_ANCHOR_STRIDE)
+
+    # Keras requires a generator to run indefinately.
+    while True:
+        sample_index = (sample_index + 1) % count
+        if shuffle and sample_index == 0:
+            np.random.shuffle(sample_ids)
+        sample_id = sample_ids[sample_index]
+        gt = np.load(os.path.join(cache_dir, "gt_{:06d}.npz".format(sample_id)))
+        image_meta, gt_class_ids, gt_boxes, gt_masks = \
+            gt["image_meta"], gt["gt_class_ids"], gt["gt_boxes"], gt["gt_masks"]
+
+        # RPN Targets
+        rpn_match, rpn_bbox = build_rpn_targets(config.IMAGE_SHAPE, anchors,
+                                                gt_class_ids, gt_boxes, config)
+
+        # Init batch arrays
+        if b == 0:
+            batch_features = [np.zeros((batch_size,) + f.shape[1:], dtype=np.float32)
+                              for f in features]
+            batch_image_meta = np.zeros(
+                (batch_size,) + image_meta.shape, dtype=image_meta.dtype)
+            batch_rpn_match = np.zeros(
+                [batch_size, anchors.shape[0], 1], dtype=rpn_match.dtype)
+            batch_rpn_bbox = np.zeros(
+                [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=rpn_bbox.dtype)
+            batch_gt_class_ids = np.zeros(
+                (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
+            batch_gt_boxes = np.zeros(
+                (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
+            batch_gt_masks = np.zeros(
+                (batch_size,) + gt_masks.shape[:2] + (config.MAX_GT_INSTANCES,))
+
+        # If more instances than fits in the array, sub-sample from them.
+        if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+            ids = np.random.choice(
+                np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
+            gt_class_ids = gt_class_ids[ids]
+            gt_boxes = gt_boxes[ids]
+            gt_masks = gt_masks[:, :, ids]
+
+        # Add to batch
+        for bf, f in zip(batch_features, features):
+            bf[b] = f[sample_id]
+        batch_image_meta[b] = image_meta
+        batch_rpn_match[b] = rpn_match[:, np.newaxis]
+        batch_rpn_bbox[b] = rpn_bbox
+        batch_gt_class_ids[b, :gt_class_ids.shape[0]] = gt_class_ids
+        batch_gt_boxes[b, :gt_boxes.shape[0]] = gt_boxes
+        batch_gt_masks[b, :, :, :gt_masks.shape[-1]] = gt_masks
+        b += 1
+
+        # Batch full?
+        if b >= batch_size:
+            inputs = batch_features + [batch_image_meta, batch_rpn_match, batch_rpn_bbox,
+                                       batch_gt_class_ids, batch_gt_boxes, batch_gt_masks]
+            yield inputs, []
+
+            # start a new batch
+            b = 0
+
+
+############################################################
+#  Optimizer Wrappers
+############################################################
+
+def clip_gradients(grads, optimizer):
+    """Clips gradients by the clipnorm and clipvalue of a Keras optimizer,
+    as its own get_gradients() would.
+    """
+    if getattr(optimizer, 'clipnorm', 0) > 0:
+        norm = K.sqrt(sum([K.sum(K.square(g)) for g in grads]))
+        grads = [keras.optimizers.clip_norm(g, optimizer.clipnorm, norm) for g in grads]
+    if getattr(optimizer, 'clipvalue', 0) > 0:
+        grads = [K.clip(g, -optimizer.clipvalue, optimizer.clipvalue) for g in grads]
+    return grads
+
+
+class GradientAccumulation(keras.optimizers.Optimizer):
+    """Wraps a Keras optimizer so that it takes one step with the mean
+    gradient of `steps` consecutive batches instead of one step per batch.
+    Training then behaves like training with steps times the batch size,
+    while only one batch is in memory at a time.
+
+    The wrapped optimizer sees the mean gradient as its gradient, so its
+    clipnorm and clipvalue apply to the gradient of the whole effective
+    batch, as they would with the large batch.
+
+    optimizer: The Keras optimizer to wrap, with its lr, momentum, clipnorm...
+    steps: Number of batches to accumulate before each update
+    """
+
+    def __init__(self, optimizer, steps, **kwargs):
+        super(GradientAccumulation, self).__init__(**kwargs)
+        self.optimizer = optimizer
+        self.steps = steps
+        # Callbacks read and set the learning rate of the model optimizer
+        self.lr = optimizer.lr
+        with K.name_scope(self.__class__.__name__):
+            self.iterations = K.variable(0, dtype='int64', name='iterations')
+
+    @interfaces.legacy_get_updates_support
+    def get_updates(self, loss, params):
+        # Apply the wrapped optimizer on the last batch of every group
+        apply = K.equal((self.iterations + 1) % self.steps, 0)
+        grads = [tf.convert_to_tensor(g) for g in self.get_gradients(loss, params)]
+        accumulators = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        mean_grads = [(a + g) / self.steps for a, g in zip(accumulators, grads)]
+
+        # The wrapped optimizer takes the mean gradients and clips them
+        optimizer = self.optimizer
+        optimizer.get_gradients = lambda loss, params: clip_gradients(mean_grads, optimizer)
+
+        # Its updates (weights, moments, its own iteration count) only take
+        # effect on the last batch of the group. Rebuild each assign to keep
+        # the old value otherwise.
+        gated_updates = []
+        for update in optimizer.get_updates(loss=loss, params=params):
+            op = update.op if hasattr(update, 'op') else update
+            ref, value = op.inputs[0], op.inputs[1]
+            if op.type == 'Assign':
+                gated_updates.append(tf.assign(ref, K.switch(apply, value, tf.identity(ref))))
+            elif op.type == 'AssignAdd':
+                gated_updates.append(tf.assign_add(ref, K.switch(apply, value, tf.zeros_like(value))))
+            else:
+                raise ValueError("Can't accumulate gradients for update {}".format(op.name))
+
+        # Then accumulate, or reset after an update, and count the batch
+        with tf.control_dependencies(gated_updates):
+            self.updates = gated_updates + [
+                K.update(a, K.switch(apply, K.zeros_like(a), a + g))
+                for a, g in zip(accumulators, grads)]
+            self.updates.append(K.update_add(self.iterations, 1))
+        self.weights = [self.iterations] + accumulators
+        return self.updates
+
+    def get_config(self):
+        config = {'optimizer': keras.optimizers.serialize(self.optimizer),
+                  'steps': self.steps}
+        base_config = super(GradientAccumulation, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class AllreduceOptimizer(keras.optimizers.Optimizer):
+    """Wraps a Keras optimizer for data parallel training in several
+    processes. Every step, the gradients of this replica are replaced by
+    their mean over all replicas before the wrapped optimizer applies
+    them, so replicas that start from the same weights stay identical.
+
+    The gradients are flattened into one float32 vector and averaged by a
+    single call of `allreduce` (see nuclei_parallel.Worker.allreduce()),
+    which runs in Python through tf.py_func. The wrapped optimizer clips
+    the mean gradient.
+
+    optimizer: The Keras optimizer to wrap, with its lr, momentum, clipnorm...
+    allreduce: Function of a float32 numpy vector that returns the mean of
+        that vector over all replicas. All replicas must call it each step.
+    """
+
+    def __init__(self, optimizer, allreduce, **kwargs):
+        super(AllreduceOptimizer, self).__init__(**kwargs)
+        self.optimizer = optimizer
+        self.allreduce = allreduce
+        # Callbacks read and set the learning rate of the model optimizer
+        self.lr = optimizer.lr
+        self.iterations = optimizer.iterations
+
+    @interfaces.legacy_get_updates_support
+    def get_updates(self, loss, params):
+        grads = [tf.convert_to_tensor(g) for g in self.get_gradients(loss, params)]
+        sizes = [int(np.prod(K.int_shape(p))) for p in params]
+        flat_grads = tf.concat([K.cast(K.reshape(g, [-1]), 'float32') for g in grads], axis=0)
+        flat_grads = tf.py_func(self.allreduce, [flat_grads], tf.float32, stateful=True,
+                                name="allreduce")
+        flat_grads.set_shape([sum(sizes)])
+        mean_grads = [K.cast(K.reshape(g, K.int_shape(p)), K.dtype(p))
+                      for g, p in zip(tf.split(flat_grads, sizes), params)]
+
+        optimizer = self.optimizer
+        optimizer.get_gradients = lambda loss, params: clip_gradients(mean_grads, optimizer)
+        self.updates = optimizer.get_updates(loss=loss, params=params)
+        self.weights = optimizer.weights
+        return self.updates
+
+    def get_config(self):
+        config = {'optimizer': keras.optimizers.serialize(self.optimizer)}
+        base_config = super(AllreduceOptimizer, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
@@ -1804,6 +2406,12 @@ class MaskRCNN():
         self.config = config
         self.model_dir = model_dir
         self.set_log_dir()
+        # nuclei_parallel.Worker of this replica in multi-process training
+        self.worker = None
+        # Optionally compile the inference graph with XLA
+        self.jit = mode == "inference" and config.XLA_JIT
+        if self.jit:
+            K.set_session(inference_session(jit=True))
         self.keras_model = self.build(mode=mode, config=config)
 
     def build(self, mode, config):
@@ -1821,9 +2429,30 @@ class MaskRCNN():
                             "to avoid fractions when downscaling and upscaling."
                             "For example, use 256, 320, 384, 448, 512, ... etc. ")
 
+        # Heads-only training on cached backbone features (see build_feature_cache())
+        self.from_feature_cache = mode == "training" and bool(config.BACKBONE_FEATURE_CACHE)
+        # Inference on images padded to a multiple of 64 instead of to an
+        # IMAGE_MAX_DIM square. The anchors are an input then, see get_anchors()
+        self.pad64 = mode == "inference" and config.IMAGE_PAD64
+
         # Inputs
-        input_image = KL.Input(
-            shape=config.IMAGE_SHAPE.tolist(), name="input_image")
+        # With IMAGE_UINT8, inference images have 1 (gray) or 3 channels
+        image_dtype = tf.uint8 if config.IMAGE_UINT8 else tf.float32
+        image_channels = None if config.IMAGE_UINT8 and mode == "inference"\
+            else config.IMAGE_SHAPE[2]
+        if self.from_feature_cache:
+            input_features = [KL.Input(shape=shape.tolist(), name="input_" + name)
+                              for name, shape in zip(["C2", "C3", "C4", "C5"],
+                                                     backbone_feature_shapes(config))]
+        elif self.pad64:
+            input_image = KL.Input(
+                shape=[None, None, image_channels], name="input_image", dtype=image_dtype)
+            # Anchors in pixels for the shape of the molded image
+            input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
+        else:
+            input_image = KL.Input(
+                shape=config.IMAGE_SHAPE[:2].tolist() + [image_channels],
+                name="input_image", dtype=image_dtype)
         input_image_meta = KL.Input(shape=[None], name="input_image_meta")
         if mode == "training":
             # RPN GT
@@ -1841,8 +2470,12 @@ class MaskRCNN():
             input_gt_boxes = KL.Input(
                 shape=[None, 4], name="input_gt_boxes", dtype=tf.float32)
             # Normalize coordinates
-            h, w = K.shape(input_image)[1], K.shape(input_image)[2]
-            image_scale = K.cast(K.stack([h, w, h, w], axis=0), tf.float32)
+            if self.from_feature_cache:
+                h, w = config.IMAGE_SHAPE[:2]
+                image_scale = K.constant([h, w, h, w], dtype=tf.float32)
+            else:
+                h, w = K.shape(input_image)[1], K.shape(input_image)[2]
+                image_scale = K.cast(K.stack([h, w, h, w], axis=0), tf.float32)
             gt_boxes = KL.Lambda(lambda x: x / image_scale)(input_gt_boxes)
             # gt_boxes = KL.Lambda(lambda x: norm_boxes_graph(x, K.shape(input_image)[1:3]))(input_gt_boxes)
             # 3. GT Masks (zero padded)
@@ -1861,7 +2494,26 @@ class MaskRCNN():
         # Bottom-up Layers
         # Returns a list of the last layers of each stage, 5 in total.
         # Don't create the thead (stage 5), so we pick the 4th item in the list.
-        _, C2, C3, C4, C5 = resnet_graph(input_image, config.BACKBONE_NAME, stage5=True)
+        # In inference, the BatchNorm layers can be folded into the convs
+        self.fold_bn = mode == "inference" and config.FOLD_BATCH_NORM
+        if self.from_feature_cache:
+            C2, C3, C4, C5 = input_features
+        else:
+            assert config.BACKBONE_NAME in BACKBONES,\
+                "Unknown backbone {}".format(config.BACKBONE_NAME)
+            if config.IMAGE_UINT8:
+                # Cast to float and subtract the mean pixel in the graph.
+                # [h, w, 1] gray images minus the [3] mean pixel broadcast
+                # to [h, w, 3].
+                mean_pixel = config.MEAN_PIXEL.astype(np.float32)
+                molded_image = KL.Lambda(
+                    lambda x: tf.cast(x, tf.float32) - mean_pixel,
+                    output_shape=lambda s: tuple(s[:3]) + (3,),
+                    name="mold_image")(input_image)
+            else:
+                molded_image = input_image
+            _, C2, C3, C4, C5 = BACKBONES[config.BACKBONE_NAME]["graph"](
+                molded_image, config.BACKBONE_NAME, stage5=True, fold_bn=self.fold_bn)
 
         # Top-down Layers
         # TODO: add assert to varify feature map sizes match what's in config
@@ -1918,11 +2570,18 @@ class MaskRCNN():
         # and zero padded.
         proposal_count = config.POST_NMS_ROIS_TRAINING if mode == "training"\
             else config.POST_NMS_ROIS_INFERENCE
-        rpn_rois = ProposalLayer(proposal_count=proposal_count,
-                                 nms_threshold=config.RPN_NMS_THRESHOLD,
-                                 name="ROI",
-                                 anchors=self.anchors,
-                                 config=config)([rpn_class, rpn_bbox])
+        if self.pad64:
+            rpn_rois = ProposalLayer(proposal_count=proposal_count,
+                                     nms_threshold=config.RPN_NMS_THRESHOLD,
+                                     name="ROI",
+                                     anchors=None,
+                                     config=config)([rpn_class, rpn_bbox, input_anchors, input_image])
+        else:
+            rpn_rois = ProposalLayer(proposal_count=proposal_count,
+                                     nms_threshold=config.RPN_NMS_THRESHOLD,
+                                     name="ROI",
+                                     anchors=self.anchors,
+                                     config=config)([rpn_class, rpn_bbox])
 
         if mode == "training":
             # Class ID mask to mark class IDs supported by the dataset the image
@@ -1977,8 +2636,9 @@ class MaskRCNN():
                 [target_mask, target_class_ids, mrcnn_mask])
 
             # Model
-            inputs = [input_image, input_image_meta,
-                      input_rpn_match, input_rpn_bbox, input_gt_class_ids, input_gt_boxes, input_gt_masks]
+            inputs = list(input_features) if self.from_feature_cache else [input_image]
+            inputs += [input_image_meta,
+                       input_rpn_match, input_rpn_bbox, input_gt_class_ids, input_gt_boxes, input_gt_masks]
             if not config.USE_RPN_ROIS:
                 inputs.append(input_rois)
             outputs = [rpn_class_logits, rpn_class, rpn_bbox,
@@ -1987,33 +2647,71 @@ class MaskRCNN():
                        rpn_class_loss, rpn_bbox_loss, class_loss, bbox_loss, mask_loss]
             model = KM.Model(inputs, outputs, name='mask_rcnn')
         else:
+            # Variable image sizes are read from the tensors in the graph
+            image_shape = None if self.pad64 else config.IMAGE_SHAPE
+
             # Network Heads
             # Proposal classifier and BBox regressor heads
             mrcnn_class_logits, mrcnn_class, mrcnn_bbox =\
-                fpn_classifier_graph(rpn_rois, mrcnn_feature_maps, config.IMAGE_SHAPE,
+                fpn_classifier_graph(rpn_rois, mrcnn_feature_maps, image_shape,
                                      config.POOL_SIZE, config.NUM_CLASSES)
 
             # Detections
             # output is [batch, num_detections, (y1, x1, y2, x2, class_id, score)] in image coordinates
-            detections = DetectionLayer(config, name="mrcnn_detection")([rpn_rois, mrcnn_class, mrcnn_bbox, input_image_meta])
-
-            # Convert boxes to normalized coordinates
-            # TODO: let DetectionLayer return normalized coordinates to avoid
-            #       unnecessary conversions
-            h, w = config.IMAGE_SHAPE[:2]
-            detection_boxes = KL.Lambda(
-                lambda x: x[..., :4] / np.array([h, w, h, w]))(detections)
-
-            # Create masks for detections
-            mrcnn_mask = build_fpn_mask_graph(detection_boxes, mrcnn_feature_maps,
-                                              config.IMAGE_SHAPE,
-                                              config.MASK_POOL_SIZE,
-                                              config.NUM_CLASSES)
-
-            model = KM.Model([input_image, input_image_meta],
-                             [detections, mrcnn_class, mrcnn_bbox,
-                                 mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
-                             name='mask_rcnn')
+            assert config.OUTPUT_LEVEL in ["masks", "boxes", "count", "raw"],\
+                "Unknown OUTPUT_LEVEL {}".format(config.OUTPUT_LEVEL)
+            early_exit = config.OUTPUT_LEVEL == "count"
+            detection_inputs = [rpn_rois, mrcnn_class, mrcnn_bbox, input_image_meta]
+            if self.pad64:
+                detection_inputs.append(input_image)
+            if config.OUTPUT_LEVEL == "raw":
+                # Candidates before NMS, whose boxes take the place of the
+                # detections in the mask branch
+                detections = RawDetectionLayer(config, name="mrcnn_raw_detection")(detection_inputs)
+            else:
+                detections = DetectionLayer(config, early_exit=early_exit, name="mrcnn_detection")(
+                    detection_inputs)
+
+            inputs = [input_image, input_image_meta]
+            if self.pad64:
+                inputs.append(input_anchors)
+
+            if config.OUTPUT_LEVEL == "count":
+                # Number of detections per image
+                detection_count = KL.Lambda(
+                    lambda x: tf.reduce_sum(tf.to_int32(x[..., 4] > 0), axis=1),
+                    output_shape=lambda s: s[:1], name="mrcnn_detection_count")(detections)
+                model = KM.Model(inputs, detection_count, name='mask_rcnn')
+            elif config.OUTPUT_LEVEL == "boxes":
+                # No mask branch and no intermediate outputs
+                model = KM.Model(inputs, detections, name='mask_rcnn')
+            else:
+                # Convert boxes to normalized coordinates
+                # TODO: let DetectionLayer return normalized coordinates to avoid
+                #       unnecessary conversions
+                if self.pad64:
+                    def normalize(x):
+                        shape = tf.to_float(tf.shape(x[1])[1:3])
+                        return x[0][..., :4] / tf.concat([shape, shape], axis=0)
+                    detection_boxes = KL.Lambda(normalize)([detections, input_image])
+                else:
+                    h, w = config.IMAGE_SHAPE[:2]
+                    detection_boxes = KL.Lambda(
+                        lambda x: x[..., :4] / np.array([h, w, h, w]))(detections)
+
+                # Create masks for detections
+                mrcnn_mask = build_fpn_mask_graph(detection_boxes, mrcnn_feature_maps,
+                                                  image_shape,
+                                                  config.MASK_POOL_SIZE,
+                                                  config.NUM_CLASSES)
+
+                if config.OUTPUT_LEVEL == "raw":
+                    model = KM.Model(inputs, [detections, mrcnn_mask], name='mask_rcnn')
+                else:
+                    model = KM.Model(inputs,
+                                     [detections, mrcnn_class, mrcnn_bbox,
+                                         mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
+                                     name='mask_rcnn')
 
         # Add multi-GPU support.
         if config.GPU_COUNT > 1:
@@ -2051,6 +2749,8 @@ class MaskRCNN():
         """Modified version of the correspoding Keras function with
         the addition of multi-GPU support and the ability to exclude
         some layers from loading.
+        filepath: h5 weights file, or an h5 group read the same way, such as
+            nuclei_pool.FrozenWeights
         exclude: list of layer names to exclude
         """
         import h5py
@@ -2058,10 +2758,13 @@ class MaskRCNN():
 
         if exclude:
             by_name = True
+        # A folded backbone has fewer layers than the file, match by name
+        if self.fold_bn:
+            by_name = True
 
         if h5py is None:
             raise ImportError('`load_weights` requires h5py.')
-        f = h5py.File(filepath, mode='r')
+        f = h5py.File(filepath, mode='r') if isinstance(filepath, str) else filepath
         if 'layer_names' not in f.attrs and 'model_weights' in f:
             f = f['model_weights']
 
@@ -2079,11 +2782,45 @@ class MaskRCNN():
             topology.load_weights_from_hdf5_group_by_name(f, layers)
         else:
             topology.load_weights_from_hdf5_group(f, layers)
-        if hasattr(f, 'close'):
-            f.close()
-
-        # Update the log directory
-        self.set_log_dir(filepath)
+        # The BatchNorm layers of a folded backbone are not in the model,
+        # so read them from the file and fold them into the convs
+        if self.fold_bn:
+            self.fold_batch_norms(f, keras_model.inner_model.layers if hasattr(keras_model, "inner_model")
+                                  else keras_model.layers)
+        if isinstance(filepath, str):
+            if hasattr(f, 'close'):
+                f.close()
+
+            # Update the log directory
+            self.set_log_dir(filepath)
+
+    def fold_batch_norms(self, f, layers):
+        """Folds the BatchNorm weights stored in an h5 weights file into
+        the backbone convs. Used by load_weights() when the backbone was
+        built with FOLD_BATCH_NORM.
+        f: open h5 weights group, as in load_weights()
+        layers: the model layers, with the conv weights already loaded
+        """
+        for layer in layers:
+            # conv1 -> bn_conv1, res2a_branch2a -> bn2a_branch2a,
+            # res2a_sep -> bn2a_sep
+            if layer.name == 'conv1':
+                bn_name = 'bn_conv1'
+            elif regex.fullmatch(r'res\d+[a-z]+_(branch\w+|sep)', layer.name):
+                bn_name = 'bn' + layer.name[3:]
+            else:
+                continue
+            if bn_name not in f:
+                continue
+            g = f[bn_name]
+            weight_names = [n.decode('utf8') if hasattr(n, 'decode') else n
+                            for n in g.attrs['weight_names']]
+            gamma, beta, moving_mean, moving_variance = [np.asarray(g[n]) for n in weight_names]
+            # The BN follows the last kernel, the pointwise one of a SeparableConv2D
+            weights = layer.get_weights()
+            weights[-2], weights[-1] = fold_batch_norm(
+                weights[-2], weights[-1], gamma, beta, moving_mean, moving_variance)
+            layer.set_weights(weights)
 
     def get_imagenet_weights(self):
         """Downloads ImageNet trained weights from Keras.
@@ -2109,6 +2846,11 @@ class MaskRCNN():
             optimizer = keras.optimizers.SGD(lr=learning_rate, momentum=momentum, clipnorm=5.0)
         else:
             optimizer = keras.optimizers.adam(lr=learning_rate, clipnorm=5.0)
+        if self.worker is not None:
+            # Average the gradients of the replicas, then accumulate the means
+            optimizer = AllreduceOptimizer(optimizer, self.worker.allreduce)
+        if self.config.GRADIENT_ACCUMULATION_STEPS > 1:
+            optimizer = GradientAccumulation(optimizer, self.config.GRADIENT_ACCUMULATION_STEPS)
         # Add Losses
         # First, clear previously set losses to avoid duplication
         self.keras_model._losses = []
@@ -2179,6 +2921,16 @@ class MaskRCNN():
                 log("{}{:20}   ({})".format(" " * indent, layer.name,
                                             layer.__class__.__name__))
 
+    def set_worker(self, worker):
+        """Makes this model one replica of a multi-process data parallel
+        training. train() then starts from the weights of the chief replica,
+        averages the gradients of all replicas each step, and only the chief
+        writes logs and checkpoints. See nuclei_parallel.
+
+        worker: nuclei_parallel.Worker of this process
+        """
+        self.worker = worker
+
     def set_log_dir(self, model_path=None):
         """Sets the model log directory and epoch counter.
 
@@ -2236,7 +2988,7 @@ class MaskRCNN():
         layer_regex = {
             # all layers but the backbone
             "heads": r"(mrcnn\_.*)|(rpn\_.*)|(fpn\_.*)",
-            # From a specific Resnet stage and up
+            # From a specific backbone stage and up
             "3+": r"(res3.*)|(bn3.*)|(res4.*)|(bn4.*)|(res5.*)|(bn5.*)|(mrcnn\_.*)|(rpn\_.*)|(fpn\_.*)",
             "4+": r"(res4.*)|(bn4.*)|(res5.*)|(bn5.*)|(mrcnn\_.*)|(rpn\_.*)|(fpn\_.*)",
             "5+": r"(res5.*)|(bn5.*)|(mrcnn\_.*)|(rpn\_.*)|(fpn\_.*)",
@@ -2247,26 +2999,40 @@ class MaskRCNN():
             layers = layer_regex[layers]
 
         # Data generators
-        train_generator = data_generator(train_dataset, self.config, shuffle=True,
-                                         batch_size=self.config.BATCH_SIZE,
-                                         augment=self.config.AUGMENTATION)
-        val_generator = data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE,
-                                       augment=False)
+        if self.from_feature_cache:
+            # The datasets were rendered into the cache by build_feature_cache()
+            train_generator = feature_cache_generator(
+                os.path.join(self.config.BACKBONE_FEATURE_CACHE, "train"), self.config,
+                shuffle=True, batch_size=self.config.BATCH_SIZE)
+            val_generator = feature_cache_generator(
+                os.path.join(self.config.BACKBONE_FEATURE_CACHE, "val"), self.config,
+                shuffle=True, batch_size=self.config.BATCH_SIZE)
+        else:
+            train_generator = data_generator(train_dataset, self.config, shuffle=True,
+                                             batch_size=self.config.BATCH_SIZE,
+                                             augment=self.config.AUGMENTATION)
+            val_generator = data_generator(val_dataset, self.config, shuffle=True,
+                                           batch_size=self.config.BATCH_SIZE,
+                                           augment=False)
 
         # Callbacks
+        # With several replicas, only the chief logs and writes checkpoints
+        chief = self.worker is None or self.worker.is_chief
         callbacks = [
             keras.callbacks.TensorBoard(log_dir=self.log_dir,
                                         histogram_freq=0, write_graph=True, write_images=False),
             keras.callbacks.ModelCheckpoint(self.checkpoint_path,
                                             verbose=0, save_weights_only=True),
-        ]
+        ] if chief else []
 
         # Train
         log("\nStarting at epoch {}. LR={}\n".format(self.epoch, learning_rate))
         log("Checkpoint Path: {}".format(self.checkpoint_path))
         self.set_trainable(layers)
         self.compile(self.config.OPTIMIZER, learning_rate, self.config.LEARNING_MOMENTUM)
+        # Replicas start from the weights of the chief
+        if self.worker is not None:
+            self.worker.broadcast_weights(self.keras_model)
 
         # Work-around for Windows: Keras fails on Windows when using
         # multiprocessing workers. See discussion here:
@@ -2287,7 +3053,7 @@ class MaskRCNN():
             max_queue_size=100,
             workers=workers,
             use_multiprocessing=True,
-            verbose=1,
+            verbose=1 if chief else 0,
         )
         self.epoch = max(self.epoch, epochs)
 
@@ -2298,7 +3064,9 @@ class MaskRCNN():
             different sizes.
 
         Returns 3 Numpy matricies:
-        molded_images: [N, h, w, 3]. Images resized and normalized.
+        molded_images: [N, h, w, 3]. Images resized and normalized. With
+            IMAGE_UINT8, images resized only, and [N, h, w, 1] if they are
+            all gray.
         image_metas: [N, length of meta data]. Details about each image.
         windows: [N, (y1, x1, y2, x2)]. The portion of the image that has the
             original image (padding excluded).
@@ -2306,6 +3074,8 @@ class MaskRCNN():
         molded_images = []
         image_metas = []
         windows = []
+        # Gray batches are fed as a single channel, the graph broadcasts it
+        gray = self.config.IMAGE_UINT8 and all(utils.is_gray_image(image) for image in images)
         for image in images:
             # Resize image to fit the model expected size
             # TODO: move resizing to mold_image()
@@ -2313,8 +3083,11 @@ class MaskRCNN():
                 image,
                 min_dim=self.config.IMAGE_MIN_DIM,
                 max_dim=self.config.IMAGE_MAX_DIM,
-                padding=self.config.IMAGE_PADDING)
+                padding=self.config.IMAGE_PADDING and not self.pad64,
+                pad64=self.pad64)
             molded_image = mold_image(molded_image, self.config)
+            if gray:
+                molded_image = molded_image[:, :, :1]
             # Build image_meta
             image_meta = compose_image_meta(
                 0, image.shape, window,
@@ -2329,78 +3102,36 @@ class MaskRCNN():
         windows = np.stack(windows)
         return molded_images, image_metas, windows
 
+    def unmold_boxes(self, boxes, image_shape, window):
+        """Translates boxes from the molded image to the original image,
+        see nuclei_utils.unmold_boxes().
+        """
+        return utils.unmold_boxes(boxes, image_shape, window)
+
     def unmold_detections(self, detections, mrcnn_mask, image_shape, window):
         """Reformats the detections of one image from the format of the neural
         network output to a format suitable for use in the rest of the
-        application.
-
-        detections: [N, (y1, x1, y2, x2, class_id, score)]
-        mrcnn_mask: [N, height, width, num_classes]
-        image_shape: [height, width, depth] Original size of the image before resizing
-        window: [y1, x1, y2, x2] Box in the image where the real image is
-                excluding the padding.
-
-        Returns:
-        boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
-        class_ids: [N] Integer class IDs for each bounding box
-        scores: [N] Float probability scores of the class_id
-        masks: [height, width, num_instances] Instance masks
+        application, see nuclei_utils.unmold_detections().
         """
-        # How many detections do we have?
-        # Detections array is padded with zeros. Find the first class_id == 0.
-        zero_ix = np.where(detections[:, 4] == 0)[0]
-        N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[0]
-
-        # Extract boxes, class_ids, scores, and class-specific masks
-        boxes = detections[:N, :4]
-        class_ids = detections[:N, 4].astype(np.int32)
-        scores = detections[:N, 5]
-        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
-
-        # Compute scale and shift to translate coordinates to image domain.
-        h_scale = image_shape[0] / (window[2] - window[0])
-        w_scale = image_shape[1] / (window[3] - window[1])
-        scale = min(h_scale, w_scale)
-        shift = window[:2]  # y, x
-        scales = np.array([scale, scale, scale, scale])
-        shifts = np.array([shift[0], shift[1], shift[0], shift[1]])
-
-        # Translate bounding boxes to image domain
-        boxes = np.multiply(boxes - shifts, scales).astype(np.int32)
-
-        # Filter out detections with zero area. Often only happens in early
-        # stages of training when the network weights are still a bit random.
-        exclude_ix = np.where(
-            (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) <= 0)[0]
-        if exclude_ix.shape[0] > 0:
-            boxes = np.delete(boxes, exclude_ix, axis=0)
-            class_ids = np.delete(class_ids, exclude_ix, axis=0)
-            scores = np.delete(scores, exclude_ix, axis=0)
-            masks = np.delete(masks, exclude_ix, axis=0)
-            N = class_ids.shape[0]
-
-        # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        if self.config.SAVE_PROB_MASK:
-            full_masks_prob = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], image_shape)
-            full_masks.append(full_mask)
-            if self.config.SAVE_PROB_MASK:
-                full_mask_prob = utils.unmold_mask_prob(masks[i], boxes[i], image_shape)
-                full_masks_prob.append(full_mask_prob)
+        return utils.unmold_detections(detections, mrcnn_mask, image_shape, window, self.config)
 
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty((0,) + masks.shape[1:3])
-        if self.config.SAVE_PROB_MASK:
-            full_masks_prob = np.stack(full_masks_prob, axis=-1) \
-                if full_masks_prob else np.empty((0,) + masks.shape[1:3])
-
-        if self.config.SAVE_PROB_MASK:
-            return boxes, class_ids, scores, full_masks, full_masks_prob
-        else:
-            return boxes, class_ids, scores, full_masks
+    def predict(self, inputs):
+        """Runs keras_model.predict() on the inputs. If the XLA_JIT session
+        fails to compile or run the graph, switches to a regular session
+        with the same weights and runs it there.
+        """
+        try:
+            return self.keras_model.predict(inputs, verbose=0)
+        except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError,
+                tf.errors.InternalError) as e:
+            if not self.jit:
+                raise
+            log("XLA JIT failed ({}), using the default executor".format(type(e).__name__))
+            weights = self.keras_model.get_weights()
+            K.set_session(inference_session(jit=False))
+            self.keras_model.set_weights(weights)
+            self.jit = False
+            return self.keras_model.predict(inputs, verbose=0)
 
     def detect(self, images, verbose=0):
         """Runs the detection pipeline.
@@ -2411,9 +3142,15 @@ class MaskRCNN():
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks, or with COMPACT_MASKS an
+            InstanceMasks of the boxes, box-local masks and probabilities
+        masks_prob: [H, W, N] mask probabilities, with SAVE_PROB_MASK only
+            and without COMPACT_MASKS
+        With OUTPUT_LEVEL "boxes" the dicts have no masks, and with "count"
+        they only hold count: the number of detections.
         """
         assert self.mode == "inference", "Create model in inference mode."
+        assert self.config.OUTPUT_LEVEL != "raw", "Use detect_raw() with OUTPUT_LEVEL raw"
         assert len(
             images) == self.config.BATCH_SIZE, "len(images) must be equal to BATCH_SIZE"
 
@@ -2426,36 +3163,210 @@ class MaskRCNN():
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
+        inputs = self.model_inputs(molded_images, image_metas)
         # Run object detection
+        if self.config.OUTPUT_LEVEL == "count":
+            counts = self.predict(inputs)
+            return [{"count": int(count)} for count in counts]
+        if self.config.OUTPUT_LEVEL == "boxes":
+            detections = self.predict(inputs)
+            return [self.unmold_result(detections[i], None, image.shape, windows[i])
+                    for i, image in enumerate(images)]
         detections, mrcnn_class, mrcnn_bbox, mrcnn_mask, \
             rois, rpn_class, rpn_bbox =\
-            self.keras_model.predict([molded_images, image_metas], verbose=0)
+            self.predict(inputs)
         # Process detections
         results = []
         for i, image in enumerate(images):
-            if self.config.SAVE_PROB_MASK:
-                final_rois, final_class_ids, final_scores, final_masks, final_masks_prob = \
-                    self.unmold_detections(detections[i], mrcnn_mask[i],
-                                           image.shape, windows[i])
-                results.append({
-                    "rois": final_rois,
-                    "class_ids": final_class_ids,
-                    "scores": final_scores,
-                    "masks": utils.deoverlap_masks(final_masks),
-                    "masks_prob": final_masks_prob,
-                })
+            results.append(self.unmold_result(detections[i], mrcnn_mask[i],
+                                              image.shape, windows[i]))
+        return results
+
+    def model_inputs(self, molded_images, image_metas):
+        """Inputs of keras_model for a batch of molded images, with their
+        anchors if IMAGE_PAD64.
+        """
+        inputs = [molded_images, image_metas]
+        if self.pad64:
+            # All images in a batch MUST be of the same size
+            image_shape = molded_images[0].shape
+            for g in molded_images[1:]:
+                assert g.shape == image_shape,\
+                    "After padding, all images in a batch must have the same size."
+            anchors = self.get_anchors(image_shape)
+            # Duplicate across the batch dimension because Keras requires it
+            inputs.append(np.broadcast_to(anchors, (len(molded_images),) + anchors.shape))
+        return inputs
+
+    def detect_raw(self, images):
+        """Runs the network up to the final NMS, for the cache of
+        nuclei_sweep. Needs OUTPUT_LEVEL "raw". replay_raw() then gives the
+        detect() result of an image under any DETECTION_* settings with
+        DETECTION_MIN_CONFIDENCE at least RAW_MIN_CONFIDENCE, provided
+        RAW_MAX_ROIS keeps every candidate that clears it (as the default,
+        POST_NMS_ROIS_INFERENCE, does). Otherwise the NMS of the replay only
+        sees the RAW_MAX_ROIS best candidates and may drop instances that
+        detect() keeps. With PROB_MASK_DTYPE "uint8" the masks may differ
+        in the pixels whose probability rounds across the threshold.
+
+        images: List of images, len(images) must be equal to BATCH_SIZE.
+
+        Returns a list of dicts, one dict per image. The dict contains:
+        boxes: [N, (y1, x1, y2, x2)] int32 refined boxes in pixels of the
+            molded image, best first
+        probs: [N, num_classes] float32 class probabilities
+        masks: [N, height, width] mask of the top class of each box, as
+            PROB_MASK_DTYPE (uint8 probability * 255 or float16)
+        image_shape: shape of the image
+        window: [y1, x1, y2, x2] of the image in the molded image
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        assert self.config.OUTPUT_LEVEL == "raw", "Build the model with OUTPUT_LEVEL raw"
+        assert len(
+            images) == self.config.BATCH_SIZE, "len(images) must be equal to BATCH_SIZE"
+        molded_images, image_metas, windows = self.mold_inputs(images)
+        raw, mrcnn_mask = self.predict(self.model_inputs(molded_images, image_metas))
+        results = []
+        for i, image in enumerate(images):
+            # Padding rows have no class probabilities
+            N = int(np.count_nonzero(raw[i, :, 4:].sum(axis=1) > 0))
+            probs = raw[i, :N, 4:]
+            class_ids = np.argmax(probs, axis=1)
+            masks = mrcnn_mask[i, np.arange(N), :, :, class_ids]
+            if self.config.PROB_MASK_DTYPE == "uint8":
+                masks = np.round(masks * 255).astype(np.uint8)
             else:
-                final_rois, final_class_ids, final_scores, final_masks =\
-                    self.unmold_detections(detections[i], mrcnn_mask[i],
-                                           image.shape, windows[i])
+                masks = masks.astype(self.config.PROB_MASK_DTYPE)
+            results.append({
+                "boxes": raw[i, :N, :4].astype(np.int32),
+                "probs": probs.astype(np.float32),
+                "masks": masks,
+                "image_shape": np.array(image.shape),
+                "window": windows[i],
+            })
+        return results
+
+    def replay_raw(self, raw):
+        """Builds the detect() result dict of one image from its
+        detect_raw() dict under the DETECTION_* settings of the config, see
+        nuclei_utils.replay_raw(). Needs no graph.
+        """
+        return utils.replay_raw(raw, self.config)
+
+    def unmold_result(self, detections, mrcnn_mask, image_shape, window):
+        """Builds the detect() result dict of one image from the outputs of
+        the model for it, see nuclei_utils.unmold_result().
+        """
+        return utils.unmold_result(detections, mrcnn_mask, image_shape, window, self.config)
+
+    def detect_tta(self, images, verbose=0):
+        """Runs the detection pipeline with test-time augmentation. Every
+        image is run under each of the config.TTA_VARIANTS flips and
+        rotations, all in one batch, and the instances found are mapped back
+        and fused (see nuclei_utils.fuse_tta_instances()).
+
+        images: List of images, len(images) * len(TTA_VARIANTS) must be
+            equal to BATCH_SIZE.
+
+        Returns a list of dicts, one dict per image, as detect().
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        assert self.config.OUTPUT_LEVEL == "masks", "TTA fuses the instance masks"
+        variants = self.config.TTA_VARIANTS
+        assert len(images) * len(variants) == self.config.BATCH_SIZE,\
+            "len(images) * len(TTA_VARIANTS) must be equal to BATCH_SIZE"
+        assert not self.pad64, "Variants of non-square images don't share one padded shape"
+
+        # All variants of all images in one batch
+        batch = [utils.tta_transform(image, variant) for image in images for variant in variants]
+        molded_images, image_metas, windows = self.mold_inputs(batch)
+        if verbose:
+            log("Processing {} images with {} variants each".format(len(images), len(variants)))
+            log("molded_images", molded_images)
+        detections, _, _, mrcnn_mask, _, _, _ = self.predict([molded_images, image_metas])
+
+        results = []
+        for i, image in enumerate(images):
+            boxes, class_ids, scores, probs, variant_ids = [], [], [], [], []
+            for v, variant in enumerate(variants):
+                b = i * len(variants) + v
+                zero_ix = np.where(detections[b, :, 4] == 0)[0]
+                N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[1]
+                variant_boxes = self.unmold_boxes(detections[b, :N, :4], batch[b].shape, windows[b])
+                for k in range(N):
+                    y1, x1, y2, x2 = variant_boxes[k]
+                    if y2 <= y1 or x2 <= x1:
+                        continue
+                    class_id = int(detections[b, k, 4])
+                    prob = utils.unmold_mask_box(mrcnn_mask[b, k, :, :, class_id], variant_boxes[k])
+                    box, prob = utils.tta_invert(variant_boxes[k], prob, variant, image.shape)
+                    boxes.append(box)
+                    class_ids.append(class_id)
+                    scores.append(detections[b, k, 5])
+                    probs.append(prob)
+                    variant_ids.append(v)
+            final_rois, final_class_ids, final_scores, final_probs = utils.fuse_tta_instances(
+                np.array(boxes, dtype=np.int32).reshape(-1, 4), np.array(class_ids, dtype=np.int32),
+                np.array(scores, dtype=np.float32), probs, np.array(variant_ids),
+                len(variants), self.config.TTA_IOU_THRESHOLD, self.config.TTA_MIN_VOTES)
+
+            if self.config.COMPACT_MASKS:
+                final_masks = utils.InstanceMasks.from_probs(
+                    final_rois, final_probs, image.shape, keep_probs=self.config.SAVE_PROB_MASK,
+                    prob_dtype=self.config.PROB_MASK_DTYPE,
+                    threshold=self.config.DETECTION_MASK_THRESHOLD)
                 results.append({
                     "rois": final_rois,
                     "class_ids": final_class_ids,
                     "scores": final_scores,
-                    "masks": utils.deoverlap_masks(final_masks),
+                    "masks": final_masks.deoverlap(),
                 })
+                continue
+
+            # Full size masks of the fused instances
+            final_masks = np.zeros(image.shape[:2] + (len(final_scores),), dtype=np.uint8)
+            if self.config.SAVE_PROB_MASK:
+                final_masks_prob = np.zeros(image.shape[:2] + (len(final_scores),))
+            for k, (y1, x1, y2, x2) in enumerate(final_rois):
+                final_masks[y1:y2, x1:x2, k] = final_probs[k] >= self.config.DETECTION_MASK_THRESHOLD
+                if self.config.SAVE_PROB_MASK:
+                    final_masks_prob[y1:y2, x1:x2, k] = final_probs[k]
+            result = {
+                "rois": final_rois,
+                "class_ids": final_class_ids,
+                "scores": final_scores,
+                "masks": utils.deoverlap_masks(final_masks),
+            }
+            if self.config.SAVE_PROB_MASK:
+                result["masks_prob"] = final_masks_prob
+            results.append(result)
         return results
 
+    def get_anchors(self, image_shape):
+        """Returns the anchor pyramid in pixels for the given image shape.
+        The last ANCHOR_CACHE_SIZE shapes are kept, least recently used
+        shapes are dropped first.
+        """
+        if not hasattr(self, "_anchor_cache"):
+            self._anchor_cache = OrderedDict()
+        key = tuple(image_shape[:2])
+        if key in self._anchor_cache:
+            self._anchor_cache.move_to_end(key)
+        else:
+            backbone_shapes = np.array(
+                [[int(math.ceil(image_shape[0] / stride)),
+                  int(math.ceil(image_shape[1] / stride))]
+                 for stride in self.config.BACKBONE_STRIDES])
+            self._anchor_cache[key] = utils.generate_pyramid_anchors(
+                self.config.RPN_ANCHOR_SCALES,
+                self.config.RPN_ANCHOR_RATIOS,
+                backbone_shapes,
+                self.config.BACKBONE_STRIDES,
+                self.config.RPN_ANCHOR_STRIDE).astype(np.float32)
+            while len(self._anchor_cache) > self.config.ANCHOR_CACHE_SIZE:
+                self._anchor_cache.popitem(last=False)
+        return self._anchor_cache[key]
+
     def ancestor(self, tensor, name, checked=None):
         """Finds the ancestor of a TF tensor in the computation graph.
         tensor: TensorFlow symbolic tensor.
@@ -2611,12 +3522,20 @@ def mold_image(images, config):
     """Takes RGB images with 0-255 values and subtraces
     the mean pixel and converts it to float. Expects image
     colors in RGB order.
+    With config.IMAGE_UINT8, only rounds the images to uint8 and leaves
+    the rest to the first layer of the model.
     """
+    if config.IMAGE_UINT8:
+        if images.dtype != np.uint8:
+            images = np.clip(np.round(images), 0, 255)
+        return images.astype(np.uint8)
     return images.astype(np.float32) - config.MEAN_PIXEL
 
 
 def unmold_image(normalized_images, config):
     """Takes a image normalized with mold() and returns the original."""
+    if config.IMAGE_UINT8:
+        return normalized_images.astype(np.uint8)
     return (normalized_images + config.MEAN_PIXEL).astype(np.uint8)
 
 
@@ -0,0 +1,225 @@
+__authors__="Jie Yang and Xinyang Feng"
+
+###########################################
+# Multi-process data parallel training on CPU
+###########################################
+
+# N processes each hold a MaskRCNN replica and train on their own shard of
+# the images. Every step the replicas average their gradients through
+# shared memory (see Worker.allreduce()) and apply the same update, so their
+# weights stay identical. Rank 0 is the chief: it writes the logs and the
+# checkpoints. See MaskRCNN.set_worker() and nuclei_train.py --workers.
+#
+# Scaling curve from 1 to N processes (short runs on the train images):
+#   python nuclei_parallel.py --dir_root . --max_workers 4 --steps 30
+
+import os
+import glob
+import time
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+import numpy as np
+
+###########################################
+# Worker
+###########################################
+
+class Worker(object):
+    """One replica of a data parallel training. Created by launch() and
+    passed to the training function of each process.
+
+    world_size: number of processes
+    barrier: multiprocessing Barrier shared by all processes
+    shm_dir: directory shared by all processes, preferably in /dev/shm,
+        that holds the gradient and weight buffers
+    rank: index of this process, 0 is the chief
+    """
+
+    def __init__(self, world_size, barrier, shm_dir, rank=0):
+        self.world_size = world_size
+        self.barrier = barrier
+        self.shm_dir = shm_dir
+        self.rank = rank
+        self.is_chief = rank == 0
+        # Time of each allreduce call, i.e. one per training step
+        self.step_times = []
+        self.grads = None
+        self.mean = None
+
+    def wait(self):
+        """Blocks until all processes get here."""
+        if self.world_size > 1:
+            self.barrier.wait()
+
+    def init_session(self):
+        """Sets a CPU Keras session that shares the cores among the
+        processes instead of letting each of them use all of them.
+        """
+        import tensorflow as tf
+        import keras.backend as K
+        threads = max(multiprocessing.cpu_count() // self.world_size, 1)
+        config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                inter_op_parallelism_threads=2,
+                                device_count={'GPU': 0})
+        K.set_session(tf.Session(config=config))
+
+    def _open_buffers(self, size):
+        # [world_size, size] gradients, one row per rank, and the [size] mean
+        grads_path = os.path.join(self.shm_dir, 'grads.bin')
+        mean_path = os.path.join(self.shm_dir, 'mean.bin')
+        if self.is_chief:
+            np.memmap(grads_path, np.float32, 'w+', shape=(self.world_size, size)).flush()
+            np.memmap(mean_path, np.float32, 'w+', shape=(size,)).flush()
+        self.wait()
+        self.grads = np.memmap(grads_path, np.float32, 'r+', shape=(self.world_size, size))
+        self.mean = np.memmap(mean_path, np.float32, 'r+', shape=(size,))
+        # Each rank averages one chunk of the vector
+        bounds = np.linspace(0, size, self.world_size + 1).astype(np.int64)
+        self.chunk = slice(bounds[self.rank], bounds[self.rank + 1])
+
+    def allreduce(self, x):
+        """Returns the mean of the float32 vector x over all processes. All
+        processes must call it with vectors of the same size.
+
+        Each rank writes its vector to its row of the shared gradients, then
+        averages its own chunk of the columns into the shared mean (reduce
+        scatter), and all ranks read the whole mean. Two barriers per call.
+        """
+        self.step_times.append(time.time())
+        if self.world_size == 1:
+            return x
+        x = np.asarray(x, np.float32).ravel()
+        if self.grads is None:
+            self._open_buffers(x.size)
+        self.grads[self.rank] = x
+        self.barrier.wait()
+        self.mean[self.chunk] = self.grads[:, self.chunk].mean(axis=0)
+        self.barrier.wait()
+        # A rank only writes its row again after the next first barrier,
+        # when all ranks have read the mean
+        return np.array(self.mean)
+
+    def broadcast_weights(self, keras_model):
+        """Sets the weights of keras_model to the ones of the chief."""
+        if self.world_size == 1:
+            return
+        weights = keras_model.get_weights()
+        size = sum(w.size for w in weights)
+        path = os.path.join(self.shm_dir, 'weights.bin')
+        if self.is_chief:
+            flat = np.memmap(path, np.float32, 'w+', shape=(size,))
+            flat[:] = np.concatenate([w.ravel() for w in weights])
+            flat.flush()
+        self.barrier.wait()
+        if not self.is_chief:
+            flat = np.memmap(path, np.float32, 'r', shape=(size,))
+            offset = 0
+            for k, w in enumerate(weights):
+                weights[k] = flat[offset:offset + w.size].reshape(w.shape).astype(w.dtype)
+                offset += w.size
+            keras_model.set_weights(weights)
+        del flat
+        self.barrier.wait()
+
+###########################################
+# Launcher
+###########################################
+
+def _run(target, worker, args):
+    target(*args, worker=worker)
+
+def launch(target, world_size, args=()):
+    """Runs target(*args, worker=worker) in world_size new processes, each
+    with its own Worker. If a process fails, the others are released from
+    the barriers and an exception is raised once all have exited.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(world_size)
+    shm_dir = tempfile.mkdtemp(prefix='nuclei_parallel_',
+                               dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    processes = [ctx.Process(target=_run, args=(target, Worker(world_size, barrier, shm_dir, rank), args))
+                 for rank in range(world_size)]
+    try:
+        for p in processes:
+            p.start()
+        while any(p.is_alive() for p in processes):
+            if any(p.exitcode not in (None, 0) for p in processes):
+                barrier.abort()
+            time.sleep(1)
+    finally:
+        for p in processes:
+            p.join()
+        shutil.rmtree(shm_dir, ignore_errors=True)
+    failed = [rank for rank, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError("Workers {} failed".format(failed))
+
+###########################################
+# Scaling benchmark
+###########################################
+
+def bench_worker(params, worker=None):
+    # One epoch of params['steps'] steps on a shard of the train images,
+    # the chief saves its step times
+    worker.init_session()
+    import nuclei_model as modellib
+    from nuclei_train import TrainingAllConfig, NucleiDataset
+
+    paths = sorted(glob.glob(os.path.join(params['dir_root'], 'dataset', 'train', '*', 'images', '*.png')))
+    paths = paths[worker.rank::worker.world_size]
+
+    config = TrainingAllConfig(512, 256, params['steps'] * TrainingAllConfig.IMAGES_PER_GPU)
+    config.BACKBONE_NAME = params['backbone']
+    config.GRADIENT_ACCUMULATION_STEPS = 1
+    config.VALIDATION_STEPS = 1
+
+    dataset = NucleiDataset()
+    dataset.add_class("cell", 1, "nulcei")
+    for k, path in enumerate(paths):
+        dataset.add_image("cell", k, path)
+    dataset.prepare()
+
+    model = modellib.MaskRCNN(mode="training", config=config, model_dir=params['out_dir'])
+    model.set_worker(worker)
+    model.train(dataset, dataset, learning_rate=config.LEARNING_RATE, epochs=1, layers="all")
+    if worker.is_chief:
+        np.save(os.path.join(params['out_dir'], 'step_times.npy'), worker.step_times)
+
+def bench_scaling(params):
+    # Images per second of 1 to max_workers processes, from the median step
+    # time after the warmup steps
+    from nuclei_train import TrainingAllConfig
+    out_dir = tempfile.mkdtemp(prefix='nuclei_parallel_bench_')
+    params = dict(params, out_dir=out_dir)
+    results = []
+    try:
+        for world_size in range(1, params['max_workers'] + 1):
+            launch(bench_worker, world_size, args=(params,))
+            step_times = np.load(os.path.join(out_dir, 'step_times.npy'))
+            step = np.median(np.diff(step_times[params['warmup']:]))
+            results.append((world_size, step, TrainingAllConfig.IMAGES_PER_GPU * world_size / step))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    print("{:>8} {:>10} {:>10} {:>8} {:>10}".format(
+        'workers', 'step (ms)', 'images/s', 'speedup', 'efficiency'))
+    for world_size, step, rate in results:
+        speedup = rate / results[0][2]
+        print("{:>8} {:>10.1f} {:>10.2f} {:>8.2f} {:>10.2f}".format(
+            world_size, step * 1000., rate, speedup, speedup / world_size))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dir_root', default='', help='root directory of the project')
+    parser.add_argument('--backbone', default='resnet50', help='backbone network')
+    parser.add_argument('--max_workers', default=max(multiprocessing.cpu_count() // 4, 1), type=int,
+                        help='largest number of processes to time')
+    parser.add_argument('--steps', default=30, type=int, help='training steps per run')
+    parser.add_argument('--warmup', default=5, type=int, help='steps left out of the timing')
+
+    args = parser.parse_args()
+    bench_scaling(vars(args))
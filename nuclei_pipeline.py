@@ -0,0 +1,274 @@
+__authors__="Jie Yang and Xinyang Feng"
+
+###########################################
+# Pipelined inference
+###########################################
+
+# MaskRCNN.detect() reads, molds, predicts and unmolds one batch after the
+# other, so the model waits for the CPU work around it. InferencePipeline
+# runs the stages concurrently, connected by bounded queues:
+#
+#   image source -> readers (threads) -> molders (threads)
+#                -> predict (one thread, batches by molded shape)
+#                -> postprocessing (processes) -> results in input order
+#
+# A full queue blocks the stage before it, so memory stays bounded however
+# long the image source is.
+
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+import numpy as np
+import nuclei_utils as utils
+
+# Ends a stream between stages
+_DONE = object()
+
+###########################################
+# Postprocessing workers
+###########################################
+
+# nuclei_utils.postprocess_config() of the model, in a worker process
+_postprocess_config = None
+
+def _init_postprocess(config):
+    global _postprocess_config
+    _postprocess_config = config
+
+def postprocess(detections, mrcnn_mask, image_shape, window):
+    # MaskRCNN.unmold_result() in a worker process, without nuclei_model
+    return utils.unmold_result(detections, mrcnn_mask, image_shape, window, _postprocess_config)
+
+class _Failure(object):
+    # An exception raised by a stage for one image, re-raised in order
+    def __init__(self, error):
+        self.error = error
+
+###########################################
+# Pipeline
+###########################################
+
+class InferencePipeline(object):
+    """Runs MaskRCNN detection on a stream of images with the reading,
+    molding, prediction and postprocessing of different images overlapped.
+
+    model: MaskRCNN in inference mode, OUTPUT_LEVEL "masks" or "boxes"
+    readers: threads reading image files
+    molders: threads resizing and normalizing images
+    postprocessors: processes unmolding the masks, 0 to unmold in the
+        predict thread
+    queue_size: capacity of each queue between stages, in images
+    max_pending: most molded images the predict stage holds while waiting
+        for a full batch of their shape, 4 * BATCH_SIZE by default
+    """
+
+    def __init__(self, model, readers=4, molders=2, postprocessors=None,
+                 queue_size=None, max_pending=None):
+        assert model.mode == "inference", "Create model in inference mode."
+        assert model.config.OUTPUT_LEVEL in ["masks", "boxes"]
+        import tensorflow as tf
+        self.model = model
+        self.batch_size = model.config.BATCH_SIZE
+        self.readers = readers
+        self.molders = molders
+        self.queue_size = queue_size or 4 * self.batch_size
+        self.max_pending = max_pending or 4 * self.batch_size
+        if postprocessors is None:
+            postprocessors = max(multiprocessing.cpu_count() // 2, 1)
+        # Spawned, the workers don't inherit the TensorFlow runtime, and
+        # with a plain copy of the config they don't import it either
+        config = utils.postprocess_config(model.config)
+        self.pool = ProcessPoolExecutor(
+            postprocessors, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_postprocess, initargs=(config,)) if postprocessors else None
+        # Keras predicts from other threads with the graph made default there
+        # and the predict function built beforehand
+        self.graph = tf.get_default_graph()
+        model.keras_model._make_predict_function()
+        # Seconds spent in predict() during the last run
+        self.predict_time = 0.
+
+    def close(self):
+        """Shuts the postprocessing processes down."""
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _feed(self, image_source, read_q, mold_q, batch_q, stop):
+        # Hands out the images, then closes the stages one after the other
+        readers = [self._start(self._read, read_q, mold_q, stop) for _ in range(self.readers)]
+        molders = [self._start(self._mold, mold_q, batch_q, stop) for _ in range(self.molders)]
+        count = 0
+        try:
+            for image in image_source:
+                if stop.is_set():
+                    break
+                read_q.put((count, image))
+                count += 1
+        except Exception as e:
+            # The error of the image source comes out after its last image
+            read_q.put((count, _Failure(e)))
+        finally:
+            for _ in readers:
+                read_q.put(_DONE)
+            for thread in readers:
+                thread.join()
+            for _ in molders:
+                mold_q.put(_DONE)
+            for thread in molders:
+                thread.join()
+            batch_q.put(_DONE)
+
+    # Once stop is set, each stage drops what it gets until its _DONE, so
+    # the stage before it never blocks on a full queue
+
+    def _read(self, read_q, mold_q, stop):
+        while True:
+            item = read_q.get()
+            if item is _DONE:
+                return
+            if stop.is_set():
+                continue
+            index, image = item
+            try:
+                if isinstance(image, str):
+                    image = utils.read_image(image)
+            except Exception as e:
+                image = _Failure(e)
+            mold_q.put((index, image))
+
+    def _mold(self, mold_q, batch_q, stop):
+        while True:
+            item = mold_q.get()
+            if item is _DONE:
+                return
+            if stop.is_set():
+                continue
+            index, image = item
+            if isinstance(image, _Failure):
+                batch_q.put((index, image))
+                continue
+            try:
+                molded_images, image_metas, windows = self.model.mold_inputs([image])
+                batch_q.put((index, (image.shape, molded_images[0], image_metas[0], windows[0])))
+            except Exception as e:
+                batch_q.put((index, _Failure(e)))
+
+    def _predict(self, batch_q, out_q, stop):
+        # Batches the molded images by shape, runs them and queues a future
+        # of the result of each image
+        with self.graph.as_default():
+            groups = {}
+            pending = 0
+            while True:
+                item = batch_q.get()
+                if item is _DONE:
+                    break
+                if stop.is_set():
+                    continue
+                index, molded = item
+                if isinstance(molded, _Failure):
+                    out_q.put((index, molded))
+                    continue
+                shape = molded[1].shape
+                groups.setdefault(shape, []).append((index, molded))
+                pending += 1
+                if len(groups[shape]) == self.batch_size:
+                    pending -= self._run_group(groups.pop(shape), out_q)
+                elif pending >= self.max_pending:
+                    oldest = min(groups, key=lambda k: groups[k][0][0])
+                    pending -= self._run_group(groups.pop(oldest), out_q)
+            for group in groups.values():
+                if not stop.is_set():
+                    self._run_group(group, out_q)
+        out_q.put(_DONE)
+
+    def _run_group(self, group, out_q):
+        # Predicts a group of same shape images, padded to BATCH_SIZE
+        count = len(group)
+        batch = group + [group[-1]] * (self.batch_size - count)
+        molded_images = np.stack([m[1] for _, m in batch])
+        image_metas = np.stack([m[2] for _, m in batch])
+        inputs = [molded_images, image_metas]
+        if self.model.pad64:
+            anchors = self.model.get_anchors(molded_images.shape[1:])
+            inputs.append(np.broadcast_to(anchors, (self.batch_size,) + anchors.shape))
+        start = time.time()
+        try:
+            outputs = self.model.predict(inputs)
+        except Exception as e:
+            for index, _ in group:
+                out_q.put((index, _Failure(e)))
+            return count
+        self.predict_time += time.time() - start
+        if self.model.config.OUTPUT_LEVEL == "boxes":
+            detections, mrcnn_mask = outputs, None
+        else:
+            detections, mrcnn_mask = outputs[0], outputs[3]
+        for i, (index, (image_shape, _, _, window)) in enumerate(group):
+            # Only the rows of actual detections go to the workers
+            zero_ix = np.where(detections[i, :, 4] == 0)[0]
+            N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[1]
+            args = (detections[i, :N], None if mrcnn_mask is None else mrcnn_mask[i, :N],
+                    image_shape, window)
+            if self.pool is not None:
+                future = self.pool.submit(postprocess, *args)
+            else:
+                future = Future()
+                future.set_result(self.model.unmold_result(*args))
+            out_q.put((index, future))
+        return count
+
+    def run(self, image_source):
+        """Detects the nuclei of each image of image_source, an iterable of
+        images or image file paths.
+
+        Yields one dict per image, in the order of image_source, as
+        MaskRCNN.detect() returns them.
+        """
+        read_q = queue.Queue(self.queue_size)
+        mold_q = queue.Queue(self.queue_size)
+        batch_q = queue.Queue(self.queue_size)
+        out_q = queue.Queue(self.queue_size)
+        self.predict_time = 0.
+        stop = threading.Event()
+        threads = [self._start(self._feed, image_source, read_q, mold_q, batch_q, stop),
+                   self._start(self._predict, batch_q, out_q, stop)]
+
+        # Results that arrive before the ones of earlier images wait here
+        waiting = {}
+        next_index = 0
+        done = False
+        try:
+            while True:
+                item = out_q.get()
+                if item is _DONE:
+                    done = True
+                    break
+                index, result = item
+                waiting[index] = result
+                while next_index in waiting:
+                    result = waiting.pop(next_index)
+                    if isinstance(result, _Failure):
+                        raise result.error
+                    yield result.result()
+                    next_index += 1
+        finally:
+            # Stopped by an error or by the caller: the stages drop the
+            # images left and end, so the next run starts clean
+            stop.set()
+            while not done:
+                item = out_q.get()
+                done = item is _DONE
+                if isinstance(item, tuple) and isinstance(item[1], Future):
+                    item[1].cancel()
+            for thread in threads:
+                thread.join()
+        assert not waiting, "Images {} got no result".format(sorted(waiting))
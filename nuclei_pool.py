@@ -0,0 +1,355 @@
+__authors__="Jie Yang and Xinyang Feng"
+
+###########################################
+# Multi-process inference on CPU
+###########################################
+
+# One process running detect() leaves most of a many-core CPU idle: the
+# unmolding holds the GIL and one session gains little from more threads.
+# InferencePool reads the weights file once into a single buffer, then forks
+# N workers, each building the model in its own TensorFlow session limited
+# to its share of the cores. The workers load the weights from the buffer
+# they inherit, whose pages stay shared with the parent as they are only
+# read (the variables of each session are still its own copy). Batches of
+# images are handed out to whichever worker is free and the results come
+# back in input order.
+#
+# The parent must not have created a TensorFlow session before the pool
+# forks: the threads of the runtime don't survive a fork.
+#
+# Scaling curve and memory per worker from 1 to N processes:
+#   python nuclei_pool.py --weights model/mask_rcnn_nuclei_train_0026.h5 --image path/to/image.png --max_workers 4
+
+import os
+import time
+import queue
+import argparse
+import threading
+import traceback
+import multiprocessing
+import numpy as np
+
+###########################################
+# Weights
+###########################################
+
+def _names(names):
+    return [n.decode('utf8') if hasattr(n, 'decode') else n for n in names]
+
+class _Group(object):
+    # One layer of FrozenWeights, read like an h5 group
+    def __init__(self, attrs, arrays):
+        self.attrs = attrs
+        self.arrays = arrays
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+class FrozenWeights(object):
+    """In memory copy of a Keras h5 weights file, all the arrays views of
+    one read-only buffer. MaskRCNN.load_weights() reads it like the file.
+    """
+
+    def __init__(self, path):
+        import h5py
+        with h5py.File(path, mode='r') as h5:
+            f = h5
+            if 'layer_names' not in f.attrs and 'model_weights' in f:
+                f = f['model_weights']
+            self.attrs = dict(f.attrs)
+            layers = [(name, f[name]) for name in _names(self.attrs['layer_names'])]
+            # Each array starts on a 64 byte boundary of the buffer
+            placed = []
+            size = 0
+            for name, g in layers:
+                for weight_name in _names(g.attrs['weight_names']):
+                    d = g[weight_name]
+                    placed.append((name, weight_name, size, d.shape, d.dtype))
+                    size += -(-d.size * d.dtype.itemsize // 64) * 64
+            self.buffer = np.empty(size, dtype=np.uint8)
+            arrays = {name: {} for name, _ in layers}
+            for name, weight_name, offset, shape, dtype in placed:
+                count = int(np.prod(shape))
+                a = self.buffer[offset:offset + count * dtype.itemsize].view(dtype).reshape(shape)
+                if count:
+                    f[name][weight_name].read_direct(a)
+                # Read-only, so the pages are never copied by a worker
+                a.flags.writeable = False
+                arrays[name][weight_name] = a
+            self.layers = {name: _Group(dict(g.attrs), arrays[name]) for name, g in layers}
+        self.buffer.flags.writeable = False
+        self.path = path
+
+    @property
+    def nbytes(self):
+        return self.buffer.nbytes
+
+    def __getitem__(self, name):
+        return self.layers[name]
+
+    def __contains__(self, name):
+        return name in self.layers
+
+###########################################
+# Memory
+###########################################
+
+def memory_usage(pid):
+    """Memory of process pid in bytes, from /proc (Linux): rss, pss (with
+    the pages shared among n processes counted 1/n), private and shared.
+    """
+    path = '/proc/{}/smaps_rollup'.format(pid)
+    if not os.path.exists(path):
+        path = '/proc/{}/smaps'.format(pid)
+    fields = {'Rss': 0, 'Pss': 0, 'Shared_Clean': 0, 'Shared_Dirty': 0,
+              'Private_Clean': 0, 'Private_Dirty': 0}
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in fields:
+                fields[key] += int(value.split()[0]) * 1024
+    return {'rss': fields['Rss'], 'pss': fields['Pss'],
+            'private': fields['Private_Clean'] + fields['Private_Dirty'],
+            'shared': fields['Shared_Clean'] + fields['Shared_Dirty']}
+
+###########################################
+# Workers
+###########################################
+
+def _serve(pool, rank):
+    # Body of a forked worker: builds the model, reports ready, then runs
+    # the batches of the task queue until it gets None
+    os.environ["OMP_NUM_THREADS"] = str(pool.threads)
+    try:
+        import tensorflow as tf
+        import keras.backend as K
+        import nuclei_model as modellib
+        import nuclei_utils as utils
+        session_config = tf.ConfigProto(intra_op_parallelism_threads=pool.threads,
+                                        inter_op_parallelism_threads=1,
+                                        device_count={'GPU': 0})
+        K.set_session(tf.Session(config=session_config))
+        model = modellib.MaskRCNN(mode="inference", config=pool.config, model_dir=pool.model_dir)
+        model.load_weights(pool.weights, by_name=True)
+        # The first call builds the predict function
+        dim = pool.config.IMAGE_MIN_DIM
+        model.detect([np.zeros((dim, dim, 3), dtype=np.uint8)] * pool.config.BATCH_SIZE)
+    except Exception:
+        pool.result_q.put((rank, None, traceback.format_exc()))
+        return
+    pool.result_q.put((rank, None, None))
+
+    while True:
+        batch = pool.task_q.get()
+        if batch is None:
+            return
+        indices = [index for index, _ in batch]
+        try:
+            images = [utils.read_image(image) if isinstance(image, str) else image for _, image in batch]
+            # The last batch is filled up with copies of its last image
+            images += images[-1:] * (pool.config.BATCH_SIZE - len(images))
+            results = model.detect(images)[:len(indices)]
+            pool.result_q.put((indices, results, None))
+        except Exception:
+            pool.result_q.put((indices, None, traceback.format_exc()))
+
+###########################################
+# Pool
+###########################################
+
+class InferencePool(object):
+    """Runs MaskRCNN.detect() in forked worker processes.
+
+    config: inference config, the workers build the model from it
+    weights_path: h5 weights, read once by the pool
+    workers: number of processes
+    threads: TensorFlow threads of each worker, the cores shared evenly
+        among the workers by default
+    max_pending: most batches handed out and not collected yet,
+        2 * workers by default
+    model_dir: log directory of the models
+    """
+
+    def __init__(self, config, weights_path, workers=2, threads=None, max_pending=None,
+                 model_dir='logs'):
+        self.config = config
+        self.weights = FrozenWeights(weights_path)
+        self.workers = workers
+        self.threads = threads or max(multiprocessing.cpu_count() // workers, 1)
+        self.max_pending = max_pending or 2 * workers
+        self.model_dir = model_dir
+        ctx = multiprocessing.get_context('fork')
+        self.task_q = ctx.Queue()
+        self.result_q = ctx.Queue()
+        self.processes = [ctx.Process(target=_serve, args=(self, rank)) for rank in range(workers)]
+        for p in self.processes:
+            p.daemon = True
+            p.start()
+        # Waits for all the workers to load the model
+        started = 0
+        while started < workers:
+            item = self._get()
+            if item is None:
+                continue
+            rank, _, error = item
+            if error is not None:
+                self.close()
+                raise RuntimeError("Worker {} failed to start:\n{}".format(rank, error))
+            started += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _get(self):
+        # A message of the workers, None after a second without any
+        try:
+            return self.result_q.get(timeout=1)
+        except queue.Empty:
+            dead = [rank for rank, p in enumerate(self.processes) if p.exitcode is not None]
+            if dead:
+                raise RuntimeError("Workers {} exited".format(dead))
+            return None
+
+    def close(self):
+        """Stops the workers."""
+        for p in self.processes:
+            if p.is_alive():
+                self.task_q.put(None)
+        for p in self.processes:
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+
+    def memory(self):
+        """memory_usage() of each worker."""
+        return [memory_usage(p.pid) for p in self.processes]
+
+    def run(self, image_source):
+        """Detects the nuclei of each image of image_source, an iterable of
+        images or image file paths, in batches of BATCH_SIZE.
+
+        Yields one dict per image, in the order of image_source, as
+        MaskRCNN.detect() returns them.
+        """
+        slots = threading.Semaphore(self.max_pending)
+        fed = {"batches": 0, "done": False, "error": None, "stop": False}
+
+        def feed():
+            batch = []
+            try:
+                for item in enumerate(image_source):
+                    if fed["stop"]:
+                        return
+                    batch.append(item)
+                    if len(batch) == self.config.BATCH_SIZE:
+                        slots.acquire()
+                        self.task_q.put(batch)
+                        fed["batches"] += 1
+                        batch = []
+                if batch and not fed["stop"]:
+                    slots.acquire()
+                    self.task_q.put(batch)
+                    fed["batches"] += 1
+            except Exception as e:
+                fed["error"] = e
+            finally:
+                fed["done"] = True
+
+        thread = threading.Thread(target=feed)
+        thread.daemon = True
+        thread.start()
+
+        # Results that arrive before the ones of earlier images wait here
+        waiting = {}
+        next_index = 0
+        collected = 0
+        try:
+            while not (fed["done"] and collected == fed["batches"]):
+                item = self._get()
+                if item is None:
+                    continue
+                indices, results, error = item
+                collected += 1
+                slots.release()
+                for k, index in enumerate(indices):
+                    waiting[index] = error if error is not None else results[k]
+                while next_index in waiting:
+                    result = waiting.pop(next_index)
+                    if isinstance(result, str):
+                        raise RuntimeError("Image {} failed:\n{}".format(next_index, result))
+                    yield result
+                    next_index += 1
+        finally:
+            # Stopped early: the batches already handed out are collected
+            # and dropped, so that the next run starts clean
+            fed["stop"] = True
+            while not (fed["done"] and collected == fed["batches"]):
+                if self._get() is not None:
+                    collected += 1
+                    slots.release()
+        thread.join()
+        if fed["error"] is not None:
+            raise fed["error"]
+        assert not waiting, "Images {} got no result".format(sorted(waiting))
+
+###########################################
+# Scaling benchmark
+###########################################
+
+def bench_scaling(params):
+    # Images per second and memory per worker of 1 to max_workers
+    # processes, the cores shared evenly among them
+    from nuclei_config import Config
+
+    class PoolBenchmarkConfig(Config):
+        NAME = "nuclei_pool"
+        NUM_CLASSES = 1 + 1
+        IMAGES_PER_GPU = 1
+        RPN_ANCHOR_SCALES = (8, 16, 32, 64, 128)
+        SAVE_PROB_MASK = False
+        COMPACT_MASKS = True
+
+    config = PoolBenchmarkConfig(params['image_dim'], params['image_dim'] // 2, 1)
+    config.IMAGES_PER_GPU = config.BATCH_SIZE = params['batch_size']
+    paths = [params['image']] * params['count']
+    results = []
+    for workers in range(1, params['max_workers'] + 1):
+        with InferencePool(config, params['weights'], workers=workers) as pool:
+            weights_mb = pool.weights.nbytes / 2. ** 20
+            list(pool.run(paths[:workers * config.BATCH_SIZE]))
+            start = time.time()
+            for _ in pool.run(paths):
+                pass
+            rate = len(paths) / (time.time() - start)
+            memory = pool.memory()
+        results.append((workers, pool.threads, rate, memory))
+
+    print("weights buffer {:.1f} MB".format(weights_mb))
+    print("{:>8} {:>8} {:>10} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+        'workers', 'threads', 'images/s', 'speedup', 'efficiency', 'pss (MB)', 'priv (MB)', 'shrd (MB)'))
+    for workers, threads, rate, memory in results:
+        speedup = rate / results[0][2]
+        mean = {key: np.mean([m[key] for m in memory]) / 2. ** 20 for key in memory[0]}
+        print("{:>8} {:>8} {:>10.2f} {:>8.2f} {:>10.2f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            workers, threads, rate, speedup, speedup / workers, mean['pss'], mean['private'], mean['shared']))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--weights', required=True, help='h5 weights of the model')
+    parser.add_argument('--image', required=True, help='image to run')
+    parser.add_argument('--image_dim', default=512, type=int, help='IMAGE_MAX_DIM of the model')
+    parser.add_argument('--batch_size', default=1, type=int, help='images per detect() call')
+    parser.add_argument('--count', default=64, type=int, help='images per timed run')
+    parser.add_argument('--max_workers', default=max(multiprocessing.cpu_count() // 4, 1), type=int,
+                        help='largest number of processes to time')
+
+    args = parser.parse_args()
+    bench_scaling(vars(args))
@@ -0,0 +1,256 @@
+__authors__="Jie Yang and Xinyang Feng"
+
+###########################################
+# Run-length encoding of instance masks
+###########################################
+
+# Both submission formats count pixels in column-major order:
+#   Kaggle: "start length start length ...", 1-based starts of the runs of 1
+#   COCO:   {"size": [H, W], "counts": ...}, alternating lengths of the runs
+#           of 0 and 1, compressed to a string as pycocotools does
+# The encoders find the runs of all the instances of an image at once, from
+# a label map, an InstanceMasks (boxes and box-local masks) or full size
+# [H, W, N] masks, then format them. Only numpy is needed.
+
+import numpy as np
+
+###########################################
+# Runs
+###########################################
+
+def _interleave(starts, ends):
+    return np.stack([starts, ends], axis=1).ravel()
+
+def label_runs(labels, count=None):
+    """Runs of each instance of a [H, W] label map, instance k as k + 1 and
+    background 0, in one pass over the image.
+
+    count: number of instances, the largest label if None
+
+    Returns a list of count (starts, lengths) pairs of int64 arrays, the
+    starts 0-based column-major pixel indices.
+    """
+    flat = np.asarray(labels).T.ravel()
+    if count is None:
+        count = int(flat.max()) if flat.size else 0
+    if not flat.size:
+        return [(np.zeros(0, np.int64), np.zeros(0, np.int64)) for _ in range(count)]
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate([[0], change]).astype(np.int64)
+    lengths = np.diff(np.concatenate([starts, [flat.size]]))
+    values = flat[starts]
+    # Runs grouped by instance, each group in pixel order
+    keep = (values > 0) & (values <= count)
+    starts, lengths, values = starts[keep], lengths[keep], values[keep]
+    order = np.argsort(values, kind='stable')
+    bounds = np.searchsorted(values[order], np.arange(1, count + 2))
+    return [(starts[order[b0:b1]], lengths[order[b0:b1]])
+            for b0, b1 in zip(bounds[:-1], bounds[1:])]
+
+def instance_runs(boxes, masks, height):
+    """Runs of instances given as boxes and box-local bool masks, as
+    label_runs(). Instances may overlap. height is the image height.
+    """
+    result = []
+    for (y1, x1, y2, x2), mask in zip(boxes, masks):
+        # Runs along the columns of the crop
+        m = np.zeros((x2 - x1, y2 - y1 + 2), dtype=np.int8)
+        m[:, 1:-1] = np.asarray(mask).T
+        d = np.diff(m, axis=1)
+        start_cols, start_rows = np.nonzero(d == 1)
+        end_cols, end_rows = np.nonzero(d == -1)
+        starts = (x1 + start_cols).astype(np.int64) * height + y1 + start_rows
+        ends = (x1 + end_cols).astype(np.int64) * height + y1 + end_rows
+        if len(starts):
+            # A run that reaches the bottom of the image goes on in the next column
+            joined = starts[1:] == ends[:-1]
+            starts = starts[np.concatenate([[True], ~joined])]
+            ends = ends[np.concatenate([~joined, [True]])]
+        result.append((starts, ends - starts))
+    return result
+
+def dense_runs(masks, threshold=0.5):
+    """Runs of full size [H, W, N] masks, pixels above threshold, as
+    label_runs(). Instances may overlap. Each mask is only read inside its
+    box, the boxes of all of them found in one pass.
+    """
+    on = masks > threshold
+    rows = on.any(axis=1)
+    cols = on.any(axis=0)
+    boxes, crops = [], []
+    for i in range(on.shape[2]):
+        ys = np.flatnonzero(rows[:, i])
+        xs = np.flatnonzero(cols[:, i])
+        if not len(ys):
+            boxes.append((0, 0, 0, 0))
+            crops.append(np.zeros((0, 0), dtype=bool))
+            continue
+        y1, y2, x1, x2 = ys[0], ys[-1] + 1, xs[0], xs[-1] + 1
+        boxes.append((y1, x1, y2, x2))
+        crops.append(on[y1:y2, x1:x2, i])
+    return instance_runs(boxes, crops, on.shape[0])
+
+def mask_runs(mask):
+    """(starts, lengths) of the runs of one [H, W] bool mask."""
+    return label_runs(np.asarray(mask, dtype=bool).view(np.uint8), 1)[0]
+
+def runs(masks):
+    """Runs of each instance and the (height, width) of the image, from a
+    [H, W] label map, an InstanceMasks or [H, W, N] masks.
+    """
+    if hasattr(masks, 'boxes'):
+        shape = tuple(masks.image_shape[:2])
+        return instance_runs(masks.boxes, masks.masks, shape[0]), shape
+    masks = np.asarray(masks)
+    if masks.ndim == 2:
+        return label_runs(masks), masks.shape
+    assert masks.ndim == 3, "Masks must be [H, W] labels or [H, W, N]"
+    return dense_runs(masks), masks.shape[:2]
+
+###########################################
+# Formats
+###########################################
+
+def kaggle_string(starts, lengths):
+    """"start length ..." with 1-based starts."""
+    return " ".join(map(str, _interleave(starts + 1, lengths).tolist()))
+
+def coco_counts(starts, lengths, size):
+    """Uncompressed COCO counts of one instance of an image of size pixels:
+    alternating run lengths of 0 and 1, starting with 0.
+    """
+    if not len(starts):
+        return np.array([size], dtype=np.int64)
+    ends = starts + lengths
+    zeros = starts - np.concatenate([[0], ends[:-1]])
+    counts = _interleave(zeros, lengths)
+    if ends[-1] < size:
+        counts = np.append(counts, size - ends[-1])
+    return counts
+
+def coco_strings(counts_list):
+    """Compresses a list of COCO counts arrays to strings, as pycocotools'
+    rleToString: each count, less the count two before it from the fourth
+    on, in 5 bit groups from the lowest, 0x20 marking that more follow,
+    plus 48. All the counts are compressed together.
+    """
+    if not counts_list:
+        return []
+    values = []
+    for counts in counts_list:
+        counts = np.asarray(counts, dtype=np.int64)
+        delta = counts.copy()
+        delta[3:] -= counts[1:-2]
+        values.append(delta)
+    sizes = [len(v) for v in values]
+    x = np.concatenate(values)
+    # [n, 8] groups, enough for counts below 2 ** 39
+    shifts = 5 * np.arange(8)
+    groups = (x[:, None] >> shifts) & 0x1f
+    rest = x[:, None] >> (shifts + 5)
+    more = np.where(groups & 0x10, rest != -1, rest != 0)
+    # Groups up to the first without more
+    used = np.cumsum(~more, axis=1) - ~more == 0
+    chars = (groups | np.where(more, 0x20, 0)) + 48
+    encoded = chars[used].astype(np.uint8).tobytes().decode('ascii')
+    # Characters per instance
+    per_value = used.sum(axis=1)
+    bounds = np.concatenate([[0], np.cumsum(np.add.reduceat(per_value, np.cumsum([0] + sizes[:-1])))])
+    return [encoded[b0:b1] for b0, b1 in zip(bounds[:-1], bounds[1:])]
+
+def encode(masks):
+    """COCO RLE dicts and Kaggle strings of all the instances of an image,
+    from one run finding pass. See runs() for masks.
+
+    Returns (coco, kaggle): a list of {"size": [H, W], "counts": str}, as
+    pycocotools.mask.encode() gives with the counts decoded, and a list of
+    "start length ..." strings.
+    """
+    found, shape = runs(masks)
+    return _coco(found, shape), [kaggle_string(s, l) for s, l in found]
+
+def _coco(found, shape):
+    size = shape[0] * shape[1]
+    strings = coco_strings([coco_counts(s, l, size) for s, l in found])
+    return [{"size": [int(shape[0]), int(shape[1])], "counts": c} for c in strings]
+
+def encode_coco(masks):
+    """COCO RLE dicts only, see encode()."""
+    return _coco(*runs(masks))
+
+def encode_kaggle(masks):
+    """Kaggle strings only, see encode()."""
+    return [kaggle_string(s, l) for s, l in runs(masks)[0]]
+
+###########################################
+# Decoding
+###########################################
+
+def _fill(starts, ends, shape):
+    # [H, W] bool mask with the column-major runs [starts, ends) set, in
+    # time proportional to the foreground
+    lengths = ends - starts
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    flat = np.zeros(shape[0] * shape[1], dtype=bool)
+    flat[np.repeat(starts, lengths) + offsets] = True
+    return flat.reshape(shape[1], shape[0]).T
+
+def decode_kaggle(rle, shape):
+    """[H, W] bool mask of a Kaggle RLE, a "start length ..." string or a
+    sequence of numbers.
+    """
+    if isinstance(rle, str):
+        rle = rle.split()
+    pairs = np.asarray(rle, dtype=np.int64).reshape(-1, 2)
+    starts = pairs[:, 0] - 1
+    return _fill(starts, starts + pairs[:, 1], shape)
+
+def decode_kaggle_labels(rles, shape):
+    """[H, W] int32 label map of a list of Kaggle RLEs, instance k as k + 1
+    and background 0, where they overlap the later one. One image is made
+    for all of them, instead of one per instance.
+    """
+    flat = np.zeros(shape[0] * shape[1], dtype=np.int32)
+    for k, rle in enumerate(rles):
+        if isinstance(rle, str):
+            rle = rle.split()
+        pairs = np.asarray(rle, dtype=np.int64).reshape(-1, 2)
+        lengths = pairs[:, 1]
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        flat[np.repeat(pairs[:, 0] - 1, lengths) + offsets] = k + 1
+    return flat.reshape(shape[1], shape[0]).T
+
+def coco_string_counts(string):
+    """Uncompressed counts of a compressed COCO counts string or bytes."""
+    if isinstance(string, str):
+        string = string.encode('ascii')
+    c = np.frombuffer(string, dtype=np.uint8).astype(np.int64) - 48
+    if not len(c):
+        return np.zeros(0, dtype=np.int64)
+    last = np.flatnonzero((c & 0x20) == 0)
+    first = np.concatenate([[0], last[:-1] + 1])
+    # Position of each group in its value
+    k = np.arange(len(c)) - np.repeat(first, last - first + 1)
+    x = np.add.reduceat((c & 0x1f) << (5 * k), first)
+    # Sign extension from the last group
+    negative = (c[last] & 0x10) != 0
+    x[negative] |= -1 << (5 * (k[last][negative] + 1))
+    counts = x.copy()
+    if len(x) > 3:
+        counts[3::2] = np.cumsum(x[3::2]) + x[1]
+    if len(x) > 4:
+        counts[4::2] = np.cumsum(x[4::2]) + x[2]
+    return counts
+
+def decode_coco(rle):
+    """[H, W] bool mask of a COCO RLE dict, with compressed ("counts" a
+    string or bytes) or uncompressed (a list) counts.
+    """
+    shape = rle["size"]
+    counts = rle["counts"]
+    if isinstance(counts, (str, bytes)):
+        counts = coco_string_counts(counts)
+    bounds = np.cumsum(np.asarray(counts, dtype=np.int64))
+    starts = bounds[0:-1:2]
+    ends = bounds[1::2]
+    return _fill(starts, ends, shape)
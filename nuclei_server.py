@@ -0,0 +1,409 @@
+__authors__="Jie Yang and Xinyang Feng"
+
+###########################################
+# HTTP inference server
+###########################################
+
+# Serves MaskRCNN detection over HTTP with the standard library only. The
+# model is loaded and warmed up once. Each request is molded in its own
+# handler thread and queued; one thread gathers the queued images into
+# batches of the same molded shape (with IMAGE_PAD64 images of different
+# sizes are padded to different shapes) and runs a batch as soon as it
+# holds BATCH_SIZE images or its oldest image has waited max_wait_ms. The
+# unmolding and the RLE encoding of the masks are done back in the handler
+# threads.
+#
+#   POST /detect[?format=kaggle|coco]  image file (PNG, JPEG, ...) or .npy
+#       -> {"image_shape", "rois", "class_ids", "scores", "masks"}
+#   GET  /metrics  queue depth, batch sizes and latency percentiles
+#   GET  /health
+#
+#   python nuclei_server.py serve --weights model/mask_rcnn_nuclei_train_0026.h5 --batch_size 4 --port 8000
+#   python nuclei_server.py load --url http://localhost:8000 --image path/to/image.png --concurrency 1 4 16
+
+import io
+import json
+import time
+import queue
+import argparse
+import itertools
+import threading
+import collections
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from urllib.request import Request, urlopen
+import numpy as np
+import nuclei_utils as utils
+import nuclei_rle
+
+###########################################
+# Batching
+###########################################
+
+# One queued image
+_Request = collections.namedtuple('_Request', ['molded_image', 'image_meta', 'window',
+                                               'image_shape', 'arrival', 'future'])
+
+def percentiles(values, qs=(50, 90, 99)):
+    """{"p50": ..., ...} of values in milliseconds, None if there are none."""
+    if not len(values):
+        return {'p{}'.format(q): None for q in qs}
+    return {'p{}'.format(q): float(v) for q, v in zip(qs, np.percentile(np.asarray(values) * 1000., qs))}
+
+class BatchingDetector(object):
+    """Runs MaskRCNN detection on images submitted one by one from any
+    number of threads, batched together.
+
+    model: MaskRCNN in inference mode, OUTPUT_LEVEL "masks" or "boxes"
+    max_wait_ms: longest an image waits for its batch to fill up
+    warmup_shapes: (height, width) of the images run once at start, so
+        the first requests don't pay for building the predict function
+        (and with IMAGE_PAD64, for each new shape)
+    window: number of the latest requests the latency percentiles are
+        computed from
+    """
+
+    def __init__(self, model, max_wait_ms=10, warmup_shapes=None, window=1000):
+        assert model.mode == "inference", "Create model in inference mode."
+        assert model.config.OUTPUT_LEVEL in ["masks", "boxes"]
+        import tensorflow as tf
+        self.model = model
+        self.batch_size = model.config.BATCH_SIZE
+        self.max_wait = max_wait_ms / 1000.
+        self.queue = queue.Queue()
+        # Keras predicts from the batching thread with the graph made
+        # default there and the predict function built beforehand
+        self.graph = tf.get_default_graph()
+        model.keras_model._make_predict_function()
+        dim = model.config.IMAGE_MAX_DIM
+        for height, width in warmup_shapes or [(dim, dim)]:
+            model.detect([np.zeros((height, width, 3), dtype=np.uint8)] * self.batch_size)
+
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.waits = collections.deque(maxlen=window)
+        self.batch_sizes = collections.Counter()
+        self.requests = 0
+        self.errors = 0
+        self.grouped = 0
+        self.started = time.time()
+        self.stopping = False
+        self.thread = threading.Thread(target=self._batch_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """Stops the batching thread after the images already queued."""
+        self.stopping = True
+        self.thread.join()
+
+    def submit(self, image):
+        """Queues an image. Returns a Future of the model outputs for it,
+        see detect().
+        """
+        molded_images, image_metas, windows = self.model.mold_inputs([image])
+        future = Future()
+        self.queue.put(_Request(molded_images[0], image_metas[0], windows[0],
+                                image.shape, time.time(), future))
+        return future
+
+    def detect(self, image):
+        """Detects the nuclei of one image. Returns the dict of
+        MaskRCNN.detect(), from the thread that calls it.
+        """
+        start = time.time()
+        try:
+            detections, mrcnn_mask, window = self.submit(image).result()
+            result = self.model.unmold_result(detections, mrcnn_mask, image.shape, window)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            raise
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(time.time() - start)
+        return result
+
+    def _batch_loop(self):
+        # Gathers the queued images into groups of the same molded shape and
+        # runs the full groups and the ones that waited long enough
+        with self.graph.as_default():
+            groups = collections.OrderedDict()
+            while not (self.stopping and self.queue.empty() and not groups):
+                if groups:
+                    oldest = min(group[0].arrival for group in groups.values())
+                    timeout = max(oldest + self.max_wait - time.time(), 0)
+                else:
+                    timeout = 0.1
+                requests = []
+                try:
+                    requests.append(self.queue.get(timeout=timeout))
+                    while True:
+                        requests.append(self.queue.get_nowait())
+                except queue.Empty:
+                    pass
+                for r in requests:
+                    groups.setdefault(r.molded_image.shape, []).append(r)
+                now = time.time()
+                for shape in list(groups):
+                    group = groups[shape]
+                    while len(group) >= self.batch_size:
+                        self._run(group[:self.batch_size])
+                        group = group[self.batch_size:]
+                    if group and (now - group[0].arrival >= self.max_wait or self.stopping):
+                        self._run(group)
+                        group = []
+                    if group:
+                        groups[shape] = group
+                    else:
+                        del groups[shape]
+                with self.lock:
+                    self.grouped = sum(len(group) for group in groups.values())
+
+    def _run(self, group):
+        # Predicts a group of same shape images, padded to BATCH_SIZE, and
+        # hands each request its rows of the outputs
+        start = time.time()
+        batch = group + [group[-1]] * (self.batch_size - len(group))
+        molded_images = np.stack([r.molded_image for r in batch])
+        image_metas = np.stack([r.image_meta for r in batch])
+        try:
+            outputs = self.model.predict(self.model.model_inputs(molded_images, image_metas))
+        except Exception as e:
+            for r in group:
+                r.future.set_exception(e)
+            return
+        if self.model.config.OUTPUT_LEVEL == "boxes":
+            detections, mrcnn_mask = outputs, None
+        else:
+            detections, mrcnn_mask = outputs[0], outputs[3]
+        with self.lock:
+            self.batch_sizes[len(group)] += 1
+            self.waits.extend(start - r.arrival for r in group)
+        for i, r in enumerate(group):
+            r.future.set_result((detections[i], None if mrcnn_mask is None else mrcnn_mask[i], r.window))
+
+    def metrics(self):
+        """Queue depth, request and batch counts and latency percentiles
+        (total and waiting for a batch) in milliseconds.
+        """
+        with self.lock:
+            batches = sum(self.batch_sizes.values())
+            images = sum(size * count for size, count in self.batch_sizes.items())
+            return {
+                "queue_depth": self.queue.qsize() + self.grouped,
+                "requests": self.requests,
+                "errors": self.errors,
+                "uptime_s": time.time() - self.started,
+                "batches": batches,
+                "mean_batch_size": images / batches if batches else None,
+                "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                "latency_ms": percentiles(list(self.latencies)),
+                "batch_wait_ms": percentiles(list(self.waits)),
+            }
+
+###########################################
+# HTTP
+###########################################
+
+def decode_image(body):
+    """[H, W, 3] image of the bytes of an image file or of a .npy file."""
+    if body[:6] == b'\x93NUMPY':
+        return utils.rgb_image(np.load(io.BytesIO(body)))
+    return utils.read_image(io.BytesIO(body))
+
+def result_json(result, image_shape, rle_format="kaggle"):
+    """JSON-ready dict of a detect() result: rois [y1, x1, y2, x2],
+    class_ids, scores and, with masks, their Kaggle "start length" strings
+    or COCO RLE dicts.
+    """
+    data = {
+        "image_shape": [int(image_shape[0]), int(image_shape[1])],
+        "rois": np.asarray(result["rois"]).tolist(),
+        "class_ids": np.asarray(result["class_ids"]).tolist(),
+        "scores": np.asarray(result["scores"]).tolist(),
+    }
+    if "masks" in result:
+        if rle_format == "coco":
+            data["masks"] = nuclei_rle.encode_coco(result["masks"])
+        else:
+            data["masks"] = nuclei_rle.encode_kaggle(result["masks"])
+    return data
+
+class _Handler(BaseHTTPRequestHandler):
+
+    server_version = "NucleiServer/1.0"
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self._send(200, self.server.detector.metrics())
+        elif path == '/health':
+            self._send(200, {"status": "ok"})
+        else:
+            self._send(404, {"error": "Unknown path {}".format(path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/detect':
+            self._send(404, {"error": "Unknown path {}".format(url.path)})
+            return
+        rle_format = parse_qs(url.query).get('format', ['kaggle'])[0]
+        if rle_format not in ['kaggle', 'coco']:
+            self._send(400, {"error": "Unknown format {}".format(rle_format)})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            image = decode_image(body)
+        except Exception as e:
+            self._send(400, {"error": "Can't read the image: {}".format(e)})
+            return
+        try:
+            result = self.server.detector.detect(image)
+            data = result_json(result, image.shape, rle_format)
+        except Exception as e:
+            self._send(500, {"error": str(e)})
+            return
+        self._send(200, data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class DetectionServer(ThreadingMixIn, HTTPServer):
+    """HTTP server answering each request in its own thread with a
+    BatchingDetector.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, detector, verbose=False):
+        HTTPServer.__init__(self, address, _Handler)
+        self.detector = detector
+        self.verbose = verbose
+
+###########################################
+# Load generator
+###########################################
+
+def load_test(url, body, concurrency=8, requests=200, rle_format="kaggle"):
+    """Sends requests POST /detect of body from concurrency threads.
+    Returns the number of requests and errors, the requests per second and
+    the latency percentiles in milliseconds.
+    """
+    endpoint = url.rstrip('/') + '/detect?format=' + rle_format
+    counter = itertools.count()
+    latencies = []
+    errors = []
+
+    def client():
+        while next(counter) < requests:
+            start = time.time()
+            try:
+                request = Request(endpoint, data=body, headers={'Content-Type': 'application/octet-stream'})
+                urlopen(request).read()
+                latencies.append(time.time() - start)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    result = {"requests": len(latencies), "errors": len(errors),
+              "requests_per_s": len(latencies) / seconds}
+    result.update(percentiles(latencies))
+    return result
+
+def bench_load(params):
+    # Latency percentiles and throughput for each concurrency, and the
+    # batch sizes the server formed
+    with open(params['image'], 'rb') as f:
+        body = f.read()
+    print("{:>12} {:>10} {:>8} {:>10} {:>10} {:>10} {:>12}".format(
+        'concurrency', 'requests', 'errors', 'req/s', 'p50 (ms)', 'p99 (ms)', 'mean batch'))
+    for concurrency in params['concurrency']:
+        before = json.loads(urlopen(params['url'].rstrip('/') + '/metrics').read().decode('utf-8'))
+        r = load_test(params['url'], body, concurrency, params['requests'], params['format'])
+        after = json.loads(urlopen(params['url'].rstrip('/') + '/metrics').read().decode('utf-8'))
+        batches = after['batches'] - before['batches']
+        images = sum(int(size) * count for size, count in after['batch_sizes'].items()) -\
+            sum(int(size) * count for size, count in before['batch_sizes'].items())
+        print("{:>12} {:>10} {:>8} {:>10.2f} {:>10.1f} {:>10.1f} {:>12.2f}".format(
+            concurrency, r['requests'], r['errors'], r['requests_per_s'], r['p50'] or 0, r['p99'] or 0,
+            images / batches if batches else 0))
+
+###########################################
+# Serving
+###########################################
+
+def serve(params):
+    import nuclei_model as modellib
+    from nuclei_config import Config
+
+    class ServerConfig(Config):
+        NAME = "nuclei_server"
+        NUM_CLASSES = 1 + 1
+        RPN_ANCHOR_SCALES = (8, 16, 32, 64, 128)
+        SAVE_PROB_MASK = False
+        COMPACT_MASKS = True
+        IMAGE_PAD64 = True
+
+    config = ServerConfig(params['image_dim'], params['image_dim'] // 2, 1)
+    config.IMAGES_PER_GPU = config.BATCH_SIZE = params['batch_size']
+    model = modellib.MaskRCNN(mode="inference", config=config, model_dir=params['dir_log'])
+    model.load_weights(params['weights'], by_name=True)
+    start = time.time()
+    warmup_shapes = [tuple(s) for s in params['warmup_shapes'] or [[params['image_dim']] * 2]]
+    detector = BatchingDetector(model, max_wait_ms=params['max_wait_ms'], warmup_shapes=warmup_shapes)
+    print("Warmed up in {:.1f} s".format(time.time() - start))
+    server = DetectionServer((params['host'], params['port']), detector, verbose=params['verbose'])
+    print("Serving on http://{}:{}".format(params['host'], params['port']))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        detector.close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('command', choices=['serve', 'load'], help='run the server or the load generator')
+    parser.add_argument('--weights', default='', help='h5 weights of the model, for serve')
+    parser.add_argument('--image_dim', default=512, type=int, help='IMAGE_MAX_DIM of the model')
+    parser.add_argument('--batch_size', default=4, type=int, help='largest batch')
+    parser.add_argument('--max_wait_ms', default=10., type=float, help='longest wait of an image for its batch to fill up')
+    parser.add_argument('--warmup_shapes', type=int, nargs=2, action='append', help='height width of an image run at start, repeatable, image_dim square by default')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', default=8000, type=int, help='port to listen on')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    parser.add_argument('--dir_log', default='logs', help='log directory')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='server to load, for load')
+    parser.add_argument('--image', default='', help='image file to send, for load')
+    parser.add_argument('--concurrency', default=[1, 4, 16], type=int, nargs='+', help='client threads, one run each')
+    parser.add_argument('--requests', default=200, type=int, help='requests per run')
+    parser.add_argument('--format', default='kaggle', choices=['kaggle', 'coco'], help='RLE format of the masks')
+
+    args = parser.parse_args()
+    params = vars(args) # convert to ordinary dict
+    if args.command == 'serve':
+        assert args.weights, "Provide --weights"
+        serve(params)
+    else:
+        assert args.image, "Provide --image"
+        bench_load(params)
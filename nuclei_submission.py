@@ -0,0 +1,259 @@
+__authors__="Jie Yang and Xinyang Feng"
+
+###########################################
+# Streaming submission writer
+###########################################
+
+# Writes detection results to a COCO style results file image by image,
+# instead of keeping every record until the end. The masks of each image
+# are run-length encoded in a pool of processes while the model goes on,
+# and the records are appended in the order of the images, either to a JSON
+# array (the same bytes as json.dumps() of the whole list) or to a JSON
+# lines file. The records are held back and written every flush_every
+# images, the array with its closing bracket, so after a crash the file is
+# valid up to the last flush.
+
+import os
+import json
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+import numpy as np
+import nuclei_rle
+
+# Boxes and box-local masks of one image, as nuclei_rle.runs() reads them
+Crops = collections.namedtuple('Crops', ['boxes', 'masks', 'image_shape'])
+
+def crop_masks(rois, masks, threshold=0.5):
+    """Crops of full size [H, W, N] masks to their rois, which hold all of
+    each mask as detect() makes them, above threshold.
+    """
+    height, width = masks.shape[:2]
+    boxes = np.minimum(np.maximum(np.asarray(rois, dtype=np.int64).reshape(-1, 4), 0),
+                       [height, width, height, width])
+    crops = [masks[y1:y2, x1:x2, i] > threshold for i, (y1, x1, y2, x2) in enumerate(boxes)]
+    return Crops(boxes, crops, (height, width))
+
+def encode_records(image_id, rois, scores, crops, category_id=1):
+    """JSON strings of the records of one image: image_id, bbox
+    [x, y, width, height], score, category_id and the COCO RLE
+    segmentation of each instance. image_id is an int or a str.
+    """
+    if isinstance(image_id, np.integer):
+        image_id = int(image_id)
+    segmentations = nuclei_rle.encode_coco(crops)
+    records = []
+    for i in range(len(rois)):
+        y1, x1, y2, x2 = rois[i]
+        width, height = x2 - x1, y2 - y1
+        data = {
+            "image_id": image_id,
+            "bbox": [float(x1), float(y1), float(width), float(height)],
+            "score": float(scores[i]),
+            "category_id": int(category_id),
+            "segmentation": segmentations[i],
+        }
+        records.append(json.dumps(data))
+    return records
+
+###########################################
+# Writer
+###########################################
+
+class SubmissionWriter(object):
+    """Appends the records of detect() results to path as they come.
+
+    path: file to write, a JSON array, or JSON lines if lines is True
+        (by default if path ends with .jsonl)
+    workers: processes encoding the masks, 0 to encode in the caller
+    flush_every: images between two flushes of the file
+    max_pending: most images being encoded at once, 4 * workers by default.
+        write() blocks beyond it.
+    category_id: category of all the records
+    log_path: if set, each flush appends a "image_id<TAB>records" line per
+        image it writes to this file, see read_log()
+    append: add to an existing JSON lines file instead of replacing it
+    """
+
+    def __init__(self, path, lines=None, workers=2, flush_every=10, max_pending=None,
+                 category_id=1, log_path=None, append=False):
+        self.path = path
+        self.lines = path.endswith('.jsonl') if lines is None else lines
+        assert self.lines or not append, "Only JSON lines files can be appended to"
+        self.flush_every = flush_every
+        self.max_pending = max_pending or 4 * max(workers, 1)
+        self.category_id = category_id
+        # Spawned, the workers don't inherit the TensorFlow runtime
+        self.pool = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn')) if workers else None
+        self.pending = collections.deque()
+        # Encoded records not written yet, and their images
+        self.buffer = []
+        self.buffered_images = []
+        self.images = 0
+        self.records = 0
+        self.log = open(log_path, 'a') if log_path else None
+        self.fp = open(path, 'ab' if append else 'wb')
+        if not self.lines:
+            self.fp.write(b'[')
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, image_id, result):
+        """Queues the records of result, a detect() dict of rois, scores and
+        masks ([H, W, N] or an InstanceMasks), for image_id.
+        """
+        masks = result["masks"]
+        if hasattr(masks, 'boxes'):
+            crops = Crops(masks.boxes, masks.masks, masks.image_shape[:2])
+        else:
+            crops = crop_masks(result["rois"], masks)
+        args = (image_id, result["rois"], result["scores"], crops, self.category_id)
+        if self.pool is not None:
+            future = self.pool.submit(encode_records, *args)
+        else:
+            future = Future()
+            future.set_result(encode_records(*args))
+        self.pending.append((image_id, future))
+        # Writes what is done, in order, and waits if too much is not
+        while self.pending and (self.pending[0][1].done() or len(self.pending) > self.max_pending):
+            self._append(*self._pop())
+
+    def _pop(self):
+        image_id, future = self.pending.popleft()
+        return image_id, future.result()
+
+    def _append(self, image_id, records):
+        for record in records:
+            if self.lines:
+                self.buffer.append(record + '\n')
+            else:
+                self.buffer.append(', ' + record if self.records else record)
+            self.records += 1
+        self.buffered_images.append((image_id, len(records)))
+        self.images += 1
+        if self.images % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        """Writes the records encoded so far to the file. A JSON array is
+        closed, and reopened by the next flush.
+        """
+        self.fp.write(''.join(self.buffer).encode('utf-8'))
+        self.buffer = []
+        if not self.lines:
+            self.fp.write(b']')
+            self.fp.flush()
+            self.fp.seek(-1, os.SEEK_CUR)
+        else:
+            self.fp.flush()
+        # The log only names images whose records are in the file
+        if self.log is not None:
+            self.log.write(''.join('{}\t{}\n'.format(*image) for image in self.buffered_images))
+            self.log.flush()
+        self.buffered_images = []
+
+    def close(self):
+        """Writes the records still being encoded and closes the file."""
+        if self.fp is None:
+            return
+        try:
+            while self.pending:
+                self._append(*self._pop())
+            self.flush()
+        finally:
+            self.fp.close()
+            self.fp = None
+            if self.log is not None:
+                self.log.close()
+            if self.pool is not None:
+                self.pool.shutdown()
+
+###########################################
+# Shards
+###########################################
+
+# A run split in N shards writes, for shard i of the output answer.json,
+# the records to answer.shard<i>of<N>.jsonl and the images done to
+# answer.shard<i>of<N>.log. A shard that is run again skips the images in
+# its log, and merge_shards() joins the shards into the output.
+
+def shard_paths(output, shard, shards):
+    """(records, log) paths of shard of shards of output."""
+    stem = os.path.splitext(output)[0]
+    name = '{}.shard{}of{}'.format(stem, shard, shards)
+    return name + '.jsonl', name + '.log'
+
+def read_log(log_path):
+    """{image_id: records} of the images a log names, the ids as str."""
+    done = {}
+    if os.path.exists(log_path):
+        with open(log_path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 2 and fields[1].isdigit():
+                    done[fields[0]] = int(fields[1])
+    return done
+
+def resume_shard(records_path, log_path):
+    """Returns the ids (as str) of the images done by an earlier run of a
+    shard, and drops from its records file any record of other images, left
+    by a run that stopped between a flush and its log line.
+    """
+    done = read_log(log_path)
+    if not os.path.exists(records_path):
+        return set(done)
+    kept = []
+    with open(records_path, 'rb') as f:
+        for line in f:
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # A line cut short by the stop
+                continue
+            if str(record["image_id"]) in done:
+                kept.append(line if line.endswith(b'\n') else line + b'\n')
+    with open(records_path, 'wb') as f:
+        f.write(b''.join(kept))
+    return set(done)
+
+def merge_shards(output, shards, image_ids):
+    """Writes the records of all the shards of output to output, as a JSON
+    array (the same as SubmissionWriter gives) or JSON lines if it ends with
+    .jsonl, the images in the order of image_ids. Only the records of the
+    images in the log of their shard are written, so a shard stopped
+    mid-flush leaves no partial image in the output.
+
+    Returns the ids (as str) of the images of image_ids no shard has done.
+    """
+    records = {}
+    done = set()
+    for shard in range(shards):
+        records_path, log_path = shard_paths(output, shard, shards)
+        logged = read_log(log_path)
+        done.update(logged)
+        if not os.path.exists(records_path):
+            continue
+        with open(records_path, 'rb') as f:
+            for line in f:
+                line = line.rstrip(b'\n')
+                try:
+                    image_id = str(json.loads(line.decode('utf-8'))["image_id"])
+                except ValueError:
+                    # A line cut short by a stopped shard
+                    continue
+                # As resume_shard(), only the records of images in the log
+                if image_id in logged:
+                    records.setdefault(image_id, []).append(line)
+    ordered = [line for image_id in image_ids for line in records.get(str(image_id), [])]
+    with open(output, 'wb') as f:
+        if output.endswith('.jsonl'):
+            f.write(b''.join(line + b'\n' for line in ordered))
+        else:
+            f.write(b'[' + b', '.join(ordered) + b']')
+    return set(str(image_id) for image_id in image_ids) - done
@@ -0,0 +1,222 @@
+__authors__="Jie Yang and Xinyang Feng"
+
+###########################################
+# Detection parameter sweeps
+###########################################
+
+# DETECTION_MIN_CONFIDENCE, DETECTION_NMS_THRESHOLD, DETECTION_MAX_INSTANCES
+# and DETECTION_MASK_THRESHOLD only change what is done after the network.
+# RawCache keeps what MaskRCNN.detect_raw() returns for each image (the
+# candidates before NMS: refined boxes, class probabilities and 28x28
+# masks), and sweep() replays the selection, NMS, unmolding and encoding of
+# every cached image for each setting of a grid, in a pool of processes,
+# without running the network again.
+#
+#   cache_dir/<model key>/<image key>.npz
+#
+# The model key hashes the weights file and the config values the network
+# outputs depend on, and the image key the pixels of the image.
+
+import os
+import time
+import hashlib
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nuclei_utils as utils
+import nuclei_rle
+
+# Config values a sweep can change
+SWEEP_PARAMETERS = ["DETECTION_MIN_CONFIDENCE", "DETECTION_NMS_THRESHOLD",
+                    "DETECTION_MAX_INSTANCES", "DETECTION_MASK_THRESHOLD"]
+
+# Config values the cached outputs depend on, besides the weights
+MODEL_KEY_ATTRIBUTES = ["BACKBONE_NAME", "NUM_CLASSES", "IMAGE_MIN_DIM", "IMAGE_MAX_DIM",
+                        "IMAGE_PAD64", "IMAGE_UINT8", "MEAN_PIXEL", "FOLD_BATCH_NORM",
+                        "RPN_ANCHOR_SCALES", "RPN_ANCHOR_RATIOS", "RPN_ANCHOR_STRIDE",
+                        "RPN_NMS_THRESHOLD", "RPN_BBOX_STD_DEV", "POST_NMS_ROIS_INFERENCE",
+                        "BBOX_STD_DEV", "MASK_SHAPE", "RAW_MIN_CONFIDENCE", "RAW_MAX_ROIS",
+                        "PROB_MASK_DTYPE"]
+
+###########################################
+# Cache
+###########################################
+
+def image_key(image):
+    """Hex digest of the shape, type and pixels of an image."""
+    image = np.ascontiguousarray(image)
+    h = hashlib.sha1('{}{}'.format(image.shape, image.dtype.str).encode('ascii'))
+    h.update(image.data)
+    return h.hexdigest()
+
+def model_key(weights_path, config):
+    """Hex digest of a weights file and of the MODEL_KEY_ATTRIBUTES of config."""
+    h = hashlib.sha1()
+    with open(weights_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    for name in MODEL_KEY_ATTRIBUTES:
+        value = getattr(config, name, None)
+        if isinstance(value, np.ndarray):
+            value = value.tolist()
+        h.update('{}={!r};'.format(name, value).encode('utf-8'))
+    return h.hexdigest()
+
+def load_raw(path):
+    """detect_raw() dict of one image from its cache file."""
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files}
+
+class RawCache(object):
+    """detect_raw() results of one model, one file per image.
+
+    cache_dir: root directory, shared by all the models
+    weights_path: weights file of the model
+    config: config of the model, OUTPUT_LEVEL "raw"
+    """
+
+    def __init__(self, cache_dir, weights_path, config):
+        self.config = config
+        self.key = model_key(weights_path, config)
+        self.dir = os.path.join(cache_dir, self.key)
+        os.makedirs(self.dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.dir, key + '.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, raw):
+        # Written under another name first, so the files of the cache are
+        # all complete
+        tmp = os.path.join(self.dir, key + '.tmp.npz')
+        np.savez_compressed(tmp, **raw)
+        os.replace(tmp, self.path(key))
+
+    def get(self, key):
+        return load_raw(self.path(key))
+
+def cache_images(model, images, cache):
+    """Runs detect_raw() on the images not in the cache yet, in batches of
+    BATCH_SIZE, and stores the results. With IMAGE_PAD64 and more than one
+    image per batch, the images must be of the same size.
+
+    model: MaskRCNN in inference mode, OUTPUT_LEVEL "raw"
+    images: iterable of images
+
+    Returns the keys of all the images, in order, for sweep().
+    """
+    keys = []
+    batch = []
+    for image in images:
+        key = image_key(image)
+        keys.append(key)
+        if key in cache or any(key == k for k, _ in batch):
+            continue
+        batch.append((key, image))
+        if len(batch) == model.config.BATCH_SIZE:
+            _cache_batch(model, batch, cache)
+            batch = []
+    if batch:
+        _cache_batch(model, batch, cache)
+    return keys
+
+def _cache_batch(model, batch, cache):
+    # The last batch is filled up with copies of its last image
+    images = [image for _, image in batch]
+    images += images[-1:] * (model.config.BATCH_SIZE - len(images))
+    for (key, _), raw in zip(batch, model.detect_raw(images)):
+        cache.put(key, raw)
+
+###########################################
+# Replay
+###########################################
+
+# nuclei_utils.postprocess_config() of the cache, in a worker process
+_replay_config = None
+
+def _init_replay(config):
+    global _replay_config
+    _replay_config = config
+
+def replay_image(path, settings, gt_mask=None):
+    """Replays the cached image of path under each dict of settings, in a
+    worker process. Returns a (detections, mAP or None, seconds) tuple per
+    setting, the seconds those of the replay and of the RLE encoding.
+    """
+    raw = load_raw(path)
+    config = _replay_config
+    rows = []
+    for setting in settings:
+        for name, value in setting.items():
+            setattr(config, name, value)
+        start = time.time()
+        r = utils.replay_raw(raw, config)
+        nuclei_rle.encode_coco(r["masks"])
+        seconds = time.time() - start
+        ap = None
+        if gt_mask is not None:
+            ap = utils.sweep_iou_mask_ap(gt_mask.copy(), r["masks"], r["scores"])
+        rows.append((len(r["scores"]), ap, seconds))
+    return rows
+
+def parameter_grid(grid):
+    """List of settings dicts, one per combination of the values of grid, a
+    dict of SWEEP_PARAMETERS names to lists of values.
+    """
+    names = sorted(grid)
+    for name in names:
+        assert name in SWEEP_PARAMETERS, "Unknown sweep parameter {}".format(name)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+def sweep(cache, keys, grid, gt_masks=None, workers=None):
+    """Replays the cached images of keys under each setting of grid, as
+    detect() with COMPACT_MASKS would have run them if the cache holds all
+    the candidates (RAW_MAX_ROIS at least POST_NMS_ROIS_INFERENCE, see
+    MaskRCNN.detect_raw()).
+
+    cache: RawCache of the images
+    keys: image keys, as cache_images() returns them
+    grid: dict of SWEEP_PARAMETERS names to lists of values, the others
+        are those of cache.config. The settings can't let in more than the
+        RAW_MIN_CONFIDENCE and RAW_MAX_ROIS of the cache.
+    gt_masks: optional list of [H, W, N] ground truth masks, one per key,
+        to score the settings with nuclei_utils.sweep_iou_mask_ap()
+    workers: processes replaying the images, one per core by default
+
+    Returns a list of dicts, one per setting: its values, "detections" (the
+    mean per image), "mAP" (the mean over the images, None without
+    gt_masks) and "seconds" (the replay time of all the images, summed
+    over the workers).
+    """
+    settings = parameter_grid(grid)
+    config = cache.config
+    for setting in settings:
+        assert setting.get("DETECTION_MIN_CONFIDENCE", config.DETECTION_MIN_CONFIDENCE)\
+            >= config.RAW_MIN_CONFIDENCE, "The cache has no boxes below RAW_MIN_CONFIDENCE"
+        assert setting.get("DETECTION_MAX_INSTANCES", config.DETECTION_MAX_INSTANCES)\
+            <= config.RAW_MAX_ROIS, "The cache has no more than RAW_MAX_ROIS boxes per image"
+    # The workers only import numpy-side modules, not nuclei_model
+    replay_config = utils.postprocess_config(config)
+    replay_config.COMPACT_MASKS = True
+    replay_config.SAVE_PROB_MASK = False
+    if gt_masks is None:
+        gt_masks = [None] * len(keys)
+    # Spawned, the workers don't inherit the TensorFlow runtime
+    with ProcessPoolExecutor(workers or multiprocessing.cpu_count(),
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_replay, initargs=(replay_config,)) as pool:
+        per_image = list(pool.map(replay_image, [cache.path(key) for key in keys],
+                                  [settings] * len(keys), gt_masks))
+    results = []
+    for s, setting in enumerate(settings):
+        rows = [image[s] for image in per_image]
+        result = dict(setting)
+        result["detections"] = float(np.mean([row[0] for row in rows])) if rows else 0.
+        aps = [row[1] for row in rows if row[1] is not None]
+        result["mAP"] = float(np.mean(aps)) if aps else None
+        result["seconds"] = sum(row[2] for row in rows)
+        results.append(result)
+    return results
@@ -0,0 +1,239 @@
+__authors__="Jie Yang and Xinyang Feng"
+
+###########################################
+# Tiled inference on large images
+###########################################
+
+# MaskRCNN.detect() resizes a whole image to IMAGE_MAX_DIM, so small nuclei
+# vanish on large slides. TiledDetector cuts the image into overlapping
+# IMAGE_MAX_DIM tiles at native scale, runs them through the model in
+# batches of BATCH_SIZE and merges the instances found twice in the
+# overlaps. Instances are returned as boxes plus box-local masks, and
+# handed out as soon as no later tile can touch them.
+
+import time
+import numpy as np
+import nuclei_utils as utils
+
+###########################################
+# Tiled detector
+###########################################
+
+class TiledDetector(object):
+    """Runs an inference MaskRCNN on tiles of an arbitrarily large image.
+
+    model: MaskRCNN in inference mode with OUTPUT_LEVEL "masks". Its tiles
+        are IMAGE_MAX_DIM squares, IMAGE_MIN_DIM must not be larger so the
+        tiles are not rescaled.
+    overlap: pixels shared by neighbouring tiles. Should be larger than the
+        nuclei, so that each nucleus is whole in at least one tile.
+    background_std: tiles whose (subsampled) intensity standard deviation
+        is below this are taken as empty background and not run.
+    iou_threshold: two instances from neighbouring tiles are the same
+        nucleus if the IoU of their masks, over the pixels both tiles see,
+        is at least this.
+    """
+
+    def __init__(self, model, overlap=64, background_std=2., iou_threshold=0.5):
+        config = model.config
+        assert model.mode == "inference", "Create model in inference mode."
+        assert config.OUTPUT_LEVEL == "masks", "Tiling needs the instance masks"
+        assert config.IMAGE_MIN_DIM <= config.IMAGE_MAX_DIM
+        self.model = model
+        self.tile = config.IMAGE_MAX_DIM
+        assert 0 <= overlap < self.tile // 2
+        self.overlap = overlap
+        self.background_std = background_std
+        self.iou_threshold = iou_threshold
+        # Counters of the last image
+        self.stats = {}
+
+    def tile_starts(self, size):
+        # Tile offsets along one axis, the last tile ends on the image border
+        if size <= self.tile:
+            return np.array([0])
+        step = self.tile - self.overlap
+        return np.array(list(range(0, size - self.tile, step)) + [size - self.tile])
+
+    def is_background(self, tile):
+        # Flat tiles hold no nuclei, whatever the stain
+        return tile[::4, ::4].std() < self.background_std
+
+    def detect_iter(self, image):
+        """Detects the nuclei of image [height, width, 3], tile batch by
+        tile batch.
+
+        Yields dicts of the instances finished by each batch:
+        rois: [N, (y1, x1, y2, x2)] boxes in image pixels
+        class_ids: [N] int class IDs
+        scores: [N] float probability scores
+        masks: list of N bool masks of the shape of their box
+        """
+        height, width = image.shape[:2]
+        # Images smaller than a tile are padded with their median color
+        if height < self.tile or width < self.tile:
+            padded = np.empty((max(height, self.tile), max(width, self.tile), image.shape[2]),
+                              dtype=image.dtype)
+            padded[:] = np.median(image.reshape(-1, image.shape[2]), axis=0).astype(image.dtype)
+            padded[:height, :width] = image
+            image = padded
+        ys = self.tile_starts(height)
+        xs = self.tile_starts(width)
+        origins = [(y, x) for y in ys for x in xs]
+        self.stats = {"tiles": len(origins), "skipped": 0, "instances": 0, "seconds": 0.}
+        start = time.time()
+
+        # Instances that later tiles may still overlap
+        self._open = []
+        batch_size = self.model.config.BATCH_SIZE
+        batch = []
+        for index, (y, x) in enumerate(origins):
+            tile = image[y:y + self.tile, x:x + self.tile]
+            if self.is_background(tile):
+                self.stats["skipped"] += 1
+            else:
+                batch.append((index, y, x, tile))
+            if len(batch) == batch_size:
+                self._add_batch(batch, ys, xs, height, width)
+                batch = []
+                # Everything no tile after this one can touch is final
+                done = self._finish(index)
+                if done is not None:
+                    yield done
+        if batch:
+            self._add_batch(batch, ys, xs, height, width)
+        done = self._finish(len(origins))
+        if done is not None:
+            yield done
+        self.stats["seconds"] = time.time() - start
+        self.stats["tiles_per_sec"] = self.stats["tiles"] / max(self.stats["seconds"], 1e-9)
+
+    def detect(self, image):
+        """Same as detect_iter(), with all the instances in one dict."""
+        rois, class_ids, scores, masks = [], [], [], []
+        for r in self.detect_iter(image):
+            rois.append(r["rois"])
+            class_ids.append(r["class_ids"])
+            scores.append(r["scores"])
+            masks.extend(r["masks"])
+        return {
+            "rois": np.concatenate(rois) if rois else np.zeros((0, 4), np.int32),
+            "class_ids": np.concatenate(class_ids) if class_ids else np.zeros((0,), np.int32),
+            "scores": np.concatenate(scores) if scores else np.zeros((0,), np.float32),
+            "masks": masks,
+        }
+
+    def _add_batch(self, batch, ys, xs, height, width):
+        # Runs a batch of tiles, the last tile repeated to fill it, and
+        # merges the instances of each tile in grid order
+        tiles = [tile for _, _, _, tile in batch]
+        tiles += [tiles[-1]] * (self.model.config.BATCH_SIZE - len(tiles))
+        results = self.model.detect(tiles)
+        for (index, y, x, _), r in zip(batch, results):
+            region = np.array([y, x, min(y + self.tile, height), min(x + self.tile, width)])
+            # Box-local masks, whether the model returns them (COMPACT_MASKS)
+            # or full size ones
+            masks = r["masks"]
+            if not isinstance(masks, utils.InstanceMasks):
+                masks = utils.InstanceMasks.from_dense(r["rois"], masks)
+            for i in range(len(r["scores"])):
+                y1, x1, y2, x2 = masks.boxes[i]
+                box = np.array([y1 + y, x1 + x, y2 + y, x2 + x])
+                mask = masks.masks[i]
+                # Drop what falls in the padding of small images
+                clipped = np.minimum(box, [height, width, height, width])
+                if clipped[2] <= box[0] or clipped[3] <= box[1]:
+                    continue
+                mask = mask[:clipped[2] - box[0], :clipped[3] - box[1]]
+                if not mask.any():
+                    continue
+                self._merge({
+                    "box": clipped,
+                    "class_id": r["class_ids"][i],
+                    "score": r["scores"][i],
+                    "mask": mask,
+                    "region": region,
+                    "margin": self._margin(clipped, region, height, width),
+                    "last": self._last_tile(clipped, ys, xs),
+                })
+
+    def _margin(self, box, region, height, width):
+        # Distance from the box to the tile borders that are inside the
+        # image, the larger the more likely the instance is whole
+        margins = [np.inf]
+        if region[0] > 0:
+            margins.append(box[0] - region[0])
+        if region[1] > 0:
+            margins.append(box[1] - region[1])
+        if region[2] < height:
+            margins.append(region[2] - box[2])
+        if region[3] < width:
+            margins.append(region[3] - box[3])
+        return min(margins)
+
+    def _last_tile(self, box, ys, xs):
+        # Index of the last tile in grid order that overlaps the box
+        row = np.where(ys < box[2])[0][-1]
+        col = np.where(xs < box[3])[0][-1]
+        return row * len(xs) + col
+
+    def _crop(self, instance, window):
+        # Mask of the instance over window [y1, x1, y2, x2]
+        y1, x1, y2, x2 = window
+        crop = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+        by1, bx1, by2, bx2 = instance["box"]
+        iy1, ix1, iy2, ix2 = max(y1, by1), max(x1, bx1), min(y2, by2), min(x2, bx2)
+        if iy1 < iy2 and ix1 < ix2:
+            crop[iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1] = \
+                instance["mask"][iy1 - by1:iy2 - by1, ix1 - bx1:ix2 - bx1]
+        return crop
+
+    def _band_iou(self, a, b):
+        # Mask IoU of two instances over the pixels both of their tiles see.
+        # A nucleus cut by a tile border looks the same there as the whole one.
+        window = [max(a["region"][0], b["region"][0], min(a["box"][0], b["box"][0])),
+                  max(a["region"][1], b["region"][1], min(a["box"][1], b["box"][1])),
+                  min(a["region"][2], b["region"][2], max(a["box"][2], b["box"][2])),
+                  min(a["region"][3], b["region"][3], max(a["box"][3], b["box"][3]))]
+        if window[0] >= window[2] or window[1] >= window[3]:
+            return 0.
+        mask_a = self._crop(a, window)
+        mask_b = self._crop(b, window)
+        union = np.sum(mask_a | mask_b)
+        return np.sum(mask_a & mask_b) / float(union) if union else 0.
+
+    def _merge(self, instance):
+        # Keeps one of the open instances of other tiles that are the same
+        # nucleus as the new one: the one farthest from its tile borders
+        box = instance["box"]
+        matches = []
+        for k, other in enumerate(self._open):
+            if other["region"] is instance["region"]:
+                continue
+            ob = other["box"]
+            if ob[0] >= box[2] or ob[2] <= box[0] or ob[1] >= box[3] or ob[3] <= box[1]:
+                continue
+            if self._band_iou(instance, other) >= self.iou_threshold:
+                matches.append(k)
+        if matches:
+            candidates = [self._open[k] for k in matches] + [instance]
+            keep = max(candidates, key=lambda c: (c["margin"], c["score"]))
+            keep["last"] = max(c["last"] for c in candidates)
+            for k in reversed(matches):
+                del self._open[k]
+            instance = keep
+        self._open.append(instance)
+
+    def _finish(self, index):
+        # Removes and returns the open instances no tile after index touches
+        done = [instance for instance in self._open if instance["last"] <= index]
+        if not done:
+            return None
+        self._open = [instance for instance in self._open if instance["last"] > index]
+        self.stats["instances"] += len(done)
+        return {
+            "rois": np.array([d["box"] for d in done], dtype=np.int32),
+            "class_ids": np.array([d["class_id"] for d in done], dtype=np.int32),
+            "scores": np.array([d["score"] for d in done], dtype=np.float32),
+            "masks": [d["mask"] for d in done],
+        }
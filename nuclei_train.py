@@ -60,6 +60,9 @@ class TrainingConfig(Config):
 
 class TrainingAllConfig(TrainingConfig):
     IMAGES_PER_GPU = 1
+    # Steps with the gradient of 4 images, like the head stage, in the
+    # memory of one
+    GRADIENT_ACCUMULATION_STEPS = 4
 
 ###########################################
 # Define nuclei dataset
@@ -68,12 +71,7 @@ class TrainingAllConfig(TrainingConfig):
 class NucleiDataset(utils.Dataset):
     def load_image(self, image_id):
         # Load the specified image and return a [H,W,3] Numpy array.
-        image = skimage.io.imread(self.image_info[image_id]['path'])
-        if image.ndim != 3:
-            image = gray2rgb(image)
-        elif image.shape[2] == 4:
-            image = image[:, :, :3]
-        return image
+        return utils.read_image(self.image_info[image_id]['path'])
     def load_mask(self, image_id):
         # Load the instance masks (a binary mask per instance)
         # return a a bool array of shape [H, W, instance count]
@@ -88,7 +86,7 @@ class NucleiDataset(utils.Dataset):
             mask[:, :, k] = skimage.io.imread(os.path.join(mask_dir, mask_files[k]))
         return mask, class_ids
 
-def main_train(params):
+def main_train(params, worker=None):
 
     ROOT_DIR = params['dir_root']
     log_name = params['dir_log']
@@ -100,6 +98,10 @@ def main_train(params):
     epoch_number_all_fast = params['epoch_number_all_fast']
     epoch_number_all_slow = params['epoch_number_all_slow']
 
+    feature_cache = params['feature_cache']
+    feature_cache_variants = params['feature_cache_variants']
+    backbone = params['backbone']
+
     # Directory of the project and models
     MODEL_DIR = os.path.join(ROOT_DIR, log_name)
     COCO_MODEL_PATH = os.path.join(ROOT_DIR, "mask_rcnn_coco.h5")
@@ -119,6 +121,9 @@ def main_train(params):
     config_tf = tf.ConfigProto()
     config_tf.gpu_options.allow_growth = True
     session = tf.Session(config=config_tf)
+    if worker is not None:
+        # One replica of a data parallel training, see nuclei_parallel.py
+        worker.init_session()
 
     ###########################################
     # Train vs. validation split
@@ -151,16 +156,32 @@ def main_train(params):
 
     print('train = '+str(len(train_ids)))
 
+    # With several workers, each one trains on an equal shard of the images
+    world_size, rank = (worker.world_size, worker.rank) if worker is not None else (1, 0)
+    id_length = len(train_ids) // world_size
+
     ###########################################
     # Training Config
     ###########################################
 
-    config_head = TrainingConfig(512,256, len(train_ids))
+    config_head = TrainingConfig(512,256, id_length)
+    config_head.BACKBONE_NAME = backbone
     config_head.display()
 
-    config_all = TrainingAllConfig(512,256, len(train_ids))
+    config_all = TrainingAllConfig(512,256, id_length)
+    config_all.BACKBONE_NAME = backbone
     config_all.display()
 
+    # Layers not to take from the COCO weights. The COCO file holds a ResNet,
+    # so other backbones also skip its stem and the FPN convs that read it,
+    # and train the whole network from the head stage on.
+    coco_exclude = ["mrcnn_class_logits", "mrcnn_bbox_fc", "mrcnn_bbox", "mrcnn_mask"]
+    head_layers = 'heads'
+    if not backbone.startswith('resnet'):
+        coco_exclude += ["conv1", "bn_conv1", "fpn_c2p2", "fpn_c3p3", "fpn_c4p4", "fpn_c5p5"]
+        head_layers = 'all'
+        assert not feature_cache, "The feature cache needs a pretrained backbone"
+
     ###########################################
     # Prepare data
     ###########################################
@@ -168,6 +189,7 @@ def main_train(params):
     random.seed(1234)
     random.shuffle(train_ids)
     random.shuffle(val_ids)
+    train_ids = train_ids[rank::world_size][:id_length]
 
     dataset_train = NucleiDataset()
     dataset_train.add_class("cell", 1, "nulcei")
@@ -186,24 +208,47 @@ def main_train(params):
     # Begin Training
     ###########################################
 
+    # Render the datasets through the frozen backbone once, so the head
+    # stage trains on cached features instead of running the ResNet
+    if train_head and feature_cache:
+        if rank == 0 and not os.path.exists(os.path.join(feature_cache, 'train', 'count.npy')):
+            model = modellib.MaskRCNN(mode="training", model_dir=MODEL_DIR, config=config_head)
+            model.load_weights(COCO_MODEL_PATH, by_name=True, exclude=coco_exclude)
+            modellib.build_feature_cache(model, dataset_train, os.path.join(feature_cache, 'train'),
+                                         variants=feature_cache_variants, augment=config_head.AUGMENTATION)
+            modellib.build_feature_cache(model, dataset_val, os.path.join(feature_cache, 'val'))
+            del model
+        if worker is not None:
+            worker.wait()
+        config_head.BACKBONE_FEATURE_CACHE = feature_cache
+
     # Train the head branches
     if train_head:
         model = modellib.MaskRCNN(mode="training", model_dir=MODEL_DIR, config=config_head)
+        if worker is not None:
+            model.set_worker(worker)
         init_with = "coco"
         if init_with == "imagenet":
             model.load_weights(model.get_imagenet_weights(), by_name=True)
         else:
-            model.load_weights(COCO_MODEL_PATH, by_name=True,
-                               exclude=["mrcnn_class_logits", "mrcnn_bbox_fc", "mrcnn_bbox", "mrcnn_mask"])
+            model.load_weights(COCO_MODEL_PATH, by_name=True, exclude=coco_exclude)
         epoch_init = epoch_number_head
-        model.train(dataset_train, dataset_val, learning_rate=config_head.LEARNING_RATE, epochs=epoch_init, layers='heads')
+        model.train(dataset_train, dataset_val, learning_rate=config_head.LEARNING_RATE, epochs=epoch_init, layers=head_layers)
         del model
 
     # Fine tune all layers
     if train_all:
+        # The chief may still be writing the last head checkpoint
+        if worker is not None:
+            worker.wait()
         model = modellib.MaskRCNN(mode="training", model_dir=MODEL_DIR, config=config_all)
+        if worker is not None:
+            model.set_worker(worker)
         model_path = model.find_last()[1]
         model_epoch = int(model_path.split('/')[-1].split('.')[0][-4:])
+        if feature_cache:
+            # Heads trained on cached features are saved without the backbone
+            model.load_weights(COCO_MODEL_PATH, by_name=True, exclude=coco_exclude)
         model.load_weights(model_path, by_name=True)
         epoch_init_fast = model_epoch + epoch_number_all_fast
         epoch_init_slow = epoch_init_fast + epoch_number_all_slow
@@ -225,10 +270,20 @@ if __name__ == "__main__":
     parser.add_argument('--epoch_number_all_fast', default=6, type=int, help='first train all layers with a fast learning rate')
     parser.add_argument('--epoch_number_all_slow', default=8, type=int, help='then train all layers with a fast learning rate')
 
+    parser.add_argument('--backbone', default='resnet50', choices=sorted(modellib.BACKBONES), help='backbone network')
+
+    parser.add_argument('--feature_cache', default='', help='if set, cache backbone features in this directory and train the head layers from it')
+    parser.add_argument('--workers', default=1, type=int, help='number of data parallel training processes on the CPU')
+    parser.add_argument('--feature_cache_variants', default=1, type=int, help='number of augmented renderings of each training image in the feature cache')
+
     epoch_number_head = 12
     epoch_number_all_fast = 6
     epoch_number_all_slow = 8
 
     args = parser.parse_args()
     params = vars(args) # convert to ordinary dict
-    main_train(params)
+    if args.workers > 1:
+        import nuclei_parallel
+        nuclei_parallel.launch(main_train, args.workers, args=(params,))
+    else:
+        main_train(params)
@@ -8,10 +8,10 @@ __authors__="Jie Yang and Xinyang Feng"
 import sys
 import os
 import math
+import types
 import random
 import numpy as np
 import cv2
-import tensorflow as tf
 import scipy.misc
 from scipy.ndimage.measurements import center_of_mass
 import skimage.color
@@ -21,41 +21,31 @@ import skimage.morphology
 from urllib.request import urlopen
 import shutil
 import networkx
+import nuclei_rle
+# The image reader of the mrcnn library, shared by the nuclei_* modules
+from mrcnn.utils import read_image, rgb_image
 
 # URL from which to download the COCO pretrained weights by MatterPort
 COCO_MODEL_URL = "https://github.com/matterport/Mask_RCNN/releases/download/v2.0/mask_rcnn_coco.h5"
 
-# Run-length encoding from https://www.kaggle.com/rakhlin/fast-run-length-encoding-python
+# Run-length encoding, see nuclei_rle for whole images
 def rle_encoding(x):
-    dots = np.where(x.T.flatten() == 1)[0]
-    run_lengths = []
-    prev = -2
-    for b in dots:
-        if (b > prev + 1): run_lengths.extend((b + 1, 0))
-        run_lengths[-1] += 1
-        prev = b
-    return run_lengths
+    # [start, length, ...] of the pixels equal to 1, 1-based column-major
+    starts, lengths = nuclei_rle.mask_runs(x == 1)
+    return np.stack([starts + 1, lengths], axis=1).ravel().tolist()
 
 def prob_to_rles(x, cutoff=0.5):
     yield rle_encoding(x > cutoff)
 
 def rle_decoding(rle, shape):
     '''
-    mask_rle: run-length as string formated (start length)
+    mask_rle: run-length as string formated (start length), or the list
+        rle_encoding() returns
     shape: (height,width) of array to return
     Returns numpy array, 1 - mask, 0 - background
 
     '''
-    starts = np.array(rle[::2])
-    lengths = np.array(rle[1::2])
-    print(starts)
-    print(lengths)
-    starts -= 1
-    ends = starts + lengths
-    img = np.zeros(shape[0] * shape[1], dtype=np.uint8)
-    for lo, hi in zip(starts, ends):
-        img[lo:hi] = 1
-    return img.reshape(shape, order='F')
+    return nuclei_rle.decode_kaggle(rle, shape).astype(np.uint8)
 
 ############################################################
 #  Bounding Boxes
@@ -190,6 +180,9 @@ def box_refinement_graph(box, gt_box):
     """Compute refinement needed to transform box to gt_box.
     box and gt_box are [N, (y1, x1, y2, x2)]
     """
+    # TensorFlow is imported where it is used, so processes that only
+    # post-process detections don't load it
+    import tensorflow as tf
     box = tf.cast(box, tf.float32)
     gt_box = tf.cast(gt_box, tf.float32)
 
@@ -366,14 +359,7 @@ class Dataset(object):
     def load_image(self, image_id):
         """Load the specified image and return a [H,W,3] Numpy array.
         """
-        # Load image
-        image = skimage.io.imread(self.image_info[image_id]['path'])
-        # If grayscale. Convert to RGB for consistency.
-        if image.shape[2]==4:
-            image = image[:,:,0:2]
-        if image.ndim != 3:
-            image = skimage.color.gray2rgb(image)
-        return image
+        return read_image(self.image_info[image_id]['path'])
 
     def load_mask(self, image_id):
         """Load instance masks for the given image.
@@ -394,7 +380,7 @@ class Dataset(object):
         return mask, class_ids
 
 
-def resize_image(image, min_dim=None, max_dim=None, padding=False):
+def resize_image(image, min_dim=None, max_dim=None, padding=False, pad64=False):
     """
     Resizes an image keeping the aspect ratio.
 
@@ -403,6 +389,8 @@ def resize_image(image, min_dim=None, max_dim=None, padding=False):
     max_dim: if provided, ensures that the image longest side doesn't
         exceed this value.
     padding: If true, pads image with zeros so it's size is max_dim x max_dim
+    pad64: If true (and padding is False), only pads the image with zeros
+        so its height and width are multiples of 64
 
     Returns:
     image: the resized image
@@ -442,6 +430,17 @@ def resize_image(image, min_dim=None, max_dim=None, padding=False):
         padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
         image = np.pad(image, padding, mode='constant', constant_values=0)
         window = (top_pad, left_pad, h + top_pad, w + left_pad)
+    elif pad64:
+        h, w = image.shape[:2]
+        max_h = int(math.ceil(h / 64.)) * 64
+        max_w = int(math.ceil(w / 64.)) * 64
+        top_pad = (max_h - h) // 2
+        bottom_pad = max_h - h - top_pad
+        left_pad = (max_w - w) // 2
+        right_pad = max_w - w - left_pad
+        padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
+        image = np.pad(image, padding, mode='constant', constant_values=0)
+        window = (top_pad, left_pad, h + top_pad, w + left_pad)
     return image, window, scale, padding
 
 
@@ -501,18 +500,28 @@ def mold_mask(mask, config):
     pass
 
 
-def unmold_mask(mask, bbox, image_shape):
+def unmold_mask_box(mask, bbox):
+    """Resizes a mask generated by the neural network to its box.
+    mask: [height, width] of type float. A small, typically 28x28 mask.
+    bbox: [y1, x1, y2, x2]. The box to fit the mask in.
+
+    Returns the [y2 - y1, x2 - x1] float32 probabilities inside the box.
+    """
+    y1, x1, y2, x2 = bbox
+    return scipy.misc.imresize(
+        mask, (y2 - y1, x2 - x1), interp='bilinear').astype(np.float32) / 255.0
+
+def unmold_mask(mask, bbox, image_shape, threshold=0.5):
     """Converts a mask generated by the neural network into a format similar
     to it's original shape.
     mask: [height, width] of type float. A small, typically 28x28 mask.
     bbox: [y1, x1, y2, x2]. The box to fit the mask in.
+    threshold: probability from which a pixel is in the mask
 
     Returns a binary mask with the same size as the original image.
     """
-    threshold = 0.5
     y1, x1, y2, x2 = bbox
-    mask = scipy.misc.imresize(
-        mask, (y2 - y1, x2 - x1), interp='bilinear').astype(np.float32) / 255.0
+    mask = unmold_mask_box(mask, bbox)
     mask = np.where(mask >= threshold, 1, 0).astype(np.uint8)
 
     # Put the mask in the right location.
@@ -529,8 +538,7 @@ def unmold_mask_prob(mask, bbox, image_shape):
     Returns a binary mask with the same size as the original image.
     """
     y1, x1, y2, x2 = bbox
-    mask = scipy.misc.imresize(
-        mask, (y2 - y1, x2 - x1), interp='bilinear').astype(np.float32) / 255.0
+    mask = unmold_mask_box(mask, bbox)
 
     # threshold = 0.5
     # mask = np.where(mask >= threshold, 1, 0).astype(np.uint8)
@@ -540,6 +548,375 @@ def unmold_mask_prob(mask, bbox, image_shape):
     full_mask[y1:y2, x1:x2] = mask
     return full_mask
 
+class InstanceMasks(object):
+    """Instance masks of one image kept as their boxes and box-local crops,
+    instead of one full size mask per instance. Full size masks are only
+    made when asked for.
+
+    boxes: [N, (y1, x1, y2, x2)] int32 boxes in pixels, inside the image
+    masks: list of N [y2 - y1, x2 - x1] bool masks
+    image_shape: [height, width, ...] of the image
+    probs: optional list of N [y2 - y1, x2 - x1] mask probabilities,
+        uint8 (probability * 255) or float16
+    """
+
+    def __init__(self, boxes, masks, image_shape, probs=None):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        self.masks = list(masks)
+        self.image_shape = tuple(image_shape[:2])
+        self.probs = probs
+
+    @classmethod
+    def from_probs(cls, boxes, probs, image_shape, keep_probs=False, prob_dtype="uint8",
+                   threshold=0.5):
+        """Builds the masks from box-local float probabilities, such as
+        unmold_mask_box() returns, thresholded as unmold_mask() does.
+        Boxes are clipped to the image.
+        """
+        height, width = image_shape[:2]
+        boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        clipped = np.minimum(np.maximum(boxes, 0), [height, width, height, width])
+        crops = [p[y1 - by1:y2 - by1, x1 - bx1:x2 - bx1] for p, (by1, bx1, _, _), (y1, x1, y2, x2)
+                 in zip(probs, boxes, clipped)]
+        masks = [c >= threshold for c in crops]
+        if not keep_probs:
+            return cls(clipped, masks, image_shape)
+        if prob_dtype == "uint8":
+            # unmold_mask_box() probabilities are multiples of 1/255
+            crops = [np.round(c * 255).astype(np.uint8) for c in crops]
+        else:
+            crops = [c.astype(prob_dtype) for c in crops]
+        return cls(clipped, masks, image_shape, crops)
+
+    @classmethod
+    def from_dense(cls, boxes, masks):
+        """Crops full size [H, W, N] masks to their boxes."""
+        boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        crops = [masks[y1:y2, x1:x2, i] > 0 for i, (y1, x1, y2, x2) in enumerate(boxes)]
+        return cls(boxes, crops, masks.shape)
+
+    def __len__(self):
+        return len(self.masks)
+
+    @property
+    def shape(self):
+        # Shape of the full size masks, as the [H, W, N] array
+        return self.image_shape + (len(self),)
+
+    @property
+    def nbytes(self):
+        size = self.boxes.nbytes + sum(m.nbytes for m in self.masks)
+        if self.probs is not None:
+            size += sum(p.nbytes for p in self.probs)
+        return size
+
+    def copy(self):
+        return InstanceMasks(self.boxes.copy(), [m.copy() for m in self.masks], self.image_shape,
+                             None if self.probs is None else [p.copy() for p in self.probs])
+
+    def prob(self, i):
+        """float32 box-local probabilities of instance i."""
+        p = self.probs[i]
+        return p.astype(np.float32) / 255. if p.dtype == np.uint8 else p.astype(np.float32)
+
+    def full(self, i):
+        """[H, W] uint8 mask of instance i, as unmold_mask() returns."""
+        y1, x1, y2, x2 = self.boxes[i]
+        mask = np.zeros(self.image_shape, dtype=np.uint8)
+        mask[y1:y2, x1:x2] = self.masks[i]
+        return mask
+
+    def full_prob(self, i):
+        """[H, W] probabilities of instance i, as unmold_mask_prob() returns."""
+        y1, x1, y2, x2 = self.boxes[i]
+        prob = np.zeros(self.image_shape)
+        prob[y1:y2, x1:x2] = self.prob(i)
+        return prob
+
+    def to_dense(self):
+        """[H, W, N] uint8 masks."""
+        masks = np.zeros(self.shape, dtype=np.uint8)
+        for i, (y1, x1, y2, x2) in enumerate(self.boxes):
+            masks[y1:y2, x1:x2, i] = self.masks[i]
+        return masks
+
+    def probs_to_dense(self):
+        """[H, W, N] probabilities."""
+        probs = np.zeros(self.shape)
+        for i, (y1, x1, y2, x2) in enumerate(self.boxes):
+            probs[y1:y2, x1:x2, i] = self.prob(i)
+        return probs
+
+    def label_map(self):
+        """[H, W] int32 image with instance i as i + 1 and background 0.
+        Where masks overlap, the later instance wins.
+        """
+        labels = np.zeros(self.image_shape, dtype=np.int32)
+        for i, (y1, x1, y2, x2) in enumerate(self.boxes):
+            labels[y1:y2, x1:x2][self.masks[i]] = i + 1
+        return labels
+
+    def rle(self, i):
+        """Run-length encoding of instance i, as rle_encoding() of its full
+        size mask: 1-based start and length pairs in column-major order.
+        nuclei_rle.encode() does all the instances in both formats.
+        """
+        starts, lengths = nuclei_rle.instance_runs(
+            self.boxes[i:i + 1], self.masks[i:i + 1], self.image_shape[0])[0]
+        return np.stack([starts + 1, lengths], axis=1).ravel().tolist()
+
+    def deoverlap(self):
+        """Same as deoverlap_masks() on the full size masks: a pixel of
+        several instances is kept only by those whose center of mass is the
+        closest. Works on the box intersections only.
+        """
+        if len(self) < 2:
+            return self
+        com = np.array([np.array(center_of_mass(m)) + box[:2]
+                        for m, box in zip(self.masks, self.boxes)])
+        b = self.boxes
+        y1 = np.maximum(b[:, None, 0], b[None, :, 0])
+        x1 = np.maximum(b[:, None, 1], b[None, :, 1])
+        y2 = np.minimum(b[:, None, 2], b[None, :, 2])
+        x2 = np.minimum(b[:, None, 3], b[None, :, 3])
+        pairs = np.argwhere(np.triu((y2 > y1) & (x2 > x1), 1))
+        # Decided on the masks as given, applied at the end
+        removed = [np.zeros_like(m) for m in self.masks]
+        for i, j in pairs:
+            wy1, wx1, wy2, wx2 = y1[i, j], x1[i, j], y2[i, j], x2[i, j]
+            mi = self.masks[i][wy1 - b[i, 0]:wy2 - b[i, 0], wx1 - b[i, 1]:wx2 - b[i, 1]]
+            mj = self.masks[j][wy1 - b[j, 0]:wy2 - b[j, 0], wx1 - b[j, 1]:wx2 - b[j, 1]]
+            rows, cols = np.nonzero(mi & mj)
+            if not len(rows):
+                continue
+            rows, cols = rows + wy1, cols + wx1
+            di = np.square(rows - com[i, 0]) + np.square(cols - com[i, 1])
+            dj = np.square(rows - com[j, 0]) + np.square(cols - com[j, 1])
+            removed[i][rows - b[i, 0], cols - b[i, 1]] |= di > dj
+            removed[j][rows - b[j, 0], cols - b[j, 1]] |= dj > di
+        self.masks = [m & ~r for m, r in zip(self.masks, removed)]
+        return self
+
+############################################################
+#  Detection post-processing
+############################################################
+
+# The numpy side of MaskRCNN.detect(), the config an argument, for worker
+# processes that unmold or replay detections without the model. The
+# MaskRCNN methods of the same names call these.
+
+# Config values the functions below read
+POSTPROCESS_CONFIG_ATTRIBUTES = ["NUM_CLASSES", "DETECTION_MIN_CONFIDENCE", "DETECTION_NMS_THRESHOLD",
+                                 "DETECTION_MAX_INSTANCES", "DETECTION_MASK_THRESHOLD",
+                                 "COMPACT_MASKS", "SAVE_PROB_MASK", "PROB_MASK_DTYPE"]
+
+def postprocess_config(config):
+    """The POSTPROCESS_CONFIG_ATTRIBUTES of config in a plain namespace. A
+    spawned process unpickles it without importing the module of the config
+    class (and TensorFlow with it).
+    """
+    return types.SimpleNamespace(**{name: getattr(config, name) for name in POSTPROCESS_CONFIG_ATTRIBUTES})
+
+def select_detections(boxes, class_ids, class_scores, config):
+    """Filters refined boxes as nuclei_model.refine_detections() does: drops background
+    boxes and boxes below DETECTION_MIN_CONFIDENCE, applies per-class NMS
+    with DETECTION_NMS_THRESHOLD and keeps the DETECTION_MAX_INSTANCES best.
+
+    boxes: [N, (y1, x1, y2, x2)] in pixels
+    class_ids: [N] top class of each box
+    class_scores: [N] probability of that class
+
+    Returns the int32 indices of the boxes kept, best first.
+    """
+    # Filter out background boxes
+    keep = np.where(class_ids > 0)[0]
+    # Filter out low confidence boxes
+    if config.DETECTION_MIN_CONFIDENCE:
+        keep = np.intersect1d(
+            keep, np.where(class_scores >= config.DETECTION_MIN_CONFIDENCE)[0])
+
+    # Apply per-class NMS
+    pre_nms_class_ids = class_ids[keep]
+    pre_nms_scores = class_scores[keep]
+    pre_nms_rois = boxes[keep]
+    nms_keep = []
+    for class_id in np.unique(pre_nms_class_ids):
+        # Pick detections of this class
+        ixs = np.where(pre_nms_class_ids == class_id)[0]
+        # Apply NMS
+        class_keep = non_max_suppression(
+            pre_nms_rois[ixs], pre_nms_scores[ixs],
+            config.DETECTION_NMS_THRESHOLD)
+        # Map indicies
+        class_keep = keep[ixs[class_keep]]
+        nms_keep = np.union1d(nms_keep, class_keep)
+    keep = np.intersect1d(keep, nms_keep).astype(np.int32)
+
+    # Keep top detections
+    roi_count = config.DETECTION_MAX_INSTANCES
+    top_ids = np.argsort(class_scores[keep])[::-1][:roi_count]
+    return keep[top_ids]
+
+def unmold_boxes(boxes, image_shape, window):
+    """Translates boxes from the molded image to the original image.
+
+    boxes: [N, (y1, x1, y2, x2)] in pixels of the molded image
+    image_shape: [height, width, depth] Original size of the image before resizing
+    window: [y1, x1, y2, x2] Box in the image where the real image is
+            excluding the padding.
+
+    Returns [N, (y1, x1, y2, x2)] int32 boxes in pixels of the original image
+    """
+    # Compute scale and shift to translate coordinates to image domain.
+    h_scale = image_shape[0] / (window[2] - window[0])
+    w_scale = image_shape[1] / (window[3] - window[1])
+    scale = min(h_scale, w_scale)
+    shift = window[:2]  # y, x
+    scales = np.array([scale, scale, scale, scale])
+    shifts = np.array([shift[0], shift[1], shift[0], shift[1]])
+    return np.multiply(boxes - shifts, scales).astype(np.int32)
+
+def unmold_detections(detections, mrcnn_mask, image_shape, window, config):
+    """Reformats the detections of one image from the format of the neural
+    network output to a format suitable for use in the rest of the
+    application.
+
+    detections: [N, (y1, x1, y2, x2, class_id, score)]
+    mrcnn_mask: [N, height, width, num_classes], or None to only return
+        the boxes, class_ids and scores
+    image_shape: [height, width, depth] Original size of the image before resizing
+    window: [y1, x1, y2, x2] Box in the image where the real image is
+            excluding the padding.
+
+    Returns:
+    boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
+    class_ids: [N] Integer class IDs for each bounding box
+    scores: [N] Float probability scores of the class_id
+    masks: [height, width, num_instances] Instance masks, or with
+        COMPACT_MASKS an InstanceMasks that also holds the probabilities
+    """
+    # How many detections do we have?
+    # Detections array is padded with zeros. Find the first class_id == 0.
+    zero_ix = np.where(detections[:, 4] == 0)[0]
+    N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[0]
+
+    # Extract boxes, class_ids, scores, and class-specific masks
+    boxes = detections[:N, :4]
+    class_ids = detections[:N, 4].astype(np.int32)
+    scores = detections[:N, 5]
+
+    # Translate bounding boxes to image domain
+    boxes = unmold_boxes(boxes, image_shape, window)
+
+    # Filter out detections with zero area. Often only happens in early
+    # stages of training when the network weights are still a bit random.
+    exclude_ix = np.where(
+        (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) <= 0)[0]
+    if exclude_ix.shape[0] > 0:
+        keep = np.delete(np.arange(N), exclude_ix)
+        boxes = np.delete(boxes, exclude_ix, axis=0)
+        class_ids = np.delete(class_ids, exclude_ix, axis=0)
+        scores = np.delete(scores, exclude_ix, axis=0)
+        N = class_ids.shape[0]
+    else:
+        keep = np.arange(N)
+    if mrcnn_mask is None:
+        return boxes, class_ids, scores
+    masks = mrcnn_mask[keep, :, :, class_ids]
+
+    if config.COMPACT_MASKS:
+        # Box-local masks only, the probabilities in them if kept
+        probs = [unmold_mask_box(masks[i], boxes[i]) for i in range(N)]
+        return boxes, class_ids, scores, InstanceMasks.from_probs(
+            boxes, probs, image_shape, keep_probs=config.SAVE_PROB_MASK,
+            prob_dtype=config.PROB_MASK_DTYPE,
+            threshold=config.DETECTION_MASK_THRESHOLD)
+
+    # Resize masks to original image size and set boundary threshold.
+    full_masks = []
+    if config.SAVE_PROB_MASK:
+        full_masks_prob = []
+    for i in range(N):
+        # Convert neural network mask to full size mask
+        full_mask = unmold_mask(masks[i], boxes[i], image_shape,
+                                config.DETECTION_MASK_THRESHOLD)
+        full_masks.append(full_mask)
+        if config.SAVE_PROB_MASK:
+            full_mask_prob = unmold_mask_prob(masks[i], boxes[i], image_shape)
+            full_masks_prob.append(full_mask_prob)
+
+    full_masks = np.stack(full_masks, axis=-1)\
+        if full_masks else np.empty((0,) + masks.shape[1:3])
+    if config.SAVE_PROB_MASK:
+        full_masks_prob = np.stack(full_masks_prob, axis=-1) \
+            if full_masks_prob else np.empty((0,) + masks.shape[1:3])
+
+    if config.SAVE_PROB_MASK:
+        return boxes, class_ids, scores, full_masks, full_masks_prob
+    else:
+        return boxes, class_ids, scores, full_masks
+
+def unmold_result(detections, mrcnn_mask, image_shape, window, config):
+    """Builds the detect() result dict of one image from the outputs of
+    the model for it. See unmold_detections() for the arguments.
+    """
+    if mrcnn_mask is None:
+        final_rois, final_class_ids, final_scores =\
+            unmold_detections(detections, None, image_shape, window, config)
+        return {
+            "rois": final_rois,
+            "class_ids": final_class_ids,
+            "scores": final_scores,
+        }
+    if config.COMPACT_MASKS:
+        final_rois, final_class_ids, final_scores, final_masks =\
+            unmold_detections(detections, mrcnn_mask, image_shape, window, config)
+        return {
+            "rois": final_rois,
+            "class_ids": final_class_ids,
+            "scores": final_scores,
+            "masks": final_masks.deoverlap(),
+        }
+    if config.SAVE_PROB_MASK:
+        final_rois, final_class_ids, final_scores, final_masks, final_masks_prob = \
+            unmold_detections(detections, mrcnn_mask, image_shape, window, config)
+        return {
+            "rois": final_rois,
+            "class_ids": final_class_ids,
+            "scores": final_scores,
+            "masks": deoverlap_masks(final_masks),
+            "masks_prob": final_masks_prob,
+        }
+    final_rois, final_class_ids, final_scores, final_masks =\
+        unmold_detections(detections, mrcnn_mask, image_shape, window, config)
+    return {
+        "rois": final_rois,
+        "class_ids": final_class_ids,
+        "scores": final_scores,
+        "masks": deoverlap_masks(final_masks),
+    }
+
+def replay_raw(raw, config):
+    """Builds the detect() result dict of one image from its
+    detect_raw() dict, with the DETECTION_MIN_CONFIDENCE,
+    DETECTION_NMS_THRESHOLD, DETECTION_MAX_INSTANCES and
+    DETECTION_MASK_THRESHOLD of the config. See MaskRCNN.detect_raw() for
+    how close it is to detect().
+    """
+    probs = np.asarray(raw["probs"], dtype=np.float32)
+    class_ids = np.argmax(probs, axis=1)
+    class_scores = probs[np.arange(len(probs)), class_ids]
+    keep = select_detections(raw["boxes"], class_ids, class_scores, config)
+    detections = np.hstack([raw["boxes"][keep], class_ids[keep][:, np.newaxis],
+                            class_scores[keep][:, np.newaxis]]).astype(np.float32)
+    masks = raw["masks"][keep].astype(np.float32)
+    if raw["masks"].dtype == np.uint8:
+        masks /= 255.
+    # Only the channel of the top class is cached
+    mrcnn_mask = np.zeros(masks.shape + (config.NUM_CLASSES,), dtype=np.float32)
+    mrcnn_mask[np.arange(len(keep)), :, :, class_ids[keep]] = masks
+    return unmold_result(detections, mrcnn_mask, raw["image_shape"], raw["window"], config)
+
 ############################################################
 #  Anchors
 ############################################################
@@ -685,20 +1062,27 @@ def compute_ap(gt_boxes, gt_class_ids,
     return mAP, precisions, recalls, overlaps
 
 def compute_mask_ap(gt_mask,pred_mask, pred_scores,iou_threshold=0.5):
+    return mask_ap_from_iou(compute_mask_iou(gt_mask, pred_mask), iou_threshold)
+
+def compute_mask_iou(gt_mask, pred_mask):
+    # IoU of each ground truth instance (rows) with each predicted instance
     # Compute number of objects
     true_objects = gt_mask.shape[2]
     pred_objects = pred_mask.shape[2]
 
     gt_mask[gt_mask>0] = 1
-    pred_mask[pred_mask>0] = 1
     labels = np.zeros([gt_mask.shape[0], gt_mask.shape[1]])
-    y_pred = np.zeros([gt_mask.shape[0], gt_mask.shape[1]])
 
     for k in range(true_objects):
         labels += gt_mask[:,:,k]*(k+1)
 
-    for k in range(pred_objects):
-        y_pred += pred_mask[:,:,k]*(k+1)
+    if isinstance(pred_mask, InstanceMasks):
+        y_pred = pred_mask.label_map()
+    else:
+        pred_mask[pred_mask>0] = 1
+        y_pred = np.zeros([gt_mask.shape[0], gt_mask.shape[1]])
+        for k in range(pred_objects):
+            y_pred += pred_mask[:,:,k]*(k+1)
 
     # Compute intersection between all objects
     intersection = np.histogram2d(labels.flatten(), y_pred.flatten(), bins=(true_objects+1, pred_objects+1))[0]
@@ -717,7 +1101,9 @@ def compute_mask_ap(gt_mask,pred_mask, pred_scores,iou_threshold=0.5):
     union[union == 0] = 1e-9
 
     # Compute the intersection over union
-    iou = intersection / union
+    return intersection / union
+
+def mask_ap_from_iou(iou, iou_threshold=0.5):
     matches = iou > iou_threshold
     true_positives = np.sum(matches, axis=1) == 1   # Correct objects
     false_positives = np.sum(matches, axis=0) == 0  # Missed objects
@@ -730,36 +1116,53 @@ def sweep_iou_mask_ap(gt_mask,pred_mask, pred_scores):
 
     if pred_mask.shape[0] == gt_mask.shape[0] and pred_mask.shape[1] == gt_mask.shape[1]:
         iou_thresholds = np.arange(0.5,1,0.05)
+        # The IoUs don't depend on the threshold
+        iou = compute_mask_iou(gt_mask, pred_mask)
         ap = []
         for iou_threshold in iou_thresholds:
-            ap.append(compute_mask_ap(gt_mask,pred_mask, pred_scores, iou_threshold=iou_threshold))
+            ap.append(mask_ap_from_iou(iou, iou_threshold=iou_threshold))
         return np.mean(ap)
     else:
         return 0
 
-def deoverlap_masks(masks):
-    # masks HxWxI
-    # I stands for number of Instances
-    masks_collapse = np.sum(masks,axis=2)
-    # Ix2 array
-    com = np.zeros((masks.shape[2],2))
-    for k in range(masks.shape[2]):
-        com[k,:] = center_of_mass(masks[:,:,k])
-    # #overlapx2 array
-    overlap_indices = np.argwhere(masks_collapse>1)
-
-    for k in range(overlap_indices.shape[0]):
-        # the indices of the overlapped instances
-        mask_indices = np.argwhere(np.squeeze(masks[overlap_indices[k,0],overlap_indices[k,1],:])==1) # binary mask assumed
-        dist_tmp = []
-        # print mask_indices
-        for kk in range(len(mask_indices)):
-            dif_vec = [overlap_indices[k,0],overlap_indices[k,1]]-com[mask_indices[kk],:]
-            dist_tmp.append(np.sum(np.square(dif_vec)))
-        dist_tmp = np.array(dist_tmp)
-        masks[overlap_indices[k,0],overlap_indices[k,1],mask_indices[dist_tmp>dist_tmp.min()]] = 0
-
-    return masks
+def deoverlap_masks(masks, return_labels=False):
+    """Resolves the pixels of several instances: each is kept only by the
+    instances whose center of mass is the closest to it (all of them on a
+    tie). The masks are changed in place.
+
+    masks: [H, W, N] binary masks
+    return_labels: also return the [H, W] int32 label map, instance k as
+        k + 1, where a pixel still shared after a tie goes to the later one
+
+    Returns the masks, and the label map if asked for.
+    """
+    height, width, count = masks.shape
+    # Centers of mass of all the instances at once, from exact integer sums
+    # so they are the same as center_of_mass() of each mask
+    area = masks.sum(axis=(0, 1), dtype=np.int64)
+    row_sum = np.arange(height).dot(masks.sum(axis=1, dtype=np.int64))
+    col_sum = np.arange(width).dot(masks.sum(axis=0, dtype=np.int64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        com = np.stack([row_sum / area.astype(np.float64),
+                        col_sum / area.astype(np.float64)], axis=1)
+
+    rows, cols = np.nonzero(masks.sum(axis=2) > 1)
+    # Contested pixels in chunks, to bound the [pixels, N] distances
+    step = max((1 << 20) // max(count, 1), 1)
+    for k in range(0, len(rows), step):
+        r, c = rows[k:k + step], cols[k:k + step]
+        covered = masks[r, c, :] == 1
+        dist = np.square(r[:, None] - com[None, :, 0]) + np.square(c[:, None] - com[None, :, 1])
+        dist[~covered] = np.inf
+        pixel, instance = np.nonzero(covered & (dist > dist.min(axis=1, keepdims=True)))
+        masks[r[pixel], c[pixel], instance] = 0
+
+    if not return_labels:
+        return masks
+    # Last instance covering each pixel
+    on = masks[:, :, ::-1] == 1
+    labels = np.where(on.any(axis=2), count - np.argmax(on, axis=2), 0).astype(np.int32)
+    return masks, labels
 
 def compute_recall(pred_boxes, gt_boxes, iou):
     """Compute the recall at the given IoU threshold. It's an indication
@@ -831,6 +1234,7 @@ def batch_slice(inputs, graph_fn, batch_size, names=None):
     if names is None:
         names = [None] * len(outputs)
 
+    import tensorflow as tf
     result = [tf.stack(o, axis=0, name=n)
               for o, n in zip(outputs, names)]
     if len(result) == 1:
@@ -1143,3 +1547,105 @@ def augment_image_mask_and_rmb(image, mask, rand_scale_train=True, scale_high_in
 
     return image, masks, class_ids
 
+
+
+############################################################
+#  Test-time Augmentation
+############################################################
+
+# Flips and rotations run by MaskRCNN.detect_tta(). Rotations are
+# counterclockwise, as np.rot90.
+TTA_VARIANTS = ["identity", "flip_lr", "flip_ud", "rot90", "rot180", "rot270"]
+
+def tta_transform(image, variant):
+    """Returns the image [H, W, C] seen through one of TTA_VARIANTS."""
+    if variant == "identity":
+        return image
+    if variant == "flip_lr":
+        return image[:, ::-1]
+    if variant == "flip_ud":
+        return image[::-1]
+    if variant == "rot90":
+        return np.rot90(image, 1)
+    if variant == "rot180":
+        return np.rot90(image, 2)
+    if variant == "rot270":
+        return np.rot90(image, 3)
+    raise ValueError("Unknown TTA variant {}".format(variant))
+
+def tta_invert(box, crop, variant, image_shape):
+    """Maps an instance found on tta_transform(image, variant) back to image.
+    box: [y1, x1, y2, x2] in pixels of the transformed image
+    crop: [y2 - y1, x2 - x1] mask (or probabilities) of the instance in its box
+    image_shape: [H, W, ...] of the original image
+
+    Returns the box and the box-local crop in the original image.
+    """
+    H, W = image_shape[:2]
+    y1, x1, y2, x2 = box
+    if variant == "identity":
+        return np.array([y1, x1, y2, x2]), crop
+    if variant == "flip_lr":
+        return np.array([y1, W - x2, y2, W - x1]), crop[:, ::-1]
+    if variant == "flip_ud":
+        return np.array([H - y2, x1, H - y1, x2]), crop[::-1]
+    if variant == "rot90":
+        return np.array([x1, W - y2, x2, W - y1]), np.rot90(crop, -1)
+    if variant == "rot180":
+        return np.array([H - y2, W - x2, H - y1, W - x1]), np.rot90(crop, 2)
+    if variant == "rot270":
+        return np.array([H - x2, y1, H - x1, y2]), np.rot90(crop, 1)
+    raise ValueError("Unknown TTA variant {}".format(variant))
+
+def fuse_tta_instances(boxes, class_ids, scores, probs, variant_ids, num_variants,
+                       iou_threshold=0.5, min_votes=0.5):
+    """Fuses the instances found on the variants of one image.
+
+    Instances are clustered greedily by score: each one not yet taken takes,
+    from every other variant, the instance of the same class with the highest
+    box IoU above iou_threshold. The mask probabilities of a cluster are
+    averaged over its members in their union box, and its score is the sum
+    of the member scores over num_variants, so instances that few variants
+    find score lower (score voting).
+
+    boxes: [N, (y1, x1, y2, x2)] in pixels of the original image
+    class_ids, scores, variant_ids: [N]
+    probs: list of N box-local mask probabilities
+    min_votes: smallest share of the variants that must find an instance
+
+    Returns boxes, class_ids, scores and box-local probabilities of the fused
+    instances, by decreasing score.
+    """
+    fused_boxes, fused_class_ids, fused_scores, fused_probs = [], [], [], []
+    if len(scores):
+        overlaps = compute_overlaps(boxes.astype(np.float32), boxes.astype(np.float32))
+        taken = np.zeros(len(scores), dtype=bool)
+        for i in np.argsort(-scores):
+            if taken[i]:
+                continue
+            members = [i]
+            for v in range(num_variants):
+                if v == variant_ids[i]:
+                    continue
+                candidates = np.where(~taken & (variant_ids == v) & (class_ids == class_ids[i]) &
+                                      (overlaps[i] >= iou_threshold))[0]
+                if len(candidates):
+                    members.append(candidates[np.argmax(overlaps[i, candidates])])
+            taken[members] = True
+            if len(members) < min_votes * num_variants:
+                continue
+            y1, x1 = boxes[members, :2].min(axis=0)
+            y2, x2 = boxes[members, 2:].max(axis=0)
+            prob = np.zeros((y2 - y1, x2 - x1), dtype=np.float32)
+            for m in members:
+                by1, bx1, by2, bx2 = boxes[m]
+                prob[by1 - y1:by2 - y1, bx1 - x1:bx2 - x1] += probs[m]
+            fused_boxes.append([y1, x1, y2, x2])
+            fused_class_ids.append(class_ids[i])
+            fused_scores.append(scores[members].sum() / num_variants)
+            fused_probs.append(prob / len(members))
+    order = np.argsort(-np.array(fused_scores, dtype=np.float32))
+    return (np.array(fused_boxes, dtype=np.int32).reshape(-1, 4)[order],
+            np.array(fused_class_ids, dtype=np.int32)[order],
+            np.array(fused_scores, dtype=np.float32)[order],
+            [fused_probs[k] for k in order])
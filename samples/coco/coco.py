@@ -356,16 +356,26 @@ def evaluate_coco(model, dataset, coco, eval_type="bbox", limit=0, image_ids=Non
     coco_image_ids = [dataset.image_info[id]["id"] for id in image_ids]
 
     t_prediction = 0
+    t_load = 0
     t_start = time.time()
 
+    # Images are loaded as the detection batches need them, inside
+    # next(detections), so their loading time is taken out of the
+    # prediction time
+    def load_images():
+        nonlocal t_load
+        for image_id in image_ids:
+            t = time.time()
+            image = dataset.load_image(image_id)
+            t_load += time.time() - t
+            yield image
+    detections = model.detect_iter(load_images())
+
     results = []
     for i, image_id in enumerate(image_ids):
-        # Load image
-        image = dataset.load_image(image_id)
-
         # Run detection
         t = time.time()
-        r = model.detect([image], verbose=0)[0]
+        r = next(detections)
         t_prediction += (time.time() - t)
 
         # Convert results to COCO format
@@ -386,8 +396,11 @@ def evaluate_coco(model, dataset, coco, eval_type="bbox", limit=0, image_ids=Non
     cocoEval.accumulate()
     cocoEval.summarize()
 
+    t_prediction -= t_load
     print("Prediction time: {}. Average {}/image".format(
         t_prediction, t_prediction / len(image_ids)))
+    print("Image loading time: {}. Average {}/image".format(
+        t_load, t_load / len(image_ids)))
     print("Total time: ", time.time() - t_start)
 
 
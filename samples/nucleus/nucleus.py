@@ -23,6 +23,28 @@ Usage: import the module (see Jupyter notebooks for examples), or run from
 
     # Generate submission file
     python3 nucleus.py detect --dataset=/path/to/dataset --subset=train --weights=<last or /path/to/weights.h5>
+
+    # Freeze trained weights into a self-contained inference graph
+    python3 nucleus.py export --weights=/path/to/weights.h5 --frozen=/path/to/nucleus.pb
+
+    # Run a directory or manifest of images in 4 shards at once, then merge them
+    # (a stopped shard run again skips the images it has done)
+    for i in 0 1 2 3; do
+        python3 nucleus.py infer --input=/path/to/images --weights=/path/to/weights.h5 --submission=answer.json --shard=$i/4 --infer_threads=4 &
+    done; wait
+    python3 nucleus.py merge --input=/path/to/images --submission=answer.json --shards=4
+
+    # Stream the submission to a JSON lines file, masks encoded by 4 processes
+    python3 nucleus.py detect --dataset=/path/to/dataset --subset=train --weights=/path/to/weights.h5 --submission=answer.jsonl --encode_workers=4
+
+    # Generate submission file from the frozen graph
+    python3 nucleus.py detect --dataset=/path/to/dataset --subset=train --frozen=/path/to/nucleus.pb
+
+    # Sweep CPU towers x threads per tower and report images/sec
+    python3 nucleus.py towers --dataset=/path/to/dataset --subset=train --weights=/path/to/weights.h5 --towers 1 2 4 --threads 4 8 16
+
+    # Compare detect_iter() images/sec at several batch sizes
+    python3 nucleus.py batch --dataset=/path/to/dataset --subset=train --weights=/path/to/weights.h5 --batch_sizes 1 2 4 8
 """
 
 # Set matplotlib backend
@@ -38,11 +60,12 @@ if __name__ == '__main__':
 import os
 import sys
 import json
+import time
 import datetime
 import numpy as np
 import skimage.io
 from imgaug import augmenters as iaa
-from pycocotools import mask as cocom
+import keras.backend as K
 
 
 # Root directory of the project
@@ -54,6 +77,10 @@ from mrcnn.config import Config
 from mrcnn import utils
 from mrcnn import model as modellib
 from mrcnn import visualize
+from mrcnn import frozen
+import nuclei_rle
+import nuclei_submission
+from nuclei_submission import SubmissionWriter
 
 # Path to trained weights file
 COCO_WEIGHTS_PATH = os.path.join(ROOT_DIR, "mask_rcnn_coco.h5")
@@ -306,32 +333,13 @@ def rle_encode(mask):
     Returns a string of space-separated values.
     """
     assert mask.ndim == 2, "Mask must be of shape [Height, Width]"
-    # Flatten it column wise
-    m = mask.T.flatten()
-    # Compute gradient. Equals 1 or -1 at transition points
-    g = np.diff(np.concatenate([[0], m, [0]]), n=1)
-    # 1-based indicies of transition points (where gradient != 0)
-    rle = np.where(g != 0)[0].reshape([-1, 2]) + 1
-    # Convert second index in each pair to lenth
-    rle[:, 1] = rle[:, 1] - rle[:, 0]
-    return " ".join(map(str, rle.flatten()))
+    return nuclei_rle.kaggle_string(*nuclei_rle.mask_runs(mask != 0))
 
 
 def rle_decode(rle, shape):
     """Decodes an RLE encoded list of space separated
     numbers and returns a binary mask."""
-    rle = list(map(int, rle.split()))
-    rle = np.array(rle, dtype=np.int32).reshape([-1, 2])
-    rle[:, 1] += rle[:, 0]
-    rle -= 1
-    mask = np.zeros([shape[0] * shape[1]], np.bool)
-    for s, e in rle:
-        assert 0 <= s < mask.shape[0]
-        assert 1 <= e <= mask.shape[0], "shape: {}  s {}  e {}".format(shape, s, e)
-        mask[s:e] = 1
-    # Reshape and transpose
-    mask = mask.reshape([shape[1], shape[0]]).T
-    return mask
+    return nuclei_rle.decode_kaggle(rle, shape)
 
 
 def mask_to_rle(image_id, mask, scores):
@@ -345,14 +353,15 @@ def mask_to_rle(image_id, mask, scores):
     # then take the maximum across the last dimension
     order = np.argsort(scores)[::-1] + 1  # 1-based descending
     mask = np.max(mask * np.reshape(order, [1, 1, -1]), -1)
-    # Loop over instance masks
+    # Runs of all the instances in one pass over the label map
+    runs = nuclei_rle.label_runs(mask, len(order))
     lines = []
     for o in order:
-        m = np.where(mask == o, 1, 0)
+        starts, lengths = runs[o - 1]
         # Skip if empty
-        if m.sum() == 0.0:
+        if not len(starts):
             continue
-        rle = rle_encode(m)
+        rle = nuclei_rle.kaggle_string(starts, lengths)
         lines.append("{}, {}".format(image_id, rle))
     return "\n".join(lines)
 
@@ -361,8 +370,12 @@ def mask_to_rle(image_id, mask, scores):
 #  Detection
 ############################################################
 
-def detect(model, dataset_dir, subset):
-    """Run detection on images in the given directory."""
+def detect(model, dataset_dir, subset, submission_path="answer.json", encode_workers=2):
+    """Run detection on images in the given directory.
+
+    The records are streamed to submission_path (JSON lines if it ends with
+    .jsonl), their masks encoded by encode_workers processes.
+    """
     print("Running on {}".format(dataset_dir))
 
     # Create directory
@@ -379,19 +392,18 @@ def detect(model, dataset_dir, subset):
     # Load over images
     submission = []
     res=[]
-    sub_data=[]
+    writer = SubmissionWriter(submission_path, workers=encode_workers)
     img_names={"TCGA-A7-A13E-01Z-00-DX1": 1, "TCGA-50-5931-01Z-00-DX1": 2, "TCGA-G2-A2EK-01A-02-TSB": 3, "TCGA-AY-A8YK-01A-01-TS1": 4, "TCGA-G9-6336-01Z-00-DX1": 5, "TCGA-G9-6348-01Z-00-DX1": 6}
     imageid_order=[1,0,3,2,4,5]
+    # Detect objects, BATCH_SIZE images at a time
+    images = (dataset.load_image(image_id) for image_id in imageid_order)
+    detections = model.detect_iter(images, model.config.BATCH_SIZE)
+    start = time.time()
     for o in range(6):
-        # Load image and run detection
-        ##print('catch')
-        ##print(image_id)
         image_id=imageid_order[o]
-        image = dataset.load_image(image_id)
-        ##print(image)
-        ##print('catch')
-        # Detect objects
-        r = model.detect([image], verbose=0)[0]
+        r = next(detections)
+        if o == 0:
+            print("First image latency: {:.2f}s".format(time.time() - start))
         print(dataset.image_info[image_id]["id"])
         name=dataset.image_info[image_id]["id"]
         ##print(r)
@@ -420,34 +432,9 @@ def detect(model, dataset_dir, subset):
         #print(sub_masks[1])
         #print(sub_masks[2])
         #print(sub_masks[999])
-        limit=0
-        
-        for i in range(len(sub_rois)):
-            y1, x1, y2, x2 = sub_rois[i]
-            width, height = x2 - x1, y2 - y1
-            single_mask=sub_masks[:,:,i]
-            input_mask=np.array(single_mask > 0.5, dtype=np.bool, order='F')
-            encode_mask=cocom.encode(input_mask)
-            
-            ##if limit==0:
-              #  print('catch')
-               # print(encode_mask['counts'])
-                #print(str(encode_mask['counts']))
-                #print(str(encode_mask['counts'])[1:])
-                #print(str(encode_mask['counts'])[2:])
-                #print('catch')
-                #limit=1
-            
-            data={
-                "image_id": int(img_names[name]) , 
-                "bbox": [float(x1), float(y1), float(width), float(height)], 
-                "score": float(sub_scores[i]) , 
-                "category_id": int(1), 
-                "segmentation": {"size": encode_mask['size'], "counts": encode_mask['counts'].decode('utf-8')}
-                 }
-            sub_data.append(data)
-            
-            ##{"size": [1000,1000], "counts": str(encode_mask['counts'])}
+        # image_id, bbox, score, category_id and COCO RLE segmentation of
+        # each instance, encoded in the background and appended in order
+        writer.write(img_names[name], r)
         
         
         
@@ -472,12 +459,8 @@ def detect(model, dataset_dir, subset):
     ##with open(file_path, "w") as f:
         ##f.write(submission)
     ##print("Saved to ", submit_dir)
-    print(sub_data[0])
-    
-    result=json.dumps(sub_data)
-    
-    with open('answer.json', 'w') as fp:
-        fp.write(result)
+    writer.close()
+    print("{} records written to {}".format(writer.records, submission_path))
     
     print('finish')
     
@@ -495,6 +478,170 @@ def detect(model, dataset_dir, subset):
     ##f.close()
 
 
+############################################################
+#  Sharded Inference
+############################################################
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+
+
+def list_images(input_path, image_dir=None):
+    """Lists the (image_id, path) of the images to run, in the same order
+    for every shard.
+
+    input_path: one of
+        * a directory, searched recursively. The ids are the file names
+          without extension.
+        * a JSON manifest, a list of {"file_name": ..., "id": ...} such as
+          test_img_ids.json
+        * a text manifest, one "path" or "path image_id" per line. Numeric
+          ids are ints, the default id is the file name without extension.
+    image_dir: directory of the relative paths of a manifest, the directory
+        of the manifest by default
+    """
+    def stem(path):
+        return os.path.splitext(os.path.basename(path))[0]
+
+    if os.path.isdir(input_path):
+        paths = []
+        for root, _, files in os.walk(input_path):
+            paths.extend(os.path.join(root, f) for f in files
+                         if f.lower().endswith(IMAGE_EXTENSIONS))
+        return [(stem(p), p) for p in sorted(paths)]
+
+    image_dir = image_dir or os.path.dirname(os.path.abspath(input_path))
+    images = []
+    if input_path.endswith(".json"):
+        with open(input_path) as f:
+            for info in json.load(f):
+                images.append((info["id"], os.path.join(image_dir, info["file_name"])))
+        return images
+    with open(input_path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            path = os.path.join(image_dir, fields[0])
+            image_id = fields[1] if len(fields) > 1 else stem(path)
+            images.append((int(image_id) if image_id.isdigit() else image_id, path))
+    return images
+
+
+def infer(model, input_path, output, shard=0, shards=1, image_dir=None,
+          encode_workers=2, flush_every=10):
+    """Runs detection on one shard of the images of input_path, every
+    shards-th image from the shard-th, BATCH_SIZE images at a time.
+
+    The records go to the shard files of output, see
+    nuclei_submission.shard_paths(), and the images already in the shard
+    log are skipped, so a stopped shard picks up where it was. With one
+    shard, output is written at the end, else run 'merge' once all the
+    shards are done.
+    """
+    all_images = list_images(input_path, image_dir)
+    images = all_images[shard::shards]
+    records_path, log_path = nuclei_submission.shard_paths(output, shard, shards)
+    done = nuclei_submission.resume_shard(records_path, log_path)
+    todo = [(image_id, path) for image_id, path in images if str(image_id) not in done]
+    print("Shard {}/{}: {} images, {} done before, {} to run".format(
+        shard, shards, len(images), len(images) - len(todo), len(todo)))
+
+    writer = SubmissionWriter(records_path, lines=True, workers=encode_workers,
+                              flush_every=flush_every, log_path=log_path, append=True)
+    start = time.time()
+    try:
+        detections = model.detect_iter((path for _, path in todo), model.config.BATCH_SIZE)
+        for k, ((image_id, _), r) in enumerate(zip(todo, detections)):
+            writer.write(image_id, r)
+            if (k + 1) % flush_every == 0 or k + 1 == len(todo):
+                print("Shard {}/{}: {}/{} images, {:.2f} images/sec".format(
+                    shard, shards, k + 1, len(todo), (k + 1) / (time.time() - start)))
+    finally:
+        writer.close()
+
+    if shards == 1:
+        missing = nuclei_submission.merge_shards(
+            output, 1, [image_id for image_id, _ in all_images])
+        print("{} written, {} images missing".format(output, len(missing)))
+
+
+############################################################
+#  Batch Size Benchmark
+############################################################
+
+def sweep_batch_sizes(weights_path, dataset_dir, subset, logs_dir,
+                      batch_sizes, count=32):
+    """Runs detect_iter() over count images of the subset with a model
+    built for each batch size and prints the images/sec of each. The
+    images keep their sizes, so the batches are formed by shape.
+    """
+    dataset = NucleusDataset()
+    dataset.load_nucleus(dataset_dir, subset)
+    dataset.prepare()
+    images = [dataset.load_image(dataset.image_ids[i % len(dataset.image_ids)])
+              for i in range(count)]
+
+    for batch_size in batch_sizes:
+        K.clear_session()
+        config = NucleusInferenceConfig()
+        config.IMAGES_PER_GPU = batch_size
+        config.BATCH_SIZE = batch_size
+        model = modellib.MaskRCNN(mode="inference", config=config,
+                                  model_dir=logs_dir)
+        model.load_weights(weights_path, by_name=True)
+
+        # The first run builds the kernels and is left out
+        list(model.detect_iter(images[:batch_size]))
+        start = time.time()
+        for _ in model.detect_iter(images):
+            pass
+        elapsed = time.time() - start
+        print("batch {:2d}: {:7.2f} images/sec".format(batch_size, count / elapsed))
+
+
+############################################################
+#  CPU Towers Benchmark
+############################################################
+
+def sweep_towers(weights_path, dataset_dir, subset, logs_dir,
+                 tower_counts, thread_counts, iterations=10):
+    """Runs inference with every combination of CPU towers and intra-op
+    threads per tower and prints the images/sec of each, to pick the
+    layout that suits the sockets and NUMA nodes of a host.
+
+    Each tower gets IMAGES_PER_GPU images of a batch. A batch repeats one
+    image of the subset, because all the images of a batch must have the
+    same size after molding.
+    """
+    dataset = NucleusDataset()
+    dataset.load_nucleus(dataset_dir, subset)
+    dataset.prepare()
+
+    for towers in tower_counts:
+        for threads in thread_counts:
+            K.clear_session()
+            config = NucleusInferenceConfig()
+            config.GPU_COUNT = towers
+            config.BATCH_SIZE = towers * config.IMAGES_PER_GPU
+            config.TOWER_DEVICE = "cpu"
+            config.CPU_TOWER_THREADS = threads
+            model = modellib.MaskRCNN(mode="inference", config=config,
+                                      model_dir=logs_dir)
+            model.load_weights(weights_path, by_name=True)
+
+            # The first run builds the kernels and is left out
+            image = dataset.load_image(dataset.image_ids[0])
+            model.detect([image] * config.BATCH_SIZE)
+            start = time.time()
+            for i in range(iterations):
+                image_id = dataset.image_ids[i % len(dataset.image_ids)]
+                image = dataset.load_image(image_id)
+                model.detect([image] * config.BATCH_SIZE)
+            elapsed = time.time() - start
+            print("towers {:2d} x threads {:2d}: {:7.2f} images/sec".format(
+                towers, threads, iterations * config.BATCH_SIZE / elapsed))
+
+
 ############################################################
 #  Command Line
 ############################################################
@@ -507,13 +654,16 @@ if __name__ == '__main__':
         description='Mask R-CNN for nuclei counting and segmentation')
     parser.add_argument("command",
                         metavar="<command>",
-                        help="'train' or 'detect'")
+                        help="'train', 'detect', 'infer', 'merge', 'export', 'towers' or 'batch'")
     parser.add_argument('--dataset', required=False,
                         metavar="/path/to/dataset/",
                         help='Root directory of the dataset')
-    parser.add_argument('--weights', required=True,
+    parser.add_argument('--weights', required=False,
                         metavar="/path/to/weights.h5",
                         help="Path to weights .h5 file or 'coco'")
+    parser.add_argument('--frozen', required=False,
+                        metavar="/path/to/graph.pb",
+                        help="Frozen graph to write with 'export' or to run 'detect' with")
     parser.add_argument('--logs', required=False,
                         default=DEFAULT_LOGS_DIR,
                         metavar="/path/to/logs/",
@@ -521,6 +671,38 @@ if __name__ == '__main__':
     parser.add_argument('--subset', required=False,
                         metavar="Dataset sub-directory",
                         help="Subset of dataset to run prediction on")
+    parser.add_argument('--towers', required=False, type=int, nargs='+',
+                        default=[1, 2, 4],
+                        help="Numbers of CPU towers to try with 'towers'")
+    parser.add_argument('--threads', required=False, type=int, nargs='+',
+                        default=[2, 4, 8],
+                        help="Numbers of threads per tower to try with 'towers'")
+    parser.add_argument('--batch_sizes', required=False, type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help="Batch sizes to try with 'batch'")
+    parser.add_argument('--submission', required=False,
+                        default="answer.json",
+                        metavar="/path/to/answer.json",
+                        help="Results file of 'detect', JSON lines if it ends with .jsonl")
+    parser.add_argument('--encode_workers', required=False, type=int,
+                        default=2,
+                        help="Processes encoding the masks of 'detect', 0 for none")
+    parser.add_argument('--input', required=False,
+                        metavar="/path/to/images or manifest",
+                        help="Image directory, JSON manifest or text manifest for 'infer'")
+    parser.add_argument('--image_dir', required=False,
+                        metavar="/path/to/images",
+                        help="Directory of the relative paths of a manifest")
+    parser.add_argument('--shard', required=False,
+                        default="0/1",
+                        metavar="i/N",
+                        help="Run shard i (from 0) of N with 'infer'")
+    parser.add_argument('--shards', required=False, type=int,
+                        default=1,
+                        help="Number of shards to join with 'merge'")
+    parser.add_argument('--infer_threads', required=False, type=int,
+                        default=0,
+                        help="Intra-op threads of 'infer' on CPU, 0 for the TF default")
     args = parser.parse_args()
 
     # Validate arguments
@@ -528,20 +710,65 @@ if __name__ == '__main__':
         assert args.dataset, "Argument --dataset is required for training"
     elif args.command == "detect":
         assert args.subset, "Provide --subset to run prediction on"
+    elif args.command == "export":
+        assert args.frozen, "Provide --frozen to write the graph to"
+    elif args.command in ["towers", "batch"]:
+        assert args.subset, "Provide --subset to run prediction on"
+    elif args.command in ["infer", "merge"]:
+        assert args.input, "Provide --input images or manifest"
+    if args.command == "merge":
+        missing = nuclei_submission.merge_shards(
+            args.submission, args.shards,
+            [image_id for image_id, _ in list_images(args.input, args.image_dir)])
+        print("{} written, {} images missing".format(args.submission, len(missing)))
+        sys.exit(0)
+    assert args.weights or (args.command in ["detect", "infer"] and args.frozen),\
+        "Argument --weights is required"
 
     print("Weights: ", args.weights)
     print("Dataset: ", args.dataset)
     if args.subset:
         print("Subset: ", args.subset)
     print("Logs: ", args.logs)
+    if args.frozen:
+        print("Frozen graph: ", args.frozen)
 
     # Configurations
     if args.command == "train":
         config = NucleusConfig()
     else:
         config = NucleusInferenceConfig()
+    if args.command == "infer" and args.infer_threads:
+        # One intra-op pool of --infer_threads, so that shards share the cores
+        config.TOWER_DEVICE = "cpu"
+        config.CPU_TOWER_THREADS = args.infer_threads
     config.display()
 
+    # Each layout builds its own model
+    if args.command == "towers":
+        sweep_towers(args.weights, args.dataset, args.subset, args.logs,
+                     args.towers, args.threads)
+        sys.exit(0)
+    if args.command == "batch":
+        sweep_batch_sizes(args.weights, args.dataset, args.subset, args.logs,
+                          args.batch_sizes)
+        sys.exit(0)
+
+    # Cold start: time from here until the model is ready to detect
+    start_time = time.time()
+
+    # Run the frozen graph directly, no Keras model or h5 weights involved
+    if args.command in ["detect", "infer"] and args.frozen:
+        model = frozen.FrozenMaskRCNN(config, args.frozen)
+        print("Model ready in {:.2f}s".format(time.time() - start_time))
+        if args.command == "infer":
+            shard, shards = map(int, args.shard.split("/"))
+            infer(model, args.input, args.submission, shard, shards, args.image_dir,
+                  args.encode_workers)
+        else:
+            detect(model, args.dataset, args.subset, args.submission, args.encode_workers)
+        sys.exit(0)
+
     # Create model
     if args.command == "train":
         model = modellib.MaskRCNN(mode="training", config=config,
@@ -575,12 +802,19 @@ if __name__ == '__main__':
             "mrcnn_bbox", "mrcnn_mask"])
     else:
         model.load_weights(weights_path, by_name=True)
+    print("Model ready in {:.2f}s".format(time.time() - start_time))
 
     # Train or evaluate
     if args.command == "train":
         train(model, args.dataset, args.subset)
     elif args.command == "detect":
-        detect(model, args.dataset, args.subset)
+        detect(model, args.dataset, args.subset, args.submission, args.encode_workers)
+    elif args.command == "infer":
+        shard, shards = map(int, args.shard.split("/"))
+        infer(model, args.input, args.submission, shard, shards, args.image_dir,
+              args.encode_workers)
+    elif args.command == "export":
+        frozen.export_frozen_graph(model, args.frozen)
     else:
         print("'{}' is not recognized. "
-              "Use 'train' or 'detect'".format(args.command))
+              "Use 'train', 'detect', 'infer' or 'export'".format(args.command))